@@ -0,0 +1,79 @@
+"""Latency benchmark over models (e.g., pruned variants saved by run.py).
+
+    python benchmark.py --model_path base.h5 pruned.h5 --modes keras,tf_function,tflite,onnx_cpu \
+        --batch_sizes 1,8 --num_threads 1,4 --output results.json
+
+"""
+import os
+import json
+import argparse
+
+import tensorflow as tf
+
+from profiling import benchmark, custom_objects
+
+def compare(results, baseline=None):
+    """Print p50 latencies and throughput of each configuration relative to `baseline` (the first model by default)."""
+    models = []
+    for r in results:
+        if r["model"] not in models:
+            models.append(r["model"])
+    if baseline is None:
+        baseline = models[0]
+
+    base = {
+        (r["mode"], r["batch_size"], r["num_threads"]):r for r in results if r["model"] == baseline
+    }
+    print("%-30s %-12s %5s %7s %10s %10s %10s %12s %8s" % ("model", "mode", "batch", "threads", "p50(ms)", "p90(ms)", "p99(ms)", "samples/s", "speedup"))
+    for r in results:
+        key = (r["mode"], r["batch_size"], r["num_threads"])
+        speedup = base[key]["p50_ms"] / r["p50_ms"] if key in base else float("nan")
+        print("%-30s %-12s %5d %7s %10.3f %10.3f %10.3f %12.1f %8.2f" % (
+            r["model"], r["mode"], r["batch_size"], r["num_threads"], r["p50_ms"], r["p90_ms"], r["p99_ms"], r["throughput"], speedup))
+
+def parse_list(value, type_):
+    return [None if v == "none" else type_(v) for v in value.split(",")]
+
+def run():
+    parser = argparse.ArgumentParser(description='Latency benchmark')
+    parser.add_argument('--model_path', type=str, nargs='+', required=True, help='model files')
+    parser.add_argument('--modes', type=str, default="keras,tf_function,tflite,onnx_cpu", help='comma-separated modes')
+    parser.add_argument('--batch_sizes', type=str, default="1", help='comma-separated batch sizes')
+    parser.add_argument('--num_threads', type=str, default="none", help='comma-separated thread counts for TFLite and ONNX Runtime')
+    parser.add_argument('--tf_threads', type=int, default=None, help='intra-op threads of TF modes')
+    parser.add_argument('--num_rounds', type=int, default=100)
+    parser.add_argument('--num_warmup', type=int, default=10)
+    parser.add_argument('--output', type=str, default=None, help='a JSON file, to which results are appended')
+    args = parser.parse_args()
+
+    if args.tf_threads is not None: # It must be set before TF is initialized.
+        tf.config.threading.set_intra_op_parallelism_threads(args.tf_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    results = []
+    if args.output is not None and os.path.exists(args.output):
+        with open(args.output, "r") as f:
+            results = json.load(f)
+
+    for path in args.model_path:
+        model = tf.keras.models.load_model(path, custom_objects=custom_objects)
+        records = benchmark(
+            model,
+            modes=args.modes.split(","),
+            batch_sizes=parse_list(args.batch_sizes, int),
+            num_threads=parse_list(args.num_threads, int),
+            num_rounds=args.num_rounds,
+            num_warmup=args.num_warmup,
+            name=os.path.basename(path))
+        for r in records:
+            r["tf_threads"] = args.tf_threads
+        results.extend(records)
+        tf.keras.backend.clear_session()
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    compare(results)
+
+if __name__ == "__main__":
+    run()
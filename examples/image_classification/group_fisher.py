@@ -6,20 +6,21 @@ from collections import OrderedDict
 import math
 import copy
 import random
+import heapq
 
 import tensorflow as tf
 from tensorflow import keras
 import numpy as np
-from numba import njit
 from numpy import dot
 from numpy.linalg import norm as npnorm
 
 import horovod.tensorflow as hvd
 
 from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser, NNParser
-from nncompress.backend.tensorflow_ import SimplePruningGate, DifferentiableGate
+from nncompress.backend.tensorflow_ import SimplePruningGate, DifferentiableGate, GateStatistics
 from nncompress.backend.tensorflow_.transformation import parse, inject, cut, unfold
 from nncompress.backend.tensorflow_.transformation.pruning_parser import StopGradientLayer
+from nncompress.backend.tensorflow_.transformation.handler import aligned_count, align_gate
 
 from train import train_step
 
@@ -62,49 +63,6 @@ def compute_sparsity(groups, l2g, gmodel):
             alive += np.sum(g.gates.numpy())
     return 1.0 - alive / sum_
 
-@njit
-def find_min(cscore, gates, min_val, min_idx, gidx, ncol):
-    for i in range(ncol):
-        if (min_idx[0] == -1 or min_val > cscore[i]) and gates[i] == 1.0:
-            min_val = cscore[i]
-            min_idx = (gidx, i)
-    assert min_idx[0] != -1
-    return min_val, min_idx
-
-def compute_act(layer, batch_size, pruning_input_gate=False, out_gate=None):
-
-    if pruning_input_gate:
-        if layer.__class__.__name__ == "Conv2D":
-            w = layer.get_weights()[0].shape
-            if out_gate is None:
-                return batch_size * np.prod(list(w[0:2])+[w[3]])
-            else:
-                return batch_size * np.prod(list(w[0:2])+[np.sum(out_gate)])
-        elif layer.__class__.__name__ == "SeparableConv2D":
-            w1 = layer.get_weights()[0].shape
-            w2 = layer.get_weights()[1].shape
-            print(w1, w2)
-            xxxxxxxxxxxx # later check.
-            return batch_size * np.prod(list(w2[0:2])+[w2[3]])
-        elif layer.__class__.__name__ == "Dense":
-            w = layer.get_weights()[0].shape
-            return batch_size * w[1]
-        elif layer.__class__.__name__ == "MultiHeadAttention":
-            w = layer.get_weights()[0].shape
-            return batch_size * w[0] * 3
-        else:
-            return 0.0
-    else: 
-        if layer.__class__.__name__ == "Conv2D" or\
-            (layer.__class__.__name__ == "DepthwiseConv2D" and not pruning_input_gate):
-            # DepthwiseConv2D only contributes for the gate associated with its outputs.
-            assert layer.groups == 1
-            return batch_size * np.prod(layer.get_weights()[0].shape[0:3])
-        elif layer.__class__.__name__ == "SeparableConv2D":
-            return batch_size * np.prod(layer.get_weights()[0].shape[0:3]) + batch_size * np.prod(layer.get_weights()[1].shape[0:3])
-        else:
-            return 0.0
-
 def flatten(group):
     ret = []
     if type(group) == str:
@@ -408,98 +366,510 @@ def compute_positions(model, ordered_groups, torder, parser, position_mode, num_
     return positions
 
 
-def compute_norm(parser, gate_mapping, gmodel, batch_size, targets, groups, inv_groups, l2g):
-    norm = {
-        t.name: 0.0
-        for t in targets
-    }
-    parents = {}
-    g2l = {}
-
-    contributors = {}
-
-    for l in l2g:
-        if gmodel.get_layer(l).__class__.__name__ in ["Conv2D", "Dense", "MultiHeadAttention", "PatchingAndEmbedding"]:
-            g2l[l2g[l]] = l
+def compute_act(layer, batch_size, pruning_input_gate=False, out_gate=None):
+    nalive = None if out_gate is None else np.sum(out_gate)
+    return macs_cost(batch_size)(
+        layer.name, layer.__class__.__name__, [tuple(w.shape) for w in layer.weights], pruning_input_gate, nalive)
+
+def macs_cost(batch_size):
+    """Per-channel MACs of a layer for `batch_size` samples.
+
+    A cost function is a function (name, class_name, shapes, pruning_input_gate, nalive) -> cost, where
+    `shapes` are the shapes of the weights of the layer and `nalive` is the number of alive output channels.
+    It returns the cost of an output channel, or an input channel if `pruning_input_gate` is True.
+
+    """
+    def cost(name, class_name, shapes, pruning_input_gate=False, nalive=None):
+        if pruning_input_gate:
+            if class_name == "Conv2D":
+                w = shapes[0]
+                if nalive is None:
+                    return batch_size * np.prod(list(w[0:2])+[w[3]])
+                else:
+                    return batch_size * np.prod(list(w[0:2])+[nalive])
+            elif class_name == "SeparableConv2D":
+                raise NotImplementedError("SeparableConv2D is not supported for input gates.")
+            elif class_name == "Dense":
+                return batch_size * shapes[0][1]
+            elif class_name == "MultiHeadAttention":
+                return batch_size * shapes[0][0] * 3
+            else:
+                return 0.0
+        else:
+            if class_name == "Conv2D" or class_name == "DepthwiseConv2D":
+                return batch_size * np.prod(shapes[0][0:3])
+            elif class_name == "SeparableConv2D":
+                return batch_size * np.prod(shapes[0][0:3]) + batch_size * np.prod(shapes[1][0:3])
+            else:
+                return 0.0
+    return cost
+
+def params_cost():
+    """Per-channel parameters of a layer."""
+    return macs_cost(1)
+
+def latency_cost(table, delta=1, scale=1e6):
+    """Per-channel latency of a layer from a measured latency table.
+
+    # Arguments.
+        table: a function (name, cin, cout) -> latency in ms such as a built `LatencyTable`,
+            or a dictionary from (name, cin, cout) to latency.
+            The per-channel cost is the latency difference made by removing channels.
+        delta: int, the difference is taken over `delta` channels and divided by `delta`,
+            which smooths measurement noise.
+        scale: float, latencies are scaled to the range of MACs (ms to ns by default), as norms are divided by 1e6.
+
+    """
+    lookup = table if callable(table) else lambda name, cin, cout: table[(name, cin, cout)]
+    def cost(name, class_name, shapes, pruning_input_gate=False, nalive=None):
+        if class_name in ["Conv2D", "Dense"]:
+            cin, cout = shapes[0][-2], shapes[0][-1]
+        elif class_name == "DepthwiseConv2D" and not pruning_input_gate:
+            # Input and output channels are removed together.
+            cin, mult = shapes[0][2], shapes[0][3]
+            if nalive is not None:
+                cin = int(nalive)
+            d = max(min(delta, cin-1), 1)
+            return scale * (lookup(name, cin, cin * mult) - lookup(name, cin-d, (cin-d) * mult)) / d
+        else:
+            return 0.0
+        if nalive is not None:
+            cout = int(nalive)
+        if pruning_input_gate:
+            d = max(min(delta, cin-1), 1)
+            return scale * (lookup(name, cin, cout) - lookup(name, cin-d, cout)) / d
+        else:
+            d = max(min(delta, cout-1), 1)
+            return scale * (lookup(name, cin, cout) - lookup(name, cin, cout-d)) / d
+    return cost
+
+COST_LAYERS = ["Conv2D", "Dense", "MultiHeadAttention", "PatchingAndEmbedding"]
+
+class GroupCostModel(object):
+    """GroupCostModel computes the normalization factors of gate groups, which are their per-channel costs.
+
+    It is built once from the parsed graph, caching the weight shapes of layers.
+    When the gates of a group change, its output-side costs and the input-side costs of its parents
+    are recomputed from the alive channels, so that costs non-linear in channels (e.g., latency) are followed.
+    For analytic costs, `remove` also lowers the norm of the pruned group by the kernel costs of its contributors
+    per removed channel until the next `__call__`, as the original group fisher does.
+
+    # Arguments.
+        cost: "macs", "params", or a cost function such as `latency_cost(table)`.
+
+    """
+
+    def __init__(self, parser, gate_mapping, gmodel, batch_size, targets, groups, inv_groups, l2g, cost="macs"):
+        if cost == "macs":
+            self.cost_func = macs_cost(batch_size)
+            self._removal_batch = batch_size
+        elif cost == "params":
+            self.cost_func = params_cost()
+            self._removal_batch = 1
+        elif callable(cost):
+            self.cost_func = cost
+            self._removal_batch = None
+        else:
+            raise NotImplementedError("`cost` can be 'macs', 'params' or a function, but %s is given." % cost)
 
-    affecting = parser.get_affecting_layers()
-    for child, parents_ in affecting.items():
-        if gmodel.get_layer(child[0]).__class__.__name__ not in ["Conv2D", "Dense", "MultiHeadAttention", "PacthingAndEmbedding"]:
-            continue
-        if child[0] not in l2g: # the last layer
-            continue
+        self.gmodel = gmodel
+        self.groups = groups
+        self._info = {}
+
+        self.parents = {}
+        self.g2l = {}
+        self.contributors = {}
+        for l in l2g:
+            if self.class_name(l) in COST_LAYERS:
+                self.g2l[l2g[l]] = l
+
+        affecting = parser.get_affecting_layers()
+        for child, parents_ in affecting.items():
+            if self.class_name(child[0]) not in COST_LAYERS:
+                continue
+            if child[0] not in l2g: # the last layer
+                continue
 
-        child_gate = l2g[child[0]]
-        if child_gate not in parents:
-            parents[child_gate] = []
-        for p in parents_:
-            if type(p[0]) == frozenset:
-                for pname in extract_parents(p):
-                    if gmodel.get_layer(pname).__class__.__name__ not in ["Conv2D", "Dense", "MultiHeadAttention", "PatchingAndEmbedding"]:
+            child_gate = l2g[child[0]]
+            if child_gate not in self.parents:
+                self.parents[child_gate] = []
+            for p in parents_:
+                if type(p[0]) == frozenset:
+                    pnames = extract_parents(p)
+                else:
+                    pnames = [p[0]]
+                for pname in pnames:
+                    if self.class_name(pname) not in COST_LAYERS:
                         continue
-                    parent_gate = l2g[pname]
-                    parents[child_gate].append(parent_gate)
-            else:
-                pname = p[0]
-                if gmodel.get_layer(pname).__class__.__name__ not in ["Conv2D", "Dense", "MultiHeadAttention", "PatchingAndEmbedding"]:
+                    self.parents[child_gate].append(l2g[pname])
+
+        # The layers whose output-side costs are counted for each gate.
+        outputs = {}
+        for t in targets:
+            outputs[t.name] = [self.g2l[t.name]] if t.name in self.g2l else []
+            if t.name not in inv_groups:
+                continue
+            if inv_groups[t.name] not in self.contributors:
+                self.contributors[inv_groups[t.name]] = set()
+            if t.name in self.g2l:
+                self.contributors[inv_groups[t.name]].add(self.g2l[t.name])
+
+        for child, _ in affecting.items():
+            if self.class_name(child[0]) == "DepthwiseConv2D":
+                gate = gate_mapping[child][0]["config"]["name"]
+                outputs[gate].append(child[0])
+                self.contributors[inv_groups[gate]].add(child[0])
+
+        self._base = [0.0 for _ in range(len(groups))] # output-side costs
+        self._outputs = [[] for _ in range(len(groups))] # (layer, gate) whose output-side costs are counted.
+        self._inputs = [[] for _ in range(len(groups))] # (layer, gate) whose input-side costs are counted.
+        for gidx, group in enumerate(groups):
+            for l in group:
+                if type(group) == dict:
+                    if type(l) == str:
+                        self._outputs[gidx].extend([(layer, l2g[l]) for layer in outputs[l2g[l]]])
+                        self._inputs[gidx].append((l, l2g[l]))
+                else:
+                    self._outputs[gidx].extend([(layer, l.name) for layer in outputs[l.name]])
+                    self._inputs[gidx].append((self.g2l[l.name], l.name))
+
+        # parent groups for each child group
+        self._parent_groups = [[] for _ in range(len(groups))]
+        visit = set()
+        for c, p in self.parents.items():
+            for p_ in p:
+                gidx = inv_groups[p_]
+                cgidx = inv_groups[c]
+                if (gidx, cgidx) in visit or gidx == cgidx:
                     continue
-                parent_gate = l2g[pname]
-                parents[child_gate].append(parent_gate)
+                visit.add((gidx, cgidx))
+                self._parent_groups[cgidx].append(gidx)
+
+        self._alive = {}
+        self._input_cost = [0.0 for _ in range(len(groups))]
+        self._gnorm = [0.0 for _ in range(len(groups))] # input-side costs
+        self._removed = [0.0 for _ in range(len(groups))] # decreases by `remove` in the current period
+        for cgidx in range(len(groups)):
+            self.update(cgidx)
+
+    def info(self, name):
+        if name not in self._info:
+            layer = self.gmodel.get_layer(name)
+            self._info[name] = (layer.__class__.__name__, [tuple(w.shape) for w in layer.weights])
+        return self._info[name]
+
+    def class_name(self, name):
+        return self.info(name)[0]
+
+    def kernel_shape(self, name):
+        return self.info(name)[1][0]
+
+    def cost(self, name, pruning_input_gate=False, nalive=None):
+        class_name, shapes = self.info(name)
+        return self.cost_func(name, class_name, shapes, pruning_input_gate, nalive)
+
+    def parent_groups(self, cgidx):
+        return self._parent_groups[cgidx]
+
+    def _read_alive(self, gate):
+        self._alive[gate] = int(np.sum(self.gmodel.get_layer(gate).gates.numpy()))
+        return self._alive[gate]
+
+    def update(self, cgidx):
+        """Update the output-side costs of group `cgidx` and the input-side costs of its parents after its gates are changed."""
+        for _, gate in self._inputs[cgidx] + self._outputs[cgidx]:
+            self._read_alive(gate)
+        self._base[cgidx] = sum([
+            self.cost(layer, nalive=self._alive[gate]) for layer, gate in self._outputs[cgidx]
+        ])
+        if len(self._parent_groups[cgidx]) == 0:
+            return
+        new_cost = 0.0
+        for layer, gate in self._inputs[cgidx]:
+            new_cost += self.cost(layer, pruning_input_gate=True, nalive=self._alive[gate])
+        delta = new_cost - self._input_cost[cgidx]
+        self._input_cost[cgidx] = new_cost
+        for gidx in self._parent_groups[cgidx]:
+            self._gnorm[gidx] += delta
+
+    def remove(self, gidx):
+        """Update the costs after a channel of group `gidx` is removed."""
+        self.update(gidx)
+        if self._removal_batch is None:
+            return
+        for cbt in self.contributors.get(gidx, []):
+            if self.class_name(cbt) not in ["Conv2D", "DepthwiseConv2D", "Dense"]:
+                continue
+            self._removed[gidx] += float(max(self._removal_batch * np.prod(list(self.kernel_shape(cbt)[0:2])), 1.0))
+
+    def refresh(self):
+        """Update the groups whose gates have been changed since the last update."""
+        for cgidx in range(len(self.groups)):
+            for _, gate in self._inputs[cgidx] + self._outputs[cgidx]:
+                if int(np.sum(self.gmodel.get_layer(gate).gates.numpy())) != self._alive.get(gate):
+                    self.update(cgidx)
+                    break
 
-    for key in norm:
-        norm[key] = compute_act(gmodel.get_layer(g2l[key]), batch_size)
+    def norm(self):
+        return [
+            (float(max(base + gnorm, 1.0)) - removed) / 1e6 for base, gnorm, removed in zip(self._base, self._gnorm, self._removed)
+        ]
 
-        if key not in inv_groups:
-            continue
+    def __call__(self):
+        self._removed = [0.0 for _ in range(len(self.groups))]
+        self.refresh()
+        return self.norm(), self.parents, self.g2l, self.contributors
+
+def compute_norm(parser, gate_mapping, gmodel, batch_size, targets, groups, inv_groups, l2g, cost="macs"):
+    return GroupCostModel(parser, gate_mapping, gmodel, batch_size, targets, groups, inv_groups, l2g, cost=cost)()
+
+class GroupFisherScorer(object):
+    """GroupFisherScorer keeps running per-channel Fisher scores of all gate groups in a single tensor,
+    and selects the channels to remove with heaps keyed by normalized scores.
+
+    The channels of all groups are laid out in a flat vector, where group `gidx` occupies
+    `[offsets[gidx], offsets[gidx] + widths[gidx])`. Gradients of the gates sharing a channel are
+    summed before being squared, and the squared sums of concatenated inputs are summed after, as in group fisher.
+
+    If `on_device` is True, gates accumulate their statistics on device (`GateStatistics`),
+    so that no gradient goes to the host during training.
+
+    """
+
+    def __init__(self, groups, l2g=None, gmodel=None, on_device=False):
+        self.groups = groups
+        self.gates = []
+        self.offsets = []
+        self.widths = []
+        self.on_device = on_device
+        self._units = [] # GateStatistics of gate sharing units, in the order of segments
+        gate_stats = {}
+
+        gate_pos = {}
+        ncols = 0
+        cols = [] # columns of the concatenated gate gradients
+        seg1 = [] # the channel of a gate sharing unit for each column
+        seg2 = [] # the flat channel for each gate sharing unit
+        nseg = 0
+        total = 0
+        def gate_offset(gate):
+            nonlocal ncols
+            if gate.name not in gate_pos:
+                gate_pos[gate.name] = ncols
+                ncols += gate.ngates
+                self.gates.append(gate)
+            return gate_pos[gate.name]
+
+        for group in groups:
+            self.offsets.append(total)
+            if type(group) == dict:
+                width = 0
+                for key, val in group.items():
+                    if type(key) == str:
+                        gate = gmodel.get_layer(l2g[key])
+                        goff = gate_offset(gate)
+                        if on_device and gate.name not in gate_stats:
+                            gate_stats[gate.name] = gate.track()
+                        for v in val:
+                            size = v[1] - v[0]
+                            width = max(width, v[1])
+                            cols.extend(range(goff, goff + size))
+                            seg1.extend(range(nseg, nseg + size))
+                            seg2.extend(range(total + v[0], total + v[1]))
+                            nseg += size
+                            if on_device:
+                                self._units.append(gate_stats[gate.name])
+            else:
+                width = group[0].ngates
+                for gate in group:
+                    goff = gate_offset(gate)
+                    cols.extend(range(goff, goff + width))
+                    seg1.extend(range(nseg, nseg + width))
+                seg2.extend(range(total, total + width))
+                nseg += width
+                if on_device:
+                    stats = GateStatistics(width, len(group))
+                    for gate in group:
+                        gate.track(stats)
+                    self._units.append(stats)
+            self.widths.append(width)
+            total += width
+
+        self.total = total
+        self._cols = tf.constant(cols, dtype=tf.int32)
+        self._seg1 = tf.constant(seg1, dtype=tf.int32)
+        self._seg2 = tf.constant(seg2, dtype=tf.int32)
+        self._nseg = nseg
+        self.fisher = tf.Variable(tf.zeros((total,)), trainable=False)
+
+        self.norm = None
+        self.alive = None
+        self.nalive = None
+        self._scores = None
+        self._heaps = None
+        self._top = None
+        self._version = None
+
+    def accumulate(self):
+        """Fold the gradients held by gates into the accumulator, and clear them.
+        It should be called once per step, which closes the step of on-device statistics."""
+        if self.on_device:
+            for stats in set(self._units):
+                stats.flush()
+            return
+        if len(self.gates) == 0 or len(self.gates[0].grad_holder) == 0:
+            return
+        grads = tf.concat([
+            tf.concat(gate.grad_holder, axis=0) for gate in self.gates
+        ], axis=1) # (samples, gate channels)
+        grads = tf.gather(tf.cast(grads, tf.float32), self._cols, axis=1)
+        shared = tf.math.unsorted_segment_sum(tf.transpose(grads), self._seg1, self._nseg)
+        fisher = tf.reduce_sum(tf.square(shared), axis=1)
+        self.fisher.assign_add(tf.math.unsorted_segment_sum(fisher, self._seg2, self.total))
+        for gate in self.gates:
+            gate.grad_holder = []
+
+    def sync(self):
+        """Gather the on-device statistics of gates into the accumulator."""
+        if self.on_device and len(self._units) > 0:
+            fisher = tf.concat([stats.read() for stats in self._units], axis=0)
+            self.fisher.assign(tf.math.unsorted_segment_sum(fisher, self._seg2, self.total))
+
+    def reset(self):
+        self.fisher.assign(tf.zeros((self.total,)))
+        for stats in set(self._units):
+            stats.reset()
+
+    def scores(self, gidx):
+        return self.fisher[self.offsets[gidx]:self.offsets[gidx]+self.widths[gidx]].numpy() / self.norm[gidx]
+
+    def gate_scores(self, l2g=None):
+        """Return the scores of the current period as a dict from gate names to per-channel scores.
+        It returns None if no period is prepared yet."""
+        if self._scores is None:
+            return None
+        ret = {}
+        for gidx, group in enumerate(self.groups):
+            offset = self.offsets[gidx]
+            if type(group) == dict:
+                for key, val in group.items():
+                    if type(key) == str:
+                        for v in val:
+                            scores = self._scores[offset+v[0]:offset+v[1]]
+                            ret[l2g[key]] = ret[l2g[key]] + scores if l2g[key] in ret else scores.copy()
+            else:
+                for gate in group:
+                    ret[gate.name] = self._scores[offset:offset+self.widths[gidx]].copy()
+        return ret
 
-        if inv_groups[key] not in contributors:
-            contributors[inv_groups[key]] = set()
-        contributors[inv_groups[key]].add(g2l[key])
+    def read_gates(self, gmodel=None, l2g=None):
+        alive = np.zeros((self.total,), dtype=bool)
+        for gidx, group in enumerate(self.groups):
+            offset = self.offsets[gidx]
+            if type(group) == dict:
+                mask = np.zeros((self.widths[gidx],))
+                for key, val in group.items():
+                    if type(key) == str:
+                        gates = gmodel.get_layer(l2g[key]).gates.numpy()
+                        for v in val:
+                            mask[v[0]:v[1]] += gates
+                alive[offset:offset+self.widths[gidx]] = mask >= 1.0
+            else:
+                alive[offset:offset+self.widths[gidx]] = group[0].gates.numpy() == 1.0
+        return alive
+
+    def prepare(self, norm, alive, fully_random=False):
+        """Build the heaps of the current period from the accumulated scores.
+
+        # Arguments.
+            norm: a list of the normalization factors of groups.
+            alive: a boolean vector over the flat channels.
+            fully_random: bool, whether random scores are used instead of Fisher scores.
+
+        """
+        self.norm = [float(n) for n in norm]
+        self.alive = alive
+        self.sync()
+        if fully_random:
+            self._scores = np.random.rand(self.total)
+        else:
+            self._scores = self.fisher.numpy()
+        self.nalive = []
+        self._heaps = []
+        for gidx in range(len(self.groups)):
+            offset = self.offsets[gidx]
+            heap = [
+                (self._scores[offset+i], i) for i in range(self.widths[gidx]) if alive[offset+i]
+            ]
+            heapq.heapify(heap)
+            self._heaps.append(heap)
+            self.nalive.append(len(heap))
+        self._top = []
+        self._version = [0 for _ in self.groups]
+        for gidx in range(len(self.groups)):
+            self._push_top(gidx)
+
+    def _push_top(self, gidx):
+        heap = self._heaps[gidx]
+        while len(heap) > 0 and not self.alive[self.offsets[gidx] + heap[0][1]]:
+            heapq.heappop(heap)
+        if len(heap) > 0 and self.nalive[gidx] >= 2: # Keep at least one channel per group.
+            heapq.heappush(self._top, (heap[0][0] / self.norm[gidx], gidx, heap[0][1], self._version[gidx]))
+
+    def pop(self):
+        """Remove the alive channel having the minimum normalized score.
+
+        # Returns.
+            a tuple (gidx, channel), or None if no channel can be removed.
+
+        """
+        while len(self._top) > 0:
+            _, gidx, channel, version = heapq.heappop(self._top)
+            if version != self._version[gidx]:
+                continue
+            self.alive[self.offsets[gidx] + channel] = False
+            self.nalive[gidx] -= 1
+            self._version[gidx] += 1
+            self._push_top(gidx)
+            return gidx, channel
+        return None
 
-    for child, _ in affecting.items():
-        if gmodel.get_layer(child[0]).__class__.__name__ == "DepthwiseConv2D":
-            gate = gate_mapping[child][0]["config"]["name"]
-            norm[gate] += compute_act(gmodel.get_layer(child[0]), batch_size)
-            contributors[inv_groups[gate]].add(child[0])
+    def restore(self, gidx, channel):
+        self.alive[self.offsets[gidx] + channel] = True
+        self.nalive[gidx] += 1
+        heapq.heappush(self._heaps[gidx], (self._scores[self.offsets[gidx] + channel], channel))
+        self._version[gidx] += 1
+        self._push_top(gidx)
 
-    gnorm = [0 for _ in range(len(groups))]
-    visit = set()
-    for c, p in parents.items():
-        if len(p) == 0: # first gate
-            continue
+    def set_norm(self, gidx, value):
+        self.norm[gidx] = value
+        self._version[gidx] += 1
+        self._push_top(gidx)
 
-        for p_ in p:
-            gidx = inv_groups[p_]
-            cgidx = inv_groups[c]
-            if (gidx, cgidx) in visit:
-                continue
-            visit.add((gidx, cgidx))
+    def aligned_nalive(self, multiple=None):
+        """Return the numbers of alive channels of groups rounded up to multiples of `multiple`."""
+        return [aligned_count(n, multiple, w) for n, w in zip(self.nalive, self.widths)]
 
-            if gidx == cgidx:
-                continue
+    def align(self, gidx, multiple):
+        """Re-admit the pruned channels of group `gidx` having the highest scores
+        until its alive channels are a multiple of `multiple`.
 
-            for l in groups[cgidx]:
-                if type(groups[cgidx]) == dict:
-                    if type(l) == str:
-                        gnorm[gidx] += compute_act(gmodel.get_layer(l), batch_size, pruning_input_gate=True, out_gate=out_gate)
-                else:
-                    out_gate = gmodel.get_layer(l.name).gates.numpy()
-                    gnorm[gidx] += compute_act(gmodel.get_layer(g2l[l.name]), batch_size, pruning_input_gate=True, out_gate=out_gate)
-
-    final_norm = [0 for _ in range(len(groups))]
-    for gidx in range(len(groups)):
-        for l in groups[gidx]:
-            if type(groups[cgidx]) == dict:
-                if type(l) == str:
-                    final_norm[gidx] += norm[l2g[l]]
-            else:
-                final_norm[gidx] += norm[l.name]
-        final_norm[gidx] += gnorm[gidx]
+        # Returns.
+            a list of re-admitted channels.
 
-    for gidx in range(len(final_norm)):
-        final_norm[gidx] = float(max(final_norm[gidx], 1.0)) / 1e6
+        """
+        offset = self.offsets[gidx]
+        num_readmit = aligned_count(self.nalive[gidx], multiple, self.widths[gidx]) - self.nalive[gidx]
+        if num_readmit <= 0:
+            return []
+        pruned = np.flatnonzero(~self.alive[offset:offset+self.widths[gidx]])
+        pruned = pruned[np.argsort(-self._scores[offset + pruned], kind="stable")][:num_readmit]
+        for channel in pruned:
+            self.restore(gidx, int(channel))
+        return [int(channel) for channel in pruned]
 
-    return final_norm, parents, g2l, contributors
+    def sparsity(self, multiple=None):
+        return 1.0 - float(np.sum(self.aligned_nalive(multiple))) / self.total
 
 
 class PruningCallback(keras.callbacks.Callback):
@@ -519,7 +889,12 @@ class PruningCallback(keras.callbacks.Callback):
                  compute_norm_func=None,
                  batch_size=32,
                  gmodel=None,
-                 logging_=False):
+                 logging_=False,
+                 budget=None,
+                 cost_func=None,
+                 on_device=True,
+                 cost_model=None,
+                 channel_multiple=None):
         super(PruningCallback, self).__init__()
         self.norm = norm
         self.targets = targets
@@ -540,6 +915,7 @@ class PruningCallback(keras.callbacks.Callback):
         self.fully_random = fully_random
         self.callback_after_deletion = callback_after_deletion
         self.compute_norm_func = compute_norm_func
+        self.cost_model = cost_model
         self.gmodel = gmodel
         self.batch_size = batch_size
         self.logging = logging_
@@ -550,6 +926,22 @@ class PruningCallback(keras.callbacks.Callback):
 
         self.subnets = []
 
+        # Pruning stops when the cost of the gated model gets under `budget`.
+        # `cost_func` maps the numbers of alive channels of groups to a cost (e.g., FLOPs or latency) in the unit of `budget`.
+        # Norms are not used instead, because they are scaled and clamped normalization factors.
+        if budget is not None and cost_func is None:
+            raise ValueError("`cost_func` is required when `budget` is given.")
+        self.budget = budget
+        self.cost_func = cost_func
+        self.on_device = on_device
+        self.scorer = None
+
+        # If it is given, the alive channels of each group are rounded up to a multiple of it when pruning ends.
+        # Sparsity and budgets are checked on the rounded channels during pruning.
+        self.channel_multiple = channel_multiple
+        if self.on_device: # Gates should be tracked before training.
+            self._get_scorer()
+
     def build_subnets(self, positions, custom_objects=None):
 
         self.subnets = []
@@ -657,84 +1049,84 @@ class PruningCallback(keras.callbacks.Callback):
         ]
 
 
+    def _set_channel(self, group, channel, value, to_update):
+        if type(group) != dict:
+            for layer in group:
+                gates_ = layer.gates.numpy()
+                gates_[channel] = value
+                layer.gates.assign(gates_)
+                if layer.gates.name not in to_update:
+                    to_update[layer.gates.name] = layer.gates
+        else:
+            for key, val in group.items():
+                if type(key) == str:
+                    val = sorted(val, key=lambda x:x[0])
+                    gate = self.gmodel.get_layer(self.l2g[key])
+                    for v in val:
+                        if v[0] <= channel and channel < v[1]:
+                            gates_ = gate.gates.numpy()
+                            gates_[channel - v[0]] = value
+                            gate.gates.assign(gates_)
+                            if gate.gates.name not in to_update:
+                                to_update[gate.gates.name] = gate.gates
+
+    def _get_groups(self):
+        if self.gate_groups is not None:
+            return self.gate_groups
+        else:
+            return [
+                [gate] for gate in self.targets
+            ]
+
+    def _get_scorer(self):
+        if self.scorer is None:
+            self.scorer = GroupFisherScorer(self._get_groups(), self.l2g, self.gmodel, on_device=self.on_device)
+        return self.scorer
+
+    def budget_met(self):
+        if self.budget is None:
+            return False
+        return self.cost_func(self.scorer.aligned_nalive(self.channel_multiple)) <= self.budget
+
+    def sparsity(self):
+        return self._get_scorer().sparsity(self.channel_multiple)
+
+    def gate_scores(self):
+        """Return the Fisher scores of the current period for each gate, which `align_channels` also uses."""
+        return self._get_scorer().gate_scores(self.l2g)
+
+    def align_channels(self, to_update):
+        """Re-admit the highest-scoring pruned channels, so that the alive channels of groups are multiples of `channel_multiple`."""
+        scorer = self._get_scorer()
+        groups = self._get_groups()
+        num_readmitted = 0
+        for gidx, group in enumerate(groups):
+            for channel in scorer.align(gidx, self.channel_multiple):
+                self._set_channel(group, channel, 1.0, to_update)
+                num_readmitted += 1
+        return num_readmitted
+
     def on_train_batch_end(self, batch, logs=None, pbar=None, model_=None):
         self._iter += 1
+        scorer = self._get_scorer()
+        if self.continue_pruning:
+            scorer.accumulate()
         if self._iter % (self.period // hvd.size()) == 0 and self.continue_pruning:
 
             if self.compute_norm_func is not None:
                 self.norm, parents, g2l, contributors = self.compute_norm_func()
 
-            if self.gate_groups is not None:
-                groups = self.gate_groups
-            else:
-                groups = [
-                    [gate] for gate in self.targets
-                ]
-
-            cscore_ = {}
-            for gidx, group in enumerate(groups):
+            groups = self._get_groups()
+            scorer.prepare(self.norm, scorer.read_gates(self.gmodel, self.l2g), fully_random=self.fully_random)
 
-                if type(group) == dict:
-                    for l in group:
-                        if type(l) == str:
-                            num_batches = len(self.gmodel.get_layer(self.l2g[l]).grad_holder)
-                            break
-
-                    items = []
-                    max_ = 0
-                    for key, val in group.items():
-                        if type(key) == str:
-                            val = sorted(val, key=lambda x:x[0])
-                            items.append((key, val))
-                            for v in val:
-                                if v[1] > max_:
-                                    max_ = v[1]
-                    sum_ = np.zeros((max_,))
-                    cscore = None
-                    for bidx in range(num_batches):
-                        for key, val in items:
-                            gate = self.gmodel.get_layer(self.l2g[key])
-                            grad = gate.grad_holder[bidx]
-                            if type(grad) == int and grad == 0:
-                                continue
-
-                            grad = pow(grad, 2)
-                            grad = tf.reduce_sum(grad, axis=0)
-                            for v in val:
-                                sum_[v[0]:v[1]] += grad
-
-                        cscore = 0.0
-                else:
-                    # compute grad based si
-                    num_batches = len(group[0].grad_holder)
-
-                    sum_ = 0
-                    cscore = None
-                    for bidx in range(num_batches):
-                        grad = 0
-                        for lidx, layer in enumerate(group):
-                            grad += layer.grad_holder[bidx]
-
-                        if type(grad) == int and grad == 0:
-                            continue
-
-                        grad = pow(grad, 2)
-                        sum_ += tf.reduce_sum(grad, axis=0)
-                        cscore = 0.0
-
-                # compute normalization
-                if cscore is not None: # To handle cscore is undefined.
-                    #cscore = sum_
-                    cscore = sum_ / self.norm[gidx]
-                cscore_[gidx] = cscore
-
-                if self.logs is not None and len(self.logs) == 0:
-                    self.logs.append((group, cscore))
-                    print([g.name for g in group])
-                    for ii in range(cscore.shape[0]):
-                        print(ii, float(cscore[ii]))
-                    import sys
-                    sys.exit(0)
+            if self.logs is not None and len(self.logs) == 0:
+                cscore = scorer.scores(0)
+                self.logs.append((groups[0], cscore))
+                print([g.name for g in groups[0]])
+                for ii in range(cscore.shape[0]):
+                    print(ii, float(cscore[ii]))
+                import sys
+                sys.exit(0)
 
             num_removed_channels = 0
             filtered = set()
@@ -743,60 +1135,13 @@ class PruningCallback(keras.callbacks.Callback):
 
             to_update = {}
             for __ in range(self.num_remove):
-                min_val = -1
-                min_idx = (-1, -1)
-                for gidx, group in enumerate(groups):
-
-                    cscore = cscore_[gidx]
-                    if type(group) == dict:
-                        items = []
-                        max_ = 0
-                        for key, val in group.items():
-                            if type(key) == str:
-                                val = sorted(val, key=lambda x:x[0])
-                                items.append((key, val))
-                                for v in val:
-                                    if v[1] > max_:
-                                        max_ = v[1]
-                        mask = np.zeros((max_,))
-                        for key, val in items:
-                            gate = self.gmodel.get_layer(self.l2g[key])
-                            for v in val:
-                                mask[v[0]:v[1]] += gate.gates.numpy()
-                        gates_ = (mask >= 1.0).astype(np.float32)
-
-                    else:
-                        gates_ = group[0].gates.numpy()
-
-                    if np.sum(gates_) < 2.0:
-                        continue
-                    if cscore is not None:
-                        if self.fully_random:
-                            cscore = np.random.rand(*tuple(cscore.shape))
-                        else:
-                            min_val, min_idx = find_min(cscore, gates_, min_val, min_idx, gidx, cscore.shape[0])
+                min_idx = scorer.pop()
+                if min_idx is None:
+                    break
 
                 filtered.add(min_idx)
                 min_group = groups[min_idx[0]]
-                if type(min_group) != dict:
-                    for min_layer in min_group:
-                        gates_ = min_layer.gates.numpy()
-                        gates_[min_idx[1]] = 0.0
-                        min_layer.gates.assign(gates_)
-                        if min_layer.gates.name not in to_update:
-                            to_update[min_layer.gates.name] = min_layer.gates
-                else:
-                    for key, val in min_group.items():
-                        if type(key) == str:
-                            val = sorted(val, key=lambda x:x[0])
-                            gate = self.gmodel.get_layer(self.l2g[key])
-                            for v in val:
-                                if v[0] <= min_idx[1] and min_idx[1] < v[1]:
-                                    gates_ = gate.gates.numpy()
-                                    gates_[min_idx[1] - v[0]] = 0.0
-                                    gate.gates.assign(gates_)
-                                    if gate.gates.name not in to_update:
-                                        to_update[gate.gates.name] = gate.gates
+                self._set_channel(min_group, min_idx[1], 0.0, to_update)
 
                 num_removed_channels += 1
                 self._num_removed += 1
@@ -860,28 +1205,8 @@ class PruningCallback(keras.callbacks.Callback):
 
                 if exit: # restore the last removed channel                    
                     for min_idx_ in filtered:
-                        min_group = groups[min_idx_[0]]
-
-                        if type(min_group) != dict:
-                            for min_layer in min_group:
-                                gates_ = min_layer.gates.numpy()
-                                gates_[min_idx_[1]] = 1.0
-                                min_layer.gates.assign(gates_)
-                                if min_layer.gates.name not in to_update:
-                                    to_update[min_layer.gates.name] = min_layer.gates
-                        else:
-                            for key, val in min_group.items():
-                                if type(key) == str:
-                                    val = sorted(val, key=lambda x:x[0])
-                                    gate = self.gmodel.get_layer(self.l2g[key])
-                                    for v in val:
-                                        if v[0] <= min_idx[1] and min_idx[1] < v[1]:
-                                            gates_ = gate.gates.numpy()
-                                            gates_[min_idx[1] - v[0]] = 1.0
-                                            gate.gates.assign(gates_)
-                                            if gate.gates.name not in to_update:
-                                                to_update[gate.gates.name] = gate.gates
-
+                        self._set_channel(groups[min_idx_[0]], min_idx_[1], 1.0, to_update)
+                        scorer.restore(*min_idx_)
                         self._num_removed -= 1
                         num_removed_channels -= 1
 
@@ -896,49 +1221,32 @@ class PruningCallback(keras.callbacks.Callback):
                     break
 
                 # score update
-                if self.compute_norm_func is not None:
-                    cscore_[min_idx[0]] *= self.norm[min_idx[0]]
-                    visit = set()
-                    base_norm_sum = 0
-                    delta1 = 0
-                    delta2 = 0
-                    #for min_layer in min_group:
-                    #    w = self.gmodel.get_layer(g2l[min_layer.name]).get_weights()[0].shape
-                    #    delta += float(max(self.batch_size * np.prod(list(w[0:2])), 1.0)) / 1e6
-                    for cbt in contributors[min_idx[0]]:
-                        if self.gmodel.get_layer(cbt).__class__.__name__ not in ["Conv2D", "DepthwiseConv2D", "Dense"]:
-                            continue
-                        w = self.gmodel.get_layer(cbt).get_weights()[0].shape
-                        if self.gmodel.get_layer(cbt).__class__.__name__ == "Conv2D":
-                            delta1 += float(max(self.batch_size * np.prod(list(w[0:2])), 1.0)) / 1e6
-                        else:
-                            delta2 += float(max(self.batch_size * np.prod(list(w[0:2])), 1.0)) / 1e6
-                    self.norm[min_idx[0]] -= (delta1+delta2)
-                    cscore_[min_idx[0]] /= self.norm[min_idx[0]]
-
-                    for min_layer in min_group:
-                        for p in parents[min_layer.name]:
-                            if cscore_[self.inv_groups[p]] is None:
-                                continue
-
-                            if (min_idx[0], self.inv_groups[p]) in visit or min_idx[0] == self.inv_groups[p]:
-                                continue
-                            visit.add((min_idx[0], self.inv_groups[p]))
-                            cscore_[self.inv_groups[p]] *= self.norm[self.inv_groups[p]]
-                            self.norm[self.inv_groups[p]] -= delta1
-                            cscore_[self.inv_groups[p]] /= self.norm[self.inv_groups[p]]
+                if self.compute_norm_func is not None and self.cost_model is not None:
+                    # The cost model recomputes the costs of the group and its parents from the alive channels,
+                    # in the unit of its cost function (MACs, params or measured latency).
+                    self.cost_model.remove(min_idx[0])
+                    norm_ = self.cost_model.norm()
+                    for gidx in [min_idx[0]] + self.cost_model.parent_groups(min_idx[0]):
+                        self.norm[gidx] = norm_[gidx]
+                        scorer.set_norm(gidx, self.norm[gidx])
 
                 if self.callback_after_deletion is not None:
                    self.callback_after_deletion(self._num_removed)
 
-                if compute_sparsity(groups, self.l2g, self.gmodel) >= self.target_ratio:
+                if self.sparsity() >= self.target_ratio or self.budget_met():
                     break
 
+            self.continue_pruning = self.sparsity() < self.target_ratio and not self.budget_met()
+            if not self.continue_pruning and self.channel_multiple is not None:
+                num_readmitted = self.align_channels(to_update)
+                self._num_removed -= num_readmitted
+                num_removed_channels -= num_readmitted
+
             if hvd.size() > 1:
                 to_update_  = [to_update[key] for key in to_update]
                 hvd.broadcast_variables(model_.variables, root_rank=0)
 
-            self.continue_pruning = compute_sparsity(groups, self.l2g, self.gmodel) < self.target_ratio
+            scorer.reset()
             for layer in self.targets:
                 layer.grad_holder = []
                 if not self.continue_pruning:
@@ -950,7 +1258,7 @@ class PruningCallback(keras.callbacks.Callback):
             ]
 
             if pbar is not None:
-                pbar.set_postfix({"Sparsity":compute_sparsity(groups, self.l2g, self.gmodel), "Num removed(last step)":num_removed_channels})
+                pbar.set_postfix({"Sparsity":self.sparsity(), "Num removed(last step)":num_removed_channels})
 
             # for fit
             if not self.continue_pruning and hasattr(self, "model") and hasattr(self.model, "stop_training"):
@@ -981,7 +1289,14 @@ def make_group_fisher(model,
                       save_steps=-1,
                       save_prefix=None,
                       save_dir=None,
-                      logging_=False):
+                      logging_=False,
+                      budget=None,
+                      cost_func=None,
+                      on_device=True,
+                      cost="macs",
+                      latency_table=None,
+                      latency_delta=8,
+                      channel_multiple=None):
 
     gmodel, model, l2g, ordered_groups, torder, parser, gate_mapping = add_gates(model, custom_objects, avoid)
     targets = find_all(gmodel, SimplePruningGate)
@@ -1026,23 +1341,39 @@ def make_group_fisher(model,
                 if type(key) == str:
                     inv_groups[l2g[key]] = idx
             
+    # Normalize scores by measured latencies instead of analytic costs.
+    # All the measurements are done here, so that the pruning loop only interpolates over the table.
+    if latency_table is not None:
+        cost = latency_cost(latency_table.build(gmodel), delta=latency_delta)
+
     # Compute normalization score
     if enable_norm:
-        norm, parents, g2l, contributors = compute_norm(parser, gate_mapping, gmodel, batch_size, targets, groups, inv_groups, l2g)
+        cost_model = GroupCostModel(parser, gate_mapping, gmodel, batch_size, targets, groups, inv_groups, l2g, cost=cost)
+        norm, parents, g2l, contributors = cost_model()
     else:
-        norm = {
-            t.name: 1.0
-            for t in targets
-        }
+        cost_model = None
+        norm = [1.0 for _ in groups]
 
     def callback_after_deletion_(num_removed):
         if num_removed % save_steps == 0 and hvd.rank() == 0:
             assert save_dir is not None
             assert save_prefix is not None
-            cmodel = parser.cut(gmodel)
-            tf.keras.models.save_model(cmodel, save_dir+"/"+save_prefix+"_"+str(num_removed)+".h5")
-            tf.keras.models.save_model(gmodel, save_dir+"/"+save_prefix+"_"+str(num_removed)+"_gated_model.h5")
-            del cmodel
+            # Align the gates by Fisher scores while saving, so that both models keep the same channels.
+            backup = {}
+            if channel_multiple is not None:
+                scores = pc.gate_scores() or {}
+                for t in targets:
+                    backup[t.name] = t.gates.numpy()
+                    t.gates.assign(align_gate(backup[t.name], channel_multiple, scores.get(t.name)).astype(backup[t.name].dtype))
+            try:
+                cmodel = parser.cut(gmodel)
+                tf.keras.models.save_model(cmodel, save_dir+"/"+save_prefix+"_"+str(num_removed)+".h5")
+                tf.keras.models.save_model(gmodel, save_dir+"/"+save_prefix+"_"+str(num_removed)+"_gated_model.h5")
+                del cmodel
+            finally:
+                for t in targets:
+                    if t.name in backup:
+                        t.gates.assign(backup[t.name])
 
     if save_steps == -1:
         cbk = None
@@ -1050,10 +1381,12 @@ def make_group_fisher(model,
         cbk = callback_after_deletion_
 
     if norm_update:
-        norm_func = lambda : compute_norm(parser, gate_mapping, gmodel, batch_size, targets, groups, inv_groups, l2g)
+        if cost_model is None:
+            cost_model = GroupCostModel(parser, gate_mapping, gmodel, batch_size, targets, groups, inv_groups, l2g, cost=cost)
+        norm_func = cost_model
     else:
         norm_func = None
-    return gmodel, model, parser, ordered_groups, torder, PruningCallback(
+    pc = PruningCallback(
         norm,
         targets,
         gate_groups=groups,
@@ -1068,7 +1401,13 @@ def make_group_fisher(model,
         callback_after_deletion=cbk,
         batch_size=batch_size,
         gmodel=gmodel,
-        logging_=logging_)
+        logging_=logging_,
+        budget=budget,
+        cost_func=cost_func,
+        on_device=on_device,
+        cost_model=cost_model,
+        channel_multiple=channel_multiple)
+    return gmodel, model, parser, ordered_groups, torder, pc
 
 
 def prune_step(X, model, teacher_logits, y, pc, print_by_pruning, pbar=None):
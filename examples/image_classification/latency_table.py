@@ -0,0 +1,196 @@
+import os
+import json
+
+import numpy as np
+import tensorflow as tf
+
+from profiling import make_runner, time_runner, summarize
+
+# Config fields identifying the kernel of a layer, in addition to its class, resolution and channels.
+KEY_FIELDS = ["kernel_size", "strides", "padding", "dilation_rate", "depth_multiplier", "groups", "use_bias"]
+
+SUPPORTED_LAYERS = ["Conv2D", "DepthwiseConv2D", "Dense"]
+
+class LatencyStore(object):
+    """LatencyStore is a persistent dictionary from configuration keys to latencies.
+
+    Latencies are appended to a JSON-lines file at `path` as soon as they are put,
+    so that an interrupted build keeps the measurements done before.
+
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._latencies = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError: # a partially written line
+                        continue
+                    self._latencies[item["key"]] = item["latency"]
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def get(self, key):
+        return self._latencies.get(key)
+
+    def put(self, key, latency):
+        latency = float(latency)
+        self._latencies[key] = latency
+        with open(self._path, "a") as f:
+            f.write(json.dumps({"key":key, "latency":latency}) + "\n")
+
+class LatencyTable(object):
+    """LatencyTable is a lookup table of measured layer latencies (p50, in milliseconds) on the local machine.
+
+    Each distinct configuration (type, kernel, stride, resolution, input/output channels) is micro-benchmarked
+    once as a single-layer model, and the result is persisted in a JSON-lines file at `path`, so that
+    later runs read it back instead of measuring again.
+
+    All the measurements are done in `build`, which benchmarks `num_points` channel counts per axis of each layer.
+    `lookup` never measures; it interpolates over the built grid, so it is cheap enough for a pruning loop.
+
+    # Arguments.
+        path: str, the file of the table.
+        mode: str, a mode of `profiling.make_runner` such as "tflite" or "onnx_cpu".
+        batch_size: int.
+        num_threads: int, the number of threads of TFLite and ONNX Runtime.
+        num_rounds: int, the number of timed calls per configuration.
+        num_points: int, the number of channel counts measured per axis of each layer.
+
+    """
+
+    def __init__(self, path, mode="tflite", batch_size=1, num_threads=None, num_rounds=50, num_warmup=10, num_points=8):
+        self._store = LatencyStore(path)
+        self.mode = mode
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.num_rounds = num_rounds
+        self.num_warmup = num_warmup
+        self.num_points = num_points
+        self._model = None
+        self._layers = {}
+        self._grids = {}
+
+    def __len__(self):
+        return len(self._store)
+
+    def bind(self, model):
+        """Bind `model`, whose layers are looked up by name in `__call__`."""
+        self._model = model
+        self._layers = {}
+        self._grids = {}
+        return self
+
+    def _layer_info(self, name):
+        if name not in self._layers:
+            layer = self._model.get_layer(name)
+            config = layer.get_config()
+            input_shape = layer.input_shape
+            if type(input_shape) == list:
+                input_shape = input_shape[0]
+            self._layers[name] = (layer.__class__, config, list(input_shape[1:-1]))
+        return self._layers[name]
+
+    def key(self, class_name, config, spatial, cin, cout):
+        return json.dumps([
+            self.mode, self.batch_size, self.num_threads,
+            class_name, {k:config[k] for k in KEY_FIELDS if k in config}, spatial, int(cin), int(cout)
+        ], sort_keys=True)
+
+    def measure(self, cls, config, spatial, cin, cout):
+        """Micro-benchmark a layer of `cls` with `cin` input channels and `cout` output channels."""
+        config = dict(config)
+        config.pop("name", None)
+        if cls.__name__ == "Conv2D":
+            config["filters"] = int(cout)
+        elif cls.__name__ == "Dense":
+            config["units"] = int(cout)
+        elif cls.__name__ == "DepthwiseConv2D":
+            pass # cout = cin * depth_multiplier
+        else:
+            raise NotImplementedError("`cls` can be one of %s, but %s is given." % (SUPPORTED_LAYERS, cls.__name__))
+
+        input_ = tf.keras.Input(shape=spatial + [int(cin)], batch_size=self.batch_size)
+        model = tf.keras.Model(input_, cls.from_config(config)(input_))
+        run = make_runner(model, self.mode, tuple([self.batch_size] + spatial + [int(cin)]), num_threads=self.num_threads)
+        times = time_runner(run, num_rounds=self.num_rounds, num_warmup=self.num_warmup)
+        del model
+        return summarize(times, self.batch_size)["p50_ms"]
+
+    def _measured(self, name, cin, cout):
+        cls, config, spatial = self._layer_info(name)
+        key = self.key(cls.__name__, config, spatial, cin, cout)
+        latency = self._store.get(key)
+        if latency is None:
+            latency = self.measure(cls, config, spatial, cin, cout)
+            self._store.put(key, latency)
+        return latency
+
+    def grid(self, nchannels):
+        """Return the channel counts measured for an axis of `nchannels` channels."""
+        points = np.round(np.linspace(1, nchannels, max(self.num_points, 2))).astype(int)
+        return sorted(set(points.tolist()) | {int(nchannels)})
+
+    def lookup(self, name, cin, cout):
+        """Return the latency of layer `name` of the bound model with `cin`/`cout` channels.
+
+        A measured configuration is returned as it is, and the others are interpolated over the grid of `build`.
+        For Conv2D and Dense, the latency is approximated as separable in `cin` and `cout`, i.e.,
+        L(cin, cout) = L(full, cout) * L(cin, full) / L(full, full).
+
+        """
+        cls, config, spatial = self._layer_info(name)
+        if cls.__name__ not in SUPPORTED_LAYERS or cin < 1 or cout < 1:
+            return 0.0
+        latency = self._store.get(self.key(cls.__name__, config, spatial, cin, cout))
+        if latency is not None:
+            return latency
+        if name not in self._grids:
+            raise ValueError("No latency is built for `%s`. Call `build` first." % name)
+        grid = self._grids[name]
+        if cls.__name__ == "DepthwiseConv2D":
+            return float(np.interp(cin, grid["cin"][0], grid["cin"][1]))
+        full = grid["full"]
+        if full <= 0.0:
+            return 0.0
+        return float(
+            np.interp(cout, grid["cout"][0], grid["cout"][1]) * np.interp(cin, grid["cin"][0], grid["cin"][1]) / full)
+
+    def __call__(self, name, cin, cout):
+        return self.lookup(name, cin, cout)
+
+    def build(self, model, names=None):
+        """Measure the layers of `model` on the channel grids queried by `lookup`, and bind `model`.
+
+        For Conv2D and Dense, the output channels are varied at full input channels and vice versa.
+        For DepthwiseConv2D, the input and output channels are varied together.
+
+        # Arguments.
+            model: a Keras model.
+            names: a list of layer names. If it is None, all supported layers are used.
+
+        """
+        self.bind(model)
+        if names is None:
+            names = [layer.name for layer in model.layers if layer.__class__.__name__ in SUPPORTED_LAYERS]
+        for name in names:
+            cls, config, spatial = self._layer_info(name)
+            layer = model.get_layer(name)
+            cin, cout = int(layer.weights[0].shape[-2]), int(layer.weights[0].shape[-1])
+            if cls.__name__ == "DepthwiseConv2D":
+                points = self.grid(cin) # cout is the depth multiplier.
+                self._grids[name] = {
+                    "cin":(points, [self._measured(name, c, c * cout) for c in points])
+                }
+            else:
+                cin_points, cout_points = self.grid(cin), self.grid(cout)
+                self._grids[name] = {
+                    "cin":(cin_points, [self._measured(name, c, cout) for c in cin_points]),
+                    "cout":(cout_points, [self._measured(name, cin, c) for c in cout_points]),
+                    "full":self._measured(name, cin, cout)
+                }
+        return self
@@ -0,0 +1,276 @@
+import os
+import json
+import copy
+import shutil
+import time
+from os import listdir
+from os.path import isfile, join
+from silence_tensorflow import silence_tensorflow
+silence_tensorflow()
+
+
+from timeit import default_timer as timer
+
+import tensorflow as tf
+import numpy as np
+tf.random.set_seed(2)
+import random
+random.seed(1234)
+import numpy as np
+np.random.seed(1234)
+import sys
+import argparse
+
+tf.config.experimental.set_synchronous_execution(True)
+tf.config.experimental.enable_op_determinism()
+
+physical_devices = tf.config.list_physical_devices('GPU')
+if len(physical_devices) > 0:
+    for i, p in enumerate(physical_devices):
+        tf.config.experimental.set_memory_growth(
+            physical_devices[i], True
+            )
+    tf.config.set_visible_devices(physical_devices[0], 'GPU')
+
+from keras_flops import get_flops
+import numpy as np
+from tensorflow.keras.optimizers import Adam
+
+from efficientnet.tfkeras import EfficientNetB0
+
+import tf2onnx
+import onnxruntime as rt
+
+from nncompress.backend.tensorflow_ import SimplePruningGate
+from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser, StopGradientLayer, has_intersection
+from prep import remove_augmentation, add_augmentation
+
+from train import load_dataset
+from droppath import DropPath
+custom_objects = {
+    "SimplePruningGate":SimplePruningGate,
+    "StopGradientLayer":StopGradientLayer,
+    "DropPath": DropPath
+}
+
+
+BATCH_SIZE_GPU = 1
+BATCH_SIZE_ONNX_GPU = 1
+BATCH_SIZE_CPU = 1
+
+def tf_convert_onnx(model):
+    input_shape = model.input.shape
+    spec = (tf.TensorSpec(input_shape, tf.float32, name=model.input.name),)
+    output_path = "/tmp/tmp_%d.onnx" % os.getpid()
+    model_proto, _ = tf2onnx.convert.from_keras(model, input_signature=spec, opset=13, output_path=output_path)
+    output_names = [n.name for n in model_proto.graph.output]
+    return output_path, output_names
+
+def tf_convert_tflite(model):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_ops = [
+    tf.lite.OpsSet.TFLITE_BUILTINS,  # Enable TensorFlow Lite ops.
+    tf.lite.OpsSet.SELECT_TF_OPS  # Enable TensorFlow ops.
+    ]
+    model_= converter.convert()
+    return model_
+
+def get_input_shape(model, mode="cpu", batch_size=-1):
+    if type(model.input) == list:
+        input_shape = list(model.input[0].shape)
+    else:
+        input_shape = list(model.input.shape)
+    if input_shape[1] is None:
+        input_shape = [None, 224, 224, 3]
+    if batch_size == -1:
+        if mode == "gpu":
+            input_shape[0] = BATCH_SIZE_GPU
+        elif mode == "onnx_gpu":
+            input_shape[0] = BATCH_SIZE_ONNX_GPU
+        else:
+            input_shape[0] = BATCH_SIZE_CPU
+    else:
+        input_shape[0] = batch_size
+    return tuple(input_shape)
+
+def make_runner(model, mode, input_shape, num_threads=None):
+    """Make a function running one inference of `model` on a random input of `input_shape`.
+
+    # Arguments.
+        model: a Keras model without augmentation layers.
+        mode: str, one of "cpu", "gpu", "keras", "tf_function", "tflite", "onnx_cpu" and "onnx_gpu".
+            "keras" and "tf_function" run on the default device.
+        input_shape: a tuple including the batch size.
+        num_threads: int, the number of threads of TFLite and ONNX Runtime. TF modes use the threads
+            configured when the process starts.
+
+    # Returns.
+        a function () -> None.
+
+    """
+    input_data = np.array(np.random.rand(*input_shape), dtype=np.float32)
+    if "onnx" in mode:
+        output_path, output_names = tf_convert_onnx(model)
+        if mode == "onnx_cpu":
+            providers = ['CPUExecutionProvider']
+            DEVICE_NAME = "cpu"
+            DEVICE_INDEX = 0
+        elif mode == "onnx_gpu":
+            providers = [('CUDAExecutionProvider', {"device_id":0})]
+            DEVICE_NAME = "cuda"
+            DEVICE_INDEX = 0
+        else:
+            raise NotImplementedError("check your mode: %s" % mode)
+        sess_options = rt.SessionOptions()
+        sess_options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        if num_threads is not None:
+            sess_options.intra_op_num_threads = num_threads
+            sess_options.inter_op_num_threads = 1
+        m = rt.InferenceSession(output_path, sess_options, providers=providers)
+
+        x_ortvalue = rt.OrtValue.ortvalue_from_numpy(input_data, DEVICE_NAME, DEVICE_INDEX)
+        io_binding = m.io_binding()
+        io_binding.bind_input(name=model.input.name, device_type=x_ortvalue.device_name(), device_id=DEVICE_INDEX, element_type=input_data.dtype, shape=x_ortvalue.shape(), buffer_ptr=x_ortvalue.data_ptr())
+        io_binding.bind_output(output_names[0])
+        return lambda : m.run_with_iobinding(io_binding)
+
+    elif mode in ["gpu", "cpu", "keras", "tf_function"]:
+        device = {"gpu":"/gpu:0", "cpu":"/cpu:0"}.get(mode, None)
+        if device is not None:
+            with tf.device(device):
+                input_tensor = tf.convert_to_tensor(input_data, dtype=tf.float32)
+        else:
+            input_tensor = tf.convert_to_tensor(input_data, dtype=tf.float32)
+
+        if mode == "tf_function":
+            func = tf.function(lambda x: model(x, training=False))
+        else:
+            func = lambda x: model(x, training=False)
+
+        def run():
+            if device is not None:
+                with tf.device(device):
+                    func(input_tensor)
+            else:
+                func(input_tensor)
+        return run
+
+    elif mode == "tflite":
+        tflite_model = tf_convert_tflite(model)
+        interpreter = tf.lite.Interpreter(model_content=tflite_model, num_threads=num_threads)
+        input_index = interpreter.get_input_details()[0]['index']
+        interpreter.resize_tensor_input(input_index, list(input_shape))
+        interpreter.allocate_tensors()
+        def run():
+            interpreter.set_tensor(input_index, input_data)
+            interpreter.invoke()
+        return run
+
+    else:
+        raise NotImplementedError("check your mode: %s" % mode)
+
+def time_runner(run, num_rounds=100, num_warmup=10):
+    """Return the wall-clock times (in seconds) of `num_rounds` calls after `num_warmup` calls."""
+    for i in range(num_warmup):
+        run()
+    times = []
+    for i in range(num_rounds):
+        start = timer()
+        run()
+        times.append(float(timer() - start))
+    return times
+
+def summarize(times, batch_size, reject_outliers=True):
+    """Summarize latencies (in seconds) into milliseconds statistics and throughput.
+
+    Outliers beyond 1.5 IQR from the quartiles are rejected before computing the statistics.
+
+    """
+    times = np.asarray(times) * 1000.0
+    kept = times
+    if reject_outliers and len(times) >= 4:
+        q1, q3 = np.percentile(times, [25, 75])
+        iqr = q3 - q1
+        kept = times[(times >= q1 - 1.5 * iqr) & (times <= q3 + 1.5 * iqr)]
+    mean = float(np.mean(kept))
+    return {
+        "mean_ms":mean,
+        "std_ms":float(np.std(kept)),
+        "min_ms":float(np.min(kept)),
+        "max_ms":float(np.max(times)),
+        "p50_ms":float(np.percentile(kept, 50)),
+        "p90_ms":float(np.percentile(kept, 90)),
+        "p99_ms":float(np.percentile(kept, 99)),
+        "throughput":batch_size * 1000.0 / mean, # samples per second
+        "num_rounds":int(len(times)),
+        "num_rejected":int(len(times) - len(kept))
+    }
+
+def measure(model, mode="cpu", batch_size=-1, num_rounds=100):
+    model = remove_augmentation(model, custom_objects)
+
+    input_shape = get_input_shape(model, mode, batch_size)
+    if mode == "cpu" and batch_size == -1:
+        assert input_shape[0] == BATCH_SIZE_CPU
+
+    tf.keras.backend.clear_session()
+    if mode == "trt":
+        from k2t import t2t_test
+        return t2t_test(model, input_shape[0], num_rounds=num_rounds) * 1000
+
+    run = make_runner(model, mode, input_shape)
+    times = time_runner(run, num_rounds=num_rounds)
+    return np.mean(times) * 1000
+
+def benchmark(model, modes=("keras", "tf_function", "tflite", "onnx_cpu"), batch_sizes=(1,), num_threads=(None,), num_rounds=100, num_warmup=10, name=None):
+    """Sweep `modes`, `batch_sizes` and `num_threads` with warm-up and outlier rejection.
+
+    # Returns.
+        a list of JSON-compatible records, each of which has the configuration and `summarize` statistics.
+
+    """
+    model = remove_augmentation(model, custom_objects)
+    results = []
+    for mode in modes:
+        for batch_size in batch_sizes:
+            input_shape = get_input_shape(model, mode, batch_size)
+            # TF modes use the threads configured at start-up, so that they are not swept.
+            threads_ = num_threads if mode in ["tflite", "onnx_cpu"] else [None]
+            for threads in threads_:
+                run = make_runner(model, mode, input_shape, num_threads=threads)
+                times = time_runner(run, num_rounds=num_rounds, num_warmup=num_warmup)
+                record = {
+                    "model":name if name is not None else model.name,
+                    "mode":mode,
+                    "batch_size":int(input_shape[0]),
+                    "num_threads":threads,
+                    "params":int(model.count_params())
+                }
+                record.update(summarize(times, input_shape[0]))
+                results.append(record)
+    return results
+
+def validate(model, model_handler, dataset, sampling_ratio=1.0):
+    custom_objects = {
+        "SimplePruningGate":SimplePruningGate,
+        "StopGradientLayer":StopGradientLayer
+    }
+    if dataset == "imagenet2012":
+        n_classes = 1000
+    elif dataset == "cifar100":
+        n_classes = 100
+
+    batch_size = model_handler.batch_size
+    model = add_augmentation(model, model_handler.width, train_batch_size=batch_size, do_mixup=False, do_cutmix=False, custom_objects=custom_objects)
+    (_, _, test_data_generator), (iters, iters_val) = load_dataset(
+        dataset,
+        model_handler,
+        training_augment=False,
+        sampling_ratio=sampling_ratio,
+        n_classes=n_classes)
+    model_handler.compile(model, run_eagerly=False)
+
+    return model.evaluate(test_data_generator, verbose=1)[1]
+
+
@@ -847,7 +847,7 @@ def rewire(datagen, model, parser, train_func, gmode=True, model_type="efnet", c
     flops = get_flops(cmodel, batch_size=1)
     print(f"FLOPS: {flops / 10 ** 9:.06} G")
 
-    from profile import measure
+    from profiling import measure
 
     x = measure(model, "onnx_cpu")
     y = measure(cmodel, "onnx_cpu")
@@ -855,7 +855,7 @@ def rewire(datagen, model, parser, train_func, gmode=True, model_type="efnet", c
     print(x, y)
     """
 
-    from profile import measure
+    from profiling import measure
 
     #x = measure(model, "onnx_cpu")
     #y = measure(cmodel, "onnx_cpu")
@@ -138,7 +138,8 @@ def get_gmodel(dataset, model, model_handler, gates_info=None):
         norm_update=False,
         fully_random=False,
         custom_objects=model_handler.get_custom_objects(),
-        save_steps=-1)
+        save_steps=-1,
+        on_device=False)
 
     for layer in gmodel.layers:
         if layer.__class__ == SimplePruningGate:
@@ -20,7 +20,7 @@ from silence_tensorflow import silence_tensorflow
 silence_tensorflow()
 
 from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser, NNParser, serialize
-from nncompress.backend.tensorflow_ import SimplePruningGate, DifferentiableGate
+from nncompress.backend.tensorflow_ import SimplePruningGate, DifferentiableGate, GateStatistics
 from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser, StopGradientLayer, has_intersection
 from nncompress import backend as M
 from group_fisher import make_group_fisher, add_gates, compute_positions, flatten
@@ -159,6 +159,39 @@ def find_min(cscore, gates, min_val, min_idx, lidx, ncol):
             min_idx = (lidx, i)
     return min_val, min_idx
 
+def is_copied(layer, model, g2l):
+    for l in g2l[layer.name]:
+        if "_copied_" in l and model.get_layer(l).__class__.__name__ in ["Conv2D", "Dense", "MultiHeadAttention"]:
+            return True
+    return False
+
+def track_gates(model, groups, l2g, g2l):
+    """Attach on-device statistics to gates.
+
+    # Returns.
+        a tuple (gate_stats, group_stats), where `gate_stats` maps gate names to their own statistics
+        and `group_stats` maps the indices of simple groups to the statistics shared by their gates.
+
+    """
+    for layer in model.layers:
+        if layer.__class__ == SimplePruningGate:
+            layer.untrack()
+
+    gate_stats = {}
+    for key, gate in l2g.items():
+        if gate not in gate_stats:
+            gate_stats[gate] = model.get_layer(gate).track()
+
+    group_stats = {}
+    for gidx, group in enumerate(groups):
+        if type(group) != dict:
+            # Copied layers do not contribute to group scores.
+            members = [layer for layer in group if not is_copied(layer, model, g2l)]
+            group_stats[gidx] = GateStatistics(group[0].ngates, max(len(members), 1))
+            for layer in members:
+                layer.track(group_stats[gidx])
+    return gate_stats, group_stats
+
 def prune_step(X, model, teacher_logits, y, num_iter, groups, l2g, norm, inv_groups, period, score_info, g2l, pbar=None):
 
     for layer in model.layers:
@@ -169,72 +202,38 @@ def prune_step(X, model, teacher_logits, y, num_iter, groups, l2g, norm, inv_gro
     tape, loss, position_output = train_step(X, model, teacher_logits, y, ret_last_tensor=True)
     _ = tape.gradient(loss, model.trainable_variables)
 
+    gate_stats, group_stats = score_info["stats"]
+    for stats in list(gate_stats.values()) + list(group_stats.values()): # close the step
+        stats.flush()
+
     if (num_iter+1) % period == 0:
         grads = {}
-        raw_grads = {}
+        raw_grads = {} # accumulated squared gradients of gates
         for key, gate in l2g.items():
-            raw_grads[key] = model.get_layer(gate).grad_holder 
-
-            sum_ = None
-            for grad in model.get_layer(gate).grad_holder:
-                grad = pow(grad, 2)
-                grad = tf.reduce_sum(grad, axis=0)
-                if sum_ is None:
-                    sum_ = grad
-                else:
-                    sum_ += grad
+            raw_grads[key] = gate_stats[gate].read()
             if key not in inv_groups:
-                grads[key] = sum_ / norm[inv_groups[l2g[key]]]
+                grads[key] = raw_grads[key] / norm[inv_groups[l2g[key]]]
             else:
-                grads[key] = sum_ / norm[inv_groups[key]]
+                grads[key] = raw_grads[key] / norm[inv_groups[key]]
 
         cscore_ = {}
         for gidx, group in enumerate(groups):
 
             if type(group) == dict:
-                for l in group:
-                    if type(l) == str:
-                        num_batches = len(model.get_layer(l2g[l]).grad_holder)
-                        break
-
-                items = []
                 max_ = 0
                 for key, val in group.items():
                     if type(key) == str:
-                        val = sorted(val, key=lambda x:x[0])
-                        items.append((key, val))
                         for v in val:
                             if v[1] > max_:
                                 max_ = v[1]
                 sum_ = np.zeros((max_,))
-                for bidx in range(num_batches):
-                    for key, val in items:
-                        gate = model.get_layer(l2g[key])
-                        grad = gate.grad_holder[bidx]
-                        if type(grad) == int and grad == 0:
-                            continue
-
-                        grad = pow(grad, 2)
-                        grad = tf.reduce_sum(grad, axis=0)
+                for key, val in group.items():
+                    if type(key) == str:
+                        grad = gate_stats[l2g[key]].read().numpy()
                         for v in val:
                             sum_[v[0]:v[1]] += grad
-
             else:
-                # compute grad based si
-                num_batches = len(group[0].grad_holder)
-                sum_ = 0
-                for bidx in range(num_batches):
-                    grad = 0
-                    for lidx, layer in enumerate(group):
-                        flag = False # copyflag
-                        for l in g2l[layer.name]:
-                            if "_copied_" in l and model.get_layer(l).__class__.__name__ in ["Conv2D", "Dense", "MultiHeadAttention"]:
-                                flag = True
-                                break
-                        if not flag:
-                            grad += layer.grad_holder[bidx]
-                    grad = pow(grad, 2)
-                    sum_ += tf.reduce_sum(grad, axis=0)
+                sum_ = group_stats[gidx].read()
 
             # compute normalization
             cscore = sum_ / norm[gidx]
@@ -242,9 +241,8 @@ def prune_step(X, model, teacher_logits, y, num_iter, groups, l2g, norm, inv_gro
 
         score_info["return"] = cscore_, grads, raw_grads
 
-        for layer in model.layers:
-            if layer.__class__ == SimplePruningGate:
-                layer.grad_holder = []
+        for stats in list(gate_stats.values()) + list(group_stats.values()):
+            stats.reset()
 
     for layer in model.layers:
         if layer.__class__ == SimplePruningGate:
@@ -264,7 +262,8 @@ def get_gmodel(dataset, model, model_handler, gates_info=None):
         norm_update=False,
         fully_random=False,
         custom_objects=model_handler.get_custom_objects(),
-        save_steps=-1)
+        save_steps=-1,
+        on_device=False)
 
     last_ = parser.get_last_transformers()
 
@@ -331,6 +330,8 @@ def prune(dataset, model, model_handler, target_ratio=0.5, continue_info=None, g
             g2l[value] = []
         g2l[value].append(key)
 
+    score_info["stats"] = track_gates(gmodel, groups, l2g, g2l)
+
     def callback_before_update(idx, global_step, X, model_, teacher_logits, y, pbar):
         teacher_logits = None
         return prune_step(X, model_, teacher_logits, y, global_step, groups, l2g, norm, inv_groups, period, score_info, g2l, pbar)
@@ -525,15 +525,22 @@ def prune(
         return val_score
 
 
-def make_distiller(model, teacher, positions, scale=0.1, model_builder=None):
+def make_distiller(model, teacher, positions, scale=0.1, model_builder=None, teacher_cache=None):
+    """Make a model having distillation losses from `teacher` at `positions`.
+
+    If `teacher_cache` (a TeacherCache) is given, the teacher is not embedded. Its outputs become inputs of
+    the returned model, which is trained with `teacher_cache.as_dataset()`.
+
+    """
 
     custom_object_scope = {
         "SimplePruningGate":SimplePruningGate, "StopGradientLayer":StopGradientLayer
     }
-    with keras.utils.custom_object_scope(custom_object_scope):
-        t_model = M.add_prefix(teacher, "t_", not_change_input=True)
+    if teacher_cache is None:
+        with keras.utils.custom_object_scope(custom_object_scope):
+            t_model = M.add_prefix(teacher, "t_", not_change_input=True)
 
-    if len(positions) > 0:
+    if len(positions) > 0 and teacher_cache is None:
         t_outputs = []
         for p in positions:
             if type(p) == list:
@@ -544,29 +551,44 @@ def make_distiller(model, teacher, positions, scale=0.1, model_builder=None):
             else:
                 t_outputs.append(t_model.get_layer("t_"+p).output)
 
+        tt = tf.keras.Model(t_model.input, [t_model.output]+t_outputs)
+    elif teacher_cache is None:
+        tt = t_model
+    else:
+        tt = None
+
+    if tt is not None:
+        tt.trainable = False
+        toutputs_ = tt(model.input)
+        if type(toutputs_) != list:
+            toutputs_ = [toutputs_]
+        inputs = model.input
+    else:
+        # cached teacher outputs are fed as inputs.
+        toutputs_ = []
+        t_inputs = []
+        for shape in teacher_cache.output_shapes():
+            if type(shape[0]) == list:
+                sub_t = [tf.keras.Input(shape=s) for s in shape]
+                toutputs_.append(sub_t)
+                t_inputs.extend(sub_t)
+            else:
+                toutputs_.append(tf.keras.Input(shape=shape))
+                t_inputs.append(toutputs_[-1])
+        inputs = [model.input] + t_inputs
+
+    if len(positions) > 0:
         g_outputs = []
         for p in positions:
             if type(p) == list:
-                sub_p = []
-                for l in p:
-                    sub_p.append(model.get_layer(l).output)
-                g_outputs.append(sub_p)
+                g_outputs.append([model.get_layer(l).output for l in p])
             else:
                 g_outputs.append(model.get_layer(p).output)
 
-        tt = tf.keras.Model(t_model.input, [t_model.output]+t_outputs)
-    else:
-        tt = t_model
-    tt.trainable = False
-
-    toutputs_ = tt(model.input)
-    if type(toutputs_) != list:
-        toutputs_ = [toutputs_]
-
     if model_builder is None:
-        new_model = tf.keras.Model(model.input, [model.output]+toutputs_)
+        new_model = tf.keras.Model(inputs, [model.output]+toutputs_)
     else:
-        new_model = model_builder(model.input, [model.output]+toutputs_)
+        new_model = model_builder(inputs, [model.output]+toutputs_)
 
     if len(positions) > 0:
         for s, t in zip(g_outputs, toutputs_[1:]):
@@ -584,8 +606,9 @@ def make_distiller(model, teacher, positions, scale=0.1, model_builder=None):
 
     new_model.add_loss(tf.reduce_mean(tf.keras.losses.kl_divergence(model.output, toutputs_[0])*scale))
 
-    for layer in tt.layers:
-        layer.trainable = False
+    if tt is not None:
+        for layer in tt.layers:
+            layer.trainable = False
 
     for layer in model.layers:
         layer.trainable = True
@@ -702,7 +725,7 @@ def run():
         print(f"FLOPS: {flops / 10 ** 9:.06} G")
         print(model.summary())
 
-        from profile import measure
+        from profiling import measure
 
         tf.keras.backend.set_floatx("float32")
         model = change_dtype(model, "float32", custom_objects=custom_object_scope, distill_set=None)
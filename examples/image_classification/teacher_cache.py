@@ -0,0 +1,226 @@
+import os
+import json
+
+import numpy as np
+import tensorflow as tf
+
+from nncompress.search.projection import FeatureBuffer
+
+def flatten_outputs(outputs):
+    """Flatten teacher outputs, where an item is a tensor or a list of tensors (a distillation position).
+
+    # Returns.
+        a tuple (flat, structure), where `structure[i]` is -1 for a tensor and the length for a list.
+
+    """
+    flat = []
+    structure = []
+    for o in outputs:
+        if type(o) == list:
+            flat.extend(o)
+            structure.append(len(o))
+        else:
+            flat.append(o)
+            structure.append(-1)
+    return flat, structure
+
+def batch_signature(X, nsamples=4096):
+    """Return a cheap signature of a batch, a sum over a strided subsample of its values."""
+    flat = np.asarray(X).reshape(-1)
+    step = max(flat.shape[0] // nsamples, 1)
+    return float(np.sum(flat[::step], dtype=np.float64))
+
+def unflatten_outputs(flat, structure):
+    ret = []
+    idx = 0
+    for s in structure:
+        if s == -1:
+            ret.append(flat[idx])
+            idx += 1
+        else:
+            ret.append(flat[idx:idx+s])
+            idx += s
+    return ret
+
+class TeacherCache(object):
+    """TeacherCache stores the outputs of a frozen teacher (its logits and the features at distillation
+    positions) for a pass over a fixed-augmentation dataset, so that they are not recomputed every step.
+
+    Outputs are stored row by row in memory-mapped `.npy` files in `dtype` (float16 by default, which halves
+    the footprint and the I/O), and they are read back batch by batch. If `with_inputs` is True,
+    the inputs and labels of the pass are stored together in their own dtypes, so that they are streamed
+    in the same order. Then, the batches can be sharded and shuffled with `batch_order`.
+    Otherwise, the signatures of the inputs are stored, so that streaming them from a generator
+    yielding batches in a different order (e.g., shuffled) is detected.
+
+    """
+
+    def __init__(self, path, meta):
+        self._path = path
+        self._meta = meta
+        self._arrays = [
+            np.load(os.path.join(path, f), mmap_mode="r") for f in meta["files"]
+        ]
+        self._offsets = np.concatenate([[0], np.cumsum(meta["batch_sizes"])]).astype(np.int64)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        return cls(path, meta)
+
+    @classmethod
+    def build(cls, teacher, data_generator, path, max_batches=None, dtype="float16", with_inputs=True):
+        """Run `teacher` over `data_generator` once and store its outputs at `path`.
+
+        # Arguments.
+            teacher: a Keras model, whose outputs are a tensor or a list of tensors and lists of tensors.
+            data_generator: an iterable of (X, y), whose augmentation should be fixed.
+            path: str, a directory.
+            max_batches: int, the maximum number of batches. If it is None, `len(data_generator)` is used.
+            dtype: str, the dtype of stored teacher outputs. Inputs and labels keep their dtypes.
+            with_inputs: bool, whether the inputs and labels are stored together.
+
+        # Returns.
+            a TeacherCache.
+
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if max_batches is None and hasattr(data_generator, "__len__"):
+            max_batches = len(data_generator)
+
+        buffers = None
+        structure = None
+        shapes = None
+        batch_sizes = []
+        signatures = []
+        for bidx, (X, y) in enumerate(data_generator):
+            if max_batches is not None and bidx >= max_batches:
+                break
+            outputs = teacher(X, training=False)
+            if type(outputs) != list:
+                outputs = [outputs]
+            flat, structure = flatten_outputs(outputs)
+            flat = [np.asarray(o) for o in flat]
+            if with_inputs:
+                flat += [np.asarray(X), np.asarray(y)]
+
+            if buffers is None:
+                shapes = [list(o.shape[1:]) for o in flat]
+                dtypes = [dtype for _ in flat]
+                if with_inputs:
+                    dtypes[-2] = flat[-2].dtype # inputs and labels keep their dtypes.
+                    dtypes[-1] = flat[-1].dtype
+                capacity = max_batches * flat[0].shape[0] if max_batches is not None else 1024
+                buffers = [
+                    FeatureBuffer(int(np.prod(shape)), dtype_, capacity=capacity, path=os.path.join(path, "output_%d.npy" % idx))
+                    for idx, (shape, dtype_) in enumerate(zip(shapes, dtypes))
+                ]
+            for buf, o in zip(buffers, flat):
+                buf.append(o.reshape(o.shape[0], -1))
+            batch_sizes.append(int(flat[0].shape[0]))
+            signatures.append(batch_signature(X))
+
+        for buf in buffers:
+            buf.flush()
+        meta = {
+            "structure":structure,
+            "shapes":shapes,
+            "files":[os.path.basename(buf.filename) for buf in buffers],
+            "batch_sizes":batch_sizes,
+            "signatures":signatures,
+            "with_inputs":with_inputs
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return cls(path, meta)
+
+    def __len__(self):
+        return len(self._meta["batch_sizes"])
+
+    @property
+    def with_inputs(self):
+        return self._meta["with_inputs"]
+
+    def _read(self, idx, bidx, dtype):
+        start, end = self._offsets[bidx], self._offsets[bidx+1]
+        data = self._arrays[idx][start:end].reshape([end-start] + self._meta["shapes"][idx])
+        return tf.convert_to_tensor(data, dtype=dtype)
+
+    def get(self, bidx, dtype=tf.float32):
+        """Return the teacher outputs of the `bidx`-th batch, in the structure of the teacher outputs."""
+        nouts = len(self._arrays) - (2 if self.with_inputs else 0)
+        flat = [self._read(idx, bidx, dtype) for idx in range(nouts)]
+        return unflatten_outputs(flat, self._meta["structure"])
+
+    def get_inputs(self, bidx, dtype=tf.float32):
+        """Return the (X, y) of the `bidx`-th batch stored with `with_inputs`."""
+        assert self.with_inputs
+        return self._read(len(self._arrays)-2, bidx, dtype), self._read(len(self._arrays)-1, bidx, dtype)
+
+    def batch_order(self, rank=0, size=1, seed=None):
+        """Return the batch indices of worker `rank` out of `size` workers.
+
+        If `seed` is given (e.g., the epoch), the batches are shuffled before being sharded.
+        All the workers must use the same seed, so that their shards are disjoint.
+        The remainder batches are dropped, so that all the workers run the same number of steps.
+
+        """
+        if len(self) < size:
+            raise ValueError("The cache has %d batches, which are fewer than %d workers." % (len(self), size))
+        if seed is None:
+            order = np.arange(len(self))
+        else:
+            order = np.random.RandomState(seed).permutation(len(self))
+        return order[:len(self) // size * size][rank::size]
+
+    def iterate(self, data_generator=None, dtype=tf.float32, order=None):
+        """Stream (X, y, teacher_outputs) batch by batch.
+
+        If the inputs are not stored, `data_generator` must yield the same batches as the one used in `build`
+        in the same order, e.g., it must not be reshuffled. Otherwise, ValueError is raised.
+        If the inputs are stored, `order` (e.g., from `batch_order`) gives the batches to stream.
+        If it is None, all the batches are streamed in order.
+
+        """
+        if data_generator is None:
+            if order is None:
+                order = range(len(self))
+            for bidx in order:
+                bidx = int(bidx)
+                X, y = self.get_inputs(bidx, dtype)
+                yield X, y, self.get(bidx, dtype)
+        else:
+            signatures = self._meta.get("signatures")
+            for bidx, (X, y) in enumerate(data_generator):
+                if bidx >= len(self):
+                    break
+                if signatures is not None and not np.isclose(batch_signature(X), signatures[bidx]):
+                    raise ValueError(
+                        "The %d-th batch does not match the cached one. `data_generator` must yield the batches of `build` in the same order." % bidx)
+                yield X, y, self.get(bidx, dtype)
+
+    def as_dataset(self, dtype=tf.float32):
+        """Return a tf.data.Dataset of ((X, *flat teacher outputs), y) for a distiller made with `teacher_cache`."""
+        assert self.with_inputs
+        def gen():
+            for X, y, outputs in self.iterate(dtype=dtype):
+                flat, _ = flatten_outputs(outputs)
+                yield tuple([X] + flat), y
+        shapes = [[None] + shape for shape in self._meta["shapes"]]
+        nouts = len(shapes) - 2
+        signature = (
+            tuple([tf.TensorSpec(shapes[nouts], dtype)] + [tf.TensorSpec(s, dtype) for s in shapes[:nouts]]),
+            tf.TensorSpec(shapes[nouts+1], dtype)
+        )
+        return tf.data.Dataset.from_generator(gen, output_signature=signature).prefetch(tf.data.AUTOTUNE)
+
+    def output_shapes(self):
+        """Return the per-sample shapes of teacher outputs, in the structure of the teacher outputs."""
+        nouts = len(self._arrays) - (2 if self.with_inputs else 0)
+        return unflatten_outputs(self._meta["shapes"][:nouts], self._meta["structure"])
@@ -325,7 +325,13 @@ def train_step(X, model, teacher_logits=None, y=None, ret_last_tensor=False):
         return tape, loss
 
 
-def iteration_based_train(dataset, model, model_handler, max_iters, lr_mode=0, teacher=None, with_label=True, with_distillation=True, callback_before_update=None, stopping_callback=None, augment=True, n_classes=100, eval_steps=-1, validate_func=None):
+def iteration_based_train(dataset, model, model_handler, max_iters, lr_mode=0, teacher=None, with_label=True, with_distillation=True, callback_before_update=None, stopping_callback=None, augment=True, n_classes=100, eval_steps=-1, validate_func=None, teacher_cache=None):
+    """Train `model` for `max_iters` iterations.
+
+    If `teacher_cache` (a TeacherCache) is given, teacher outputs are read from it instead of running `teacher`.
+    When it has stored inputs, the training data are streamed from it as well.
+
+    """
 
     from nncompress.backend.tensorflow_ import SimplePruningGate
     from nncompress.backend.tensorflow_.transformation.pruning_parser import StopGradientLayer
@@ -350,10 +356,19 @@ def iteration_based_train(dataset, model, model_handler, max_iters, lr_mode=0, t
             # start with new epoch.
             done = False
             idx = 0
-            for X, y in train_data_generator:
+            if teacher_cache is None:
+                data = ((X, y, None) for X, y in train_data_generator)
+            elif teacher_cache.with_inputs:
+                # Each worker streams its own shard of the cached batches, shuffled every epoch.
+                data = teacher_cache.iterate(order=teacher_cache.batch_order(hvd.rank(), hvd.size(), seed=epoch))
+            else:
+                data = teacher_cache.iterate(train_data_generator)
+            for X, y, cached_logits in data:
                 idx += 1
                 y = tf.convert_to_tensor(y, dtype=tf.float32)
-                if teacher is not None:
+                if cached_logits is not None:
+                    teacher_logits = cached_logits
+                elif teacher is not None:
                     teacher_logits = teacher(X)
                     if type(teacher_logits) != list:
                         teacher_logits = [teacher_logits]
@@ -406,9 +421,10 @@ def iteration_based_train(dataset, model, model_handler, max_iters, lr_mode=0, t
                         done = False
             if done:
                 break
-            else:
+            elif teacher_cache is None:
+                # With a teacher cache, its outputs are matched to batches by their order, so the generator is not reshuffled.
                 train_data_generator.on_epoch_end()
 
-            #epoch += 1
+            epoch += 1
             #if validate_func is not None:
             #    print("Epoch %d: %f" % (epoch, validate_func()))
@@ -22,44 +22,93 @@ def transition_prob(diff_score, temp, init_temp=INIT_TEMP):
         return math.exp(50000000 * diff_score / temp)
 
 class SimulatedAnnealingSolver(Solver):
+    """Simulated annealing over states.
 
-    def __init__(self, score_func, max_niters, temp_func=temperature, tprob_func=transition_prob):
+    If `batch_size` is larger than 1, it proposes `batch_size` neighbors at each iteration and scores them together.
+    The scores are computed by `executor` (concurrent.futures.Executor-like, having `map`) if it is given.
+    Note that a process pool requires a picklable score function and states.
+    The score function of NNCompress builds models and writes its score cache under a lock,
+    so that it can be used with a thread pool, in which only `handler.score` runs concurrently.
+    The Metropolis acceptance is then applied over the batch in descending order of scores,
+    and the first accepted neighbor becomes the next state.
+
+    """
+
+    def __init__(self, score_func, max_niters, temp_func=temperature, tprob_func=transition_prob, batch_size=1, executor=None):
         super(SimulatedAnnealingSolver, self).__init__(score_func)
         self.max_niters = max_niters
         self._temp_func = temperature
         self._best = None
         self._best_score = None
+        self._temp = -1
+        self.batch_size = batch_size
+        self._executor = executor
         print(time.ctime(time.time()))
 
-    def solve(self, initial_state, callbacks=None):
+    def _score_all(self, states):
+        if self._executor is None or len(states) == 1:
+            return [self._score_func(s) for s in states]
+        else:
+            return list(self._executor.map(self._score_func, states))
+
+    def _propose(self, state):
+        candidates = [state.get_next() for _ in range(self.batch_size)]
+        scores = self._score_all(candidates)
+        for c in candidates:
+            if hasattr(c, "report"):
+                c.report()
+
+        # Retry invalid neighbors (score 0.0) until the batch is filled.
+        ret = [(c, s) for c, s in zip(candidates, scores) if s != 0.0]
+        while len(ret) < self.batch_size:
+            candidates = [state.get_next() for _ in range(self.batch_size - len(ret))]
+            scores = self._score_all(candidates)
+            ret.extend([(c, s) for c, s in zip(candidates, scores) if s != 0.0])
+        return ret
+
+    @property
+    def best(self):
+        return self._best
+
+    @property
+    def best_score(self):
+        return self._best_score
+
+    @property
+    def temp(self):
+        return self._temp
+
+    def solve(self, initial_state, callbacks=None, start_iter=0, best=None, best_score=None, temp=-1):
+        """Run the search from `initial_state`.
+
+        `start_iter`, `best`, `best_score` and `temp` restore a search stopped after iteration `start_iter`-1.
+
+        """
         state = initial_state
-        self._best = state
-        T = -1
-        for i in range(self.max_niters):
+        self._best = state if best is None else best
+        self._best_score = best_score
+        T = temp
+        for i in range(start_iter, self.max_niters):
             T = self._temp_func(i, self.max_niters, T)
+            self._temp = T
             score = self._score_func(state)
-            new_state = state.get_next()
-            new_score = self._score_func(new_state)
-            if hasattr(new_state, "report"):
-                new_state.report()
-
-            while new_score == 0.0:
-                new_state = state.get_next()
-                new_score = self._score_func(new_state)
+            candidates = self._propose(state)
+            candidates.sort(key=lambda x: x[1], reverse=True)
 
             if self._best_score is None:
                 self._best_score = self._score_func(self._best)
 
-            if new_score > self._best_score:
-                self._best = new_state
-                self._best_score = new_score
+            if candidates[0][1] > self._best_score:
+                self._best, self._best_score = candidates[0]
 
-            prob = transition_prob(new_score - score, T)
-            print("[%s] %d iterations, Score:%.4f   New score:%.4f Best score:%.4f  prob:%.4f, output:%s" % (time.ctime(time.time()), i, score, new_score, self._best_score, prob, str(self._best)))
             transition = False
-            if prob >= random.random():
-                state = new_state
-                transition = True
+            for new_state, new_score in candidates:
+                prob = transition_prob(new_score - score, T)
+                print("[%s] %d iterations, Score:%.4f   New score:%.4f Best score:%.4f  prob:%.4f, output:%s" % (time.ctime(time.time()), i, score, new_score, self._best_score, prob, str(self._best)))
+                if prob >= random.random():
+                    state = new_state
+                    transition = True
+                    break
 
             if callbacks is not None:
                 for c in callbacks:
@@ -1,4 +1,4 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from nncompress.backend.tensorflow_.layers.gate import DifferentiableGate, SimplePruningGate
+from nncompress.backend.tensorflow_.layers.gate import DifferentiableGate, SimplePruningGate, GateStatistics
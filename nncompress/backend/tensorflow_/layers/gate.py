@@ -47,6 +47,46 @@ class DifferentiableGate(layers.Layer, DifferentiableGateFormula):
         })
         return config
 
+class GateStatistics(object):
+    """GateStatistics accumulates squared gradients of gates in a non-trainable variable on device.
+
+    It can be shared by `nmembers` gates sharing channels. Gradients added in a step are summed
+    over all the calls of all the members (a shared gate can be called several times, and a member can be skipped),
+    and `flush` squares the sum, as in group fisher. `flush` should be called once per step.
+    If `per_call` is True (the statistics of a single gate), the gradient of each call is squared when it is added.
+
+    """
+
+    def __init__(self, ngates, nmembers=1, per_call=False):
+        self.ngates = ngates
+        self.nmembers = nmembers
+        self.per_call = per_call
+        self.fisher = tf.Variable(tf.zeros((ngates,)), trainable=False)
+        self._pending = None
+
+    def add(self, grad):
+        grad = tf.cast(grad, tf.float32)
+        if self.per_call:
+            self.fisher.assign_add(tf.reduce_sum(tf.square(grad), axis=0))
+        elif self._pending is None:
+            self._pending = grad
+        else:
+            self._pending += grad
+
+    def flush(self):
+        """Fold the gradients of the current step into the accumulator."""
+        if self._pending is not None:
+            self.fisher.assign_add(tf.reduce_sum(tf.square(self._pending), axis=0))
+            self._pending = None
+
+    def read(self):
+        self.flush()
+        return self.fisher.read_value()
+
+    def reset(self):
+        self.fisher.assign(tf.zeros((self.ngates,)))
+        self._pending = None
+
 class SimplePruningGate(layers.Layer, SimplePruningGateFormula):
 
     def __init__(self,
@@ -56,6 +96,7 @@ class SimplePruningGate(layers.Layer, SimplePruningGateFormula):
         self.ngates = ngates
 
         self.grad_holder = []
+        self.statistics = [] # If it is not empty, gradients are accumulated on device instead of `grad_holder`.
         self.collecting = True
         self.data_collecting = False
 
@@ -64,13 +105,16 @@ class SimplePruningGate(layers.Layer, SimplePruningGateFormula):
             def custom_grad(dy, variables):
                 if self.collecting:
                     if len(x.shape) == 4:
-                        self.grad_holder.append(\
-                            tf.reduce_sum(dy * x, axis=[1, 2]).numpy())
+                        grad = tf.reduce_sum(dy * x, axis=[1, 2])
                     elif len(x.shape) == 3:
-                        self.grad_holder.append(\
-                            tf.reduce_sum(dy * x, axis=[1]).numpy())
+                        grad = tf.reduce_sum(dy * x, axis=[1])
                     else:
                         raise NotImplementedError()
+                    if len(self.statistics) > 0:
+                        for stats in self.statistics:
+                            stats.add(grad)
+                    else:
+                        self.grad_holder.append(grad.numpy())
                 return self.compute(dy), [ tf.zeros(self.ngates,) ]
             return self.compute(x), custom_grad
         self.grad_tracker = grad_tracker
@@ -82,6 +126,25 @@ class SimplePruningGate(layers.Layer, SimplePruningGateFormula):
             return x
         self.data_tracker = data_tracker
 
+    def track(self, statistics=None):
+        """Accumulate the squared gradients of this gate into `statistics` on device.
+
+        # Arguments.
+            statistics: GateStatistics, which can be shared by gates. If it is None, a new one of this gate is created,
+                which squares the gradient of each call.
+
+        # Returns.
+            the GateStatistics.
+
+        """
+        if statistics is None:
+            statistics = GateStatistics(self.ngates, per_call=True)
+        self.statistics.append(statistics)
+        return statistics
+
+    def untrack(self):
+        self.statistics = []
+
     def build(self, input_shape):
         self.gates = self.add_weight(name='gates',
                                      shape=(self.ngates,),
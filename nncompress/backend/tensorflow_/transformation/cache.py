@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+from collections import OrderedDict
+
+def _canonical(value):
+    # A deterministic repr of a layer config, in which dict keys are sorted.
+    if isinstance(value, dict):
+        return "{" + ",".join("%r:%s" % (k, _canonical(value[k])) for k in sorted(value, key=str)) + "}"
+    elif isinstance(value, (list, tuple)):
+        return "[" + ",".join(_canonical(v) for v in value) + "]"
+    else:
+        return repr(value)
+
+def fingerprint(model):
+    """Compute a structural fingerprint of a Keras model without serializing it.
+
+    The fingerprint covers layer names, classes, layer configs, weight shapes, output shapes and
+    the inbound connections of every node. Thus, two models having the same fingerprint
+    have the same model dictionary except weight values.
+
+    # Arguments.
+        model: a Keras model.
+
+    # Returns.
+        a str, the hex digest of the fingerprint.
+
+    """
+    h = hashlib.sha1()
+    h.update(model.__class__.__name__.encode())
+    for layer in model.layers:
+        config = dict(layer.get_config())
+        config.pop("name", None)
+        items = [layer.__class__.__name__, layer.name, _canonical(config), [tuple(w.shape) for w in layer.weights]]
+        for node in layer._inbound_nodes:
+            items.append([(l.name, node_idx, tensor_idx) for l, node_idx, tensor_idx, _ in node.iterate_inbound()])
+            items.append(node.output_shapes)
+        h.update(repr(items).encode())
+    return h.hexdigest()
+
+class ParserCache(object):
+    """ParserCache keeps parsed NNParser instances to avoid parsing the same model repeatedly.
+
+    An entry is keyed by the structural fingerprint of a model together with the parser class,
+    the names of custom objects and the keyword arguments of the parser.
+    When a cached parser is returned, it is rebound to the query model, so that its weights are
+    taken from the query model, not from the model that was parsed first.
+    A cached parser edited in place is parsed again on the next query. Use `fork` to edit it safely.
+    The least recently used entry is evicted when the number of entries exceeds `capacity`.
+
+    """
+
+    def __init__(self, capacity=8):
+        self._capacity = capacity
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @capacity.setter
+    def capacity(self, capacity):
+        self._capacity = capacity
+        self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _make_key(self, fp, parser_class, custom_objects, kwargs):
+        custom_keys = tuple(sorted(custom_objects.keys())) if custom_objects else ()
+        return (fp, parser_class, custom_keys, tuple(sorted(kwargs.items(), key=lambda x: x[0])))
+
+    def _evict(self):
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def get(self, model, parser_class, custom_objects=None, **kwargs):
+        """Return a parsed parser for `model`.
+
+        # Arguments.
+            model: a Keras model.
+            parser_class: NNParser or its subclass.
+            custom_objects: custom objects for loading a Keras model having custom layers/operators.
+            kwargs: additional keyword arguments for `parser_class`.
+
+        # Returns.
+            a parser on which `parse` was already executed.
+
+        """
+        key = self._make_key(fingerprint(model), parser_class, custom_objects, kwargs)
+        if key in self._entries:
+            parser, version = self._entries[key]
+            if parser.version == version: # not edited after caching
+                self.hits += 1
+                self._entries.move_to_end(key)
+                parser.rebind(model)
+                return parser
+            del self._entries[key]
+
+        self.misses += 1
+        parser = parser_class(model, custom_objects=custom_objects, **kwargs)
+        parser.parse()
+        if self._capacity > 0:
+            self._entries[key] = (parser, parser.version)
+            self._evict()
+        return parser
+
+    def invalidate(self, model=None):
+        """Remove cached parsers.
+
+        # Arguments.
+            model: a Keras model or None. If it is None, all the entries are removed.
+                Otherwise, the entries associated with `model` are removed.
+
+        """
+        if model is None:
+            self._entries.clear()
+            return
+        fp = fingerprint(model)
+        for key in [key for key in self._entries if key[0] == fp]:
+            del self._entries[key]
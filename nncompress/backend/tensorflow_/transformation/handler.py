@@ -2,8 +2,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import copy
-
 import numpy as np
 from tensorflow.keras.layers import Lambda, Concatenate
 
@@ -13,22 +11,71 @@ def get_handler(class_name):
     else:
         return LayerHandler
 
+def to_index(gate):
+    """Convert a gate (a boolean or binary mask) into an integer index array.
+    An integer array is regarded as already converted and returned as it is.
+
+    """
+    if gate is None:
+        return None
+    gate = np.asarray(gate)
+    if gate.dtype.kind in "iu":
+        return gate
+    return np.flatnonzero(gate.astype(bool))
+
+def aligned_count(nalive, multiple, width):
+    """Round `nalive` up to a multiple of `multiple`, which is capped at `width`."""
+    if multiple is None or multiple <= 1 or nalive == 0:
+        return nalive
+    return min(int(np.ceil(float(nalive) / multiple)) * multiple, width)
+
+def align_gate(gate, multiple, scores=None):
+    """Re-admit pruned channels of `gate` until the number of alive channels is a multiple of `multiple`
+    (or all of them), so that cut layers have SIMD-friendly channel counts.
+
+    # Arguments.
+        gate: a boolean or binary mask.
+        multiple: int, e.g., 8 or 16.
+        scores: a vector over channels. Pruned channels having higher scores are re-admitted first.
+            If it is None, pruned channels are re-admitted in the index order.
+
+    # Returns.
+        a boolean mask.
+
+    """
+    gate = np.asarray(gate).astype(bool)
+    nalive = int(np.sum(gate))
+    num_readmit = aligned_count(nalive, multiple, gate.shape[0]) - nalive
+    if num_readmit <= 0:
+        return gate
+    pruned = np.flatnonzero(~gate)
+    if scores is not None:
+        pruned = pruned[np.argsort(-np.asarray(scores)[pruned], kind="stable")]
+    gate = gate.copy()
+    gate[pruned[:num_readmit]] = True
+    return gate
+
+def take(w, gate, axis):
+    """Gather `w` along `axis` by a gate. It returns `w` itself if `gate` is None."""
+    idx = to_index(gate)
+    return w if idx is None else np.take(w, idx, axis=axis)
+
 def cut(w, in_gate, out_gate):
-    if out_gate is not None:
-        out_gate = np.array(out_gate, dtype=np.bool)
-        if len(w.shape) == 4: # conv2d
-            w = w[:,:,:,out_gate]
-        elif len(w.shape) == 2: # fc
-            w = w[:,out_gate]
-        elif len(w.shape) == 1: # bias ... 
-            w = w[out_gate]
-    if in_gate is not None:
-        in_gate = np.array(in_gate, dtype=np.bool)
-        if len(w.shape) == 4: # conv2d
-            w = w[:,:,in_gate,:]
-        elif len(w.shape) == 2: # fc
-            w = w[in_gate,:]
-    return w
+    """Slice `w` by gates along its output and input channel axes.
+    The gates can be masks or integer index arrays from `to_index`.
+    The result is a new array made by a single gather, so that `w` is never modified.
+
+    """
+    out_idx = to_index(out_gate)
+    in_idx = to_index(in_gate)
+    if len(w.shape) == 1: # bias ...
+        return take(w, out_idx, axis=0)
+    if len(w.shape) not in {2, 4}:
+        return w
+    in_axis = len(w.shape) - 2
+    if out_idx is not None and in_idx is not None:
+        return w[(slice(None),) * in_axis + (in_idx[:, np.newaxis], out_idx[np.newaxis, :])]
+    return take(take(w, out_idx, axis=-1), in_idx, axis=in_axis)
 
 class LayerHandler(object):
 
@@ -63,7 +110,7 @@ class LayerHandler(object):
     def cut_weights(W, in_gate, out_gate):
         ret = []
         for w in W:
-            w_ = cut(copy.deepcopy(w), in_gate, out_gate)
+            w_ = cut(w, in_gate, out_gate)
             ret.append(w_)
         return ret
 
@@ -89,9 +136,9 @@ class PatchingAndEmbeddingHandler(LayerHandler):
         ret = []
         for w in W:
             if len(w.shape) == 4:
-                w_ = cut(copy.deepcopy(w), in_gate, out_gate)
+                w_ = cut(w, in_gate, out_gate)
             else:
-                w_ = cut(copy.deepcopy(w), None, out_gate)
+                w_ = cut(w, None, out_gate)
             ret.append(w_)
         return ret
 
@@ -152,9 +199,9 @@ class DWConv2DHandler(LayerHandler):
         ret = []
         for w in W:
             if len(w.shape) == 4:
-                w_ = cut(copy.deepcopy(w), out_gate, None)
+                w_ = cut(w, out_gate, None)
             else:
-                w_ = cut(copy.deepcopy(w), in_gate, out_gate)
+                w_ = cut(w, in_gate, out_gate)
             ret.append(w_)
         return ret
 
@@ -170,16 +217,14 @@ class MultiHeadAttentionHandler(LayerHandler):
         ret = []
         for idx, w in enumerate(W):
             if len(w.shape) == 3:
-                w_ = copy.deepcopy(w)
                 if idx < 6: # k,q,v
-                    w_ = w_[in_gate,:,:]
+                    w_ = take(w, in_gate, axis=0)
                 else: # o 
-                    w_ = w_[:,:,out_gate]
+                    w_ = take(w, out_gate, axis=2)
             elif idx == len(W)-1: # last bias
-                w_ = copy.deepcopy(w)
-                w_ = w_[out_gate]
+                w_ = take(w, out_gate, axis=0)
             else:
-                w_ = copy.deepcopy(w)
+                w_ = w
             ret.append(w_)
         return ret
 
@@ -207,9 +252,9 @@ class SeparableConv2DHandler(LayerHandler):
         ret = []
         for idx, w in enumerate(W):
             if idx == 0: # Depth-wise
-                w_ = cut(copy.deepcopy(w), in_gate, None)
+                w_ = cut(w, in_gate, None)
             else: # Point-wise
-                w_ = cut(copy.deepcopy(w), in_gate, out_gate)
+                w_ = cut(w, in_gate, out_gate)
             ret.append(w_)
         return ret
 
@@ -21,6 +21,16 @@ def serialize(layer):
     layer_dict["inbound_nodes"] = []
     return layer_dict
 
+def functionalize(model):
+    if type(model) == keras.Sequential:
+        input_layer = keras.layers.Input(batch_shape=model.layers[0].input_shape, name="seq_input")
+        prev_layer = input_layer
+        for layer in model.layers:
+            layer._inbound_nodes = []
+            prev_layer = layer(prev_layer)
+        model = keras.models.Model([input_layer], [prev_layer])
+    return model
+
 class NNParser(object):
     """NNParser is a tool for enabling differentiable pruning.
    
@@ -48,22 +58,20 @@ class NNParser(object):
 
     def __init__(self, model, basestr="", custom_objects=None, namespace=None):
 
-        if type(model) == keras.Sequential:
-            input_layer = keras.layers.Input(batch_shape=model.layers[0].input_shape, name="seq_input")
-            prev_layer = input_layer
-            for layer in model.layers:
-                layer._inbound_nodes = []
-                prev_layer = layer(prev_layer)
-            model = keras.models.Model([input_layer], [prev_layer])
-
-        self._model = model
+        self._model = functionalize(model)
         self._custom_objects = custom_objects or {}
 
         self._graph = nx.MultiDiGraph()
         self._model_dict = None
+        self._torder = None
+        self._index = None
+        self._version = 0
+        self._edit_weights = {}
+        self._owned = None # the names of layer dicts owned by this parser. None means all of them.
 
         self._id_cnt = {}
         self._basestr = basestr
+        self._owns_namespace = namespace is None
         if namespace is None:
             self._namespace = set()
         else:
@@ -78,10 +86,47 @@ class NNParser(object):
     def model(self):
         return self._model
 
+    def clear(self):
+        """Clear internal info.
+        It does not remove the parsed information.
+
+        """
+        self._id_cnt = {}
+        if self._owns_namespace:
+            self._namespace = set()
+
+    def rebind(self, model):
+        """Bind `model` to this parser without parsing it again.
+        `model` must have the same structure as the parsed model, while its weights can be different.
+        Identifiers given by `get_id` are also reset, so the rebound parser gives the same names as a fresh one.
+
+        # Arguments.
+            model: a Keras model, which is structurally identical to the parsed model.
+
+        """
+        self._model = functionalize(model)
+        self.clear()
+
     @property
     def custom_objects(self):
         return self._custom_objects
 
+    @property
+    def version(self):
+        """The number of edits applied to the parsed graph."""
+        return self._version
+
+    @property
+    def torder(self):
+        """A dictionary from layer names to their indices in the traversal order."""
+        if self._torder is None:
+            v = self.traverse()
+            self._torder = {
+                name:idx
+                for idx, (name, _) in enumerate(v)
+            }
+        return self._torder
+
     def get_id(self, prefix):
         """This function gives an identifier for a prefix.
 
@@ -181,41 +226,248 @@ class NNParser(object):
                 inserted model.
 
         """
+        parser = self.fork()
+        for layer, position in zip(layers, positions):
+            parser.insert_layer(layer, position)
+        return parser.materialize(custom_objects=custom_objects, rebind=False)
 
-        model_dict = copy.deepcopy(self._model_dict)
-        layers_dict = {}
-        for layer_dict_ in model_dict["config"]["layers"]:
-            layers_dict[layer_dict_["config"]["name"]] = layer_dict_
+    def fork(self):
+        """Return a parser having a private copy of the parsed graph.
+        Edits on the returned parser do not affect this parser.
 
-        for layer, position in zip(layers, positions):
-            layer_dict = copy.deepcopy(layer)
-            for inbound in layers_dict[position]["inbound_nodes"]:
-                if "inbound_nodes" not in layer_dict:
-                    layer_dict["inbound_nodes"] = []
-                layer_dict["inbound_nodes"].append([[position, 0, 0, {}]]) # 0, 0, {} -> may be updated.
-
-            # find target
-            targets = []
-            for name, target in layers_dict.items():
-                for inbound in target["inbound_nodes"]:
-                    if type(inbound[0]) == list:
-                        for ib in inbound:
-                            if ib[0] == position:
-                                ib[0] = layer["name"]
-                    else: # must be str
-                        if inbound[0] == position:
-                            inbound[0] = layer["name"]
-
-            model_dict["config"]["layers"].append(layer_dict)
-
-        model_json = json.dumps(model_dict)
-        ret = tf.keras.models.model_from_json(model_json, custom_objects=self._custom_objects)
+        Layer dicts are shared by both parsers and copied only when an edit modifies them,
+        so that forking and editing do not copy the whole model dictionary.
+
+        # Returns.
+            a parser of the same class.
+
+        """
+        ret = copy.copy(self)
+        ret._graph = self._graph.copy() # node attributes are copied shallowly.
+        ret._model_dict = dict(self._model_dict)
+        ret._model_dict["config"] = dict(self._model_dict["config"])
+        ret._model_dict["config"]["layers"] = list(self._model_dict["config"]["layers"])
+        for key in ["input_layers", "output_layers"]:
+            ret._model_dict["config"][key] = copy.deepcopy(self._model_dict["config"][key])
+        # Neither parser owns the shared layer dicts anymore.
+        self._owned = set()
+        ret._owned = set()
+        ret._id_cnt = copy.deepcopy(self._id_cnt)
+        if self._owns_namespace:
+            ret._namespace = copy.deepcopy(self._namespace)
+        ret._edit_weights = dict(self._edit_weights)
+        ret._index = None
+        return ret
+
+    def _mark_modified(self):
+        self._version += 1
+        self._torder = None
+        self._index = None
+
+    def _writable(self, name):
+        """Return the layer dict of `name`, which is copied first if it is shared with another parser."""
+        layer_dict = self._graph.nodes[name]["layer_dict"]
+        if self._owned is None or name in self._owned:
+            return layer_dict
+        new_dict = copy.deepcopy(layer_dict)
+        layers = self._model_dict["config"]["layers"]
+        for idx, layer_dict_ in enumerate(layers):
+            if layer_dict_ is layer_dict:
+                layers[idx] = new_dict
+                break
+        self._graph.nodes[name]["layer_dict"] = new_dict
+        self._owned.add(name)
+        return new_dict
+
+    def _get_inbound(self, dst, flow_idx, inbound_idx):
+        flow = self._writable(dst)["inbound_nodes"][flow_idx]
+        if type(flow[0]) != list:
+            return flow
+        else:
+            return flow[inbound_idx]
+
+    def _reroute_outputs(self, name, level_map):
+        """Reroute the outbound edges of tensor 0 of `name`.
+
+        # Arguments.
+            name: str, the layer name whose outputs are rerouted.
+            level_map: a function (level) -> (new_src, new_level, new_tensor).
+
+        """
+        for src, dst, key, data in list(self._graph.out_edges(name, keys=True, data=True)):
+            if data["tensor"] != 0:
+                continue
+            level, flow_idx = data["level_change"]
+            new_src, new_level, new_tensor = level_map(level)
+            inbound = self._get_inbound(dst, flow_idx, data["inbound_idx"])
+            inbound[0], inbound[1], inbound[2] = new_src, new_level, new_tensor
+            if type(inbound[-1]) == dict and "value" in inbound[-1] and inbound[-1]["value"][0] == src:
+                inbound[-1]["value"][0:3] = [new_src, new_level, new_tensor]
+            self._graph.remove_edge(src, dst, key)
+            self._graph.add_edge(
+                new_src, dst, level_change=(new_level, flow_idx), tensor=new_tensor, inbound_idx=data["inbound_idx"], temp=data["temp"])
+
+        for output_layer in self._model_dict["config"]["output_layers"]:
+            if output_layer[0] == name and output_layer[2] == 0:
+                output_layer[0], output_layer[1], output_layer[2] = level_map(output_layer[1])
+
+    def _add_layer(self, layer_dict, weights):
+        self._model_dict["config"]["layers"].append(layer_dict)
+        if self._owned is not None:
+            self._owned.add(layer_dict["config"]["name"])
+        self._graph.add_node(layer_dict["config"]["name"], layer_dict=layer_dict, nlevel=len(layer_dict["inbound_nodes"]))
+        if weights is not None:
+            self._edit_weights[layer_dict["config"]["name"]] = weights
+
+    def _remove_layer(self, name):
+        layer_dict = self._graph.nodes[name]["layer_dict"]
+        layers = self._model_dict["config"]["layers"]
+        for idx, layer_dict_ in enumerate(layers):
+            if layer_dict_ is layer_dict:
+                del layers[idx]
+                break
+        self._graph.remove_node(name)
+        if name in self._edit_weights:
+            del self._edit_weights[name]
+        if self._owned is not None:
+            self._owned.discard(name)
+
+    def _check_editable(self, name):
+        if self._model_dict is None:
+            raise ValueError("`parse` should be executed before editing the graph.")
+        if name not in self._graph.nodes:
+            raise ValueError("%s does not exist in the graph." % name)
+        for _, _, data in self._graph.out_edges(name, data=True):
+            if data["tensor"] != 0:
+                raise NotImplementedError("Editing a layer having multiple output tensors is not supported.")
+
+    def insert_layer(self, layer_dict, position, weights=None):
+        """Insert a layer after `position` in place.
+        Only the edges around `position` are updated, and no Keras model is created.
+        Call `materialize` to get the edited model.
+
+        # Arguments.
+            layer_dict: dict, the layer dict to insert.
+            position: str, the layer name where the inserted layer is located after.
+            weights: a list of numpy arrays or None, the weights of the inserted layer.
+
+        """
+        self._check_editable(position)
+        layer_dict = copy.deepcopy(layer_dict)
+        name = layer_dict["config"]["name"]
+        layer_dict["name"] = name
+        nflow = max(self._graph.nodes[position]["nlevel"], 1)
+        layer_dict["inbound_nodes"] = [[[position, i, 0, {}]] for i in range(nflow)]
+
+        self._reroute_outputs(position, lambda level: (name, level, 0))
+        self._add_layer(layer_dict, weights)
+        for i in range(nflow):
+            self._graph.add_edge(position, name, level_change=(i, i), tensor=0, inbound_idx=0, temp=None)
+        self._mark_modified()
+
+    def replace_layer(self, target, replacement, weights=None):
+        """Replace `target` with a sequence of layers in place.
+        The first layer of `replacement` takes over the inbound nodes of `target`,
+        and the outputs of the last one are connected to the layers which used `target`.
+
+        # Arguments.
+            target: str, the layer name to be replaced.
+            replacement: a list of layer dicts, which are connected sequentially.
+            weights: a list of weight lists (or None) aligned with `replacement`.
+
+        """
+        self._check_editable(target)
+        node_data = self._graph.nodes[target]
+        if node_data["nlevel"] == 0:
+            raise ValueError("An input layer cannot be replaced.")
+        nflow = node_data["nlevel"]
+        if weights is None:
+            weights = [None for _ in replacement]
+
+        replacement = copy.deepcopy(replacement)
+        names = []
+        for idx, r in enumerate(replacement):
+            r["name"] = r["config"]["name"]
+            names.append(r["name"])
+            if idx == 0:
+                r["inbound_nodes"] = copy.deepcopy(node_data["layer_dict"]["inbound_nodes"])
+            else:
+                r["inbound_nodes"] = [[[names[idx-1], i, 0, {}]] for i in range(nflow)]
+
+        in_edges = list(self._graph.in_edges(target, data=True))
+        self._reroute_outputs(target, lambda level: (names[-1], level, 0))
+        self._remove_layer(target)
+        for r, w in zip(replacement, weights):
+            self._add_layer(r, w)
+        for src, _, data in in_edges:
+            self._graph.add_edge(src, names[0], **data)
+        for idx in range(1, len(names)):
+            for i in range(nflow):
+                self._graph.add_edge(names[idx-1], names[idx], level_change=(i, i), tensor=0, inbound_idx=0, temp=None)
+        self._mark_modified()
+
+    def remove_layer(self, name):
+        """Remove a layer having a single inbound tensor per flow in place.
+        The layers which used `name` are connected to the input of `name`.
+
+        # Arguments.
+            name: str, the layer name to be removed.
+
+        """
+        self._check_editable(name)
+        inbound_nodes = self._graph.nodes[name]["layer_dict"]["inbound_nodes"]
+        sources = []
+        for flow in inbound_nodes:
+            if type(flow[0]) != list:
+                sources.append(tuple(flow[0:3]))
+            elif len(flow) == 1:
+                sources.append(tuple(flow[0][0:3]))
+            else:
+                raise ValueError("%s has multiple inbound tensors." % name)
+        if len(sources) == 0:
+            raise ValueError("An input layer cannot be removed.")
+
+        self._reroute_outputs(name, lambda level: sources[level])
+        self._remove_layer(name)
+        self._mark_modified()
+
+    def materialize(self, custom_objects=None, rebind=True):
+        """Create a Keras model from the (edited) graph.
+        The weights of the layers given in edits are used, and the others are taken from the bound model.
+
+        # Arguments.
+            custom_objects: `custom objects for loading a Keras model having custom layers/operators.
+            rebind: bool, if it is True, the parser is bound to the returned model.
+
+        # Returns.
+            a Keras model.
+
+        """
+        model_json = json.dumps(self._model_dict)
+        ret = tf.keras.models.model_from_json(model_json, custom_objects=custom_objects or self._custom_objects)
         for layer in ret.layers:
-            if len(layer.get_weights()) > 0:
-                layer.set_weights(self._model.get_layer(layer.name).get_weights())
+            if layer.name in self._edit_weights:
+                layer.set_weights(self._edit_weights[layer.name])
+                continue
+            try:
+                weights = self._model.get_layer(layer.name).get_weights()
+            except ValueError:
+                continue
+            if len(weights) > 0:
+                layer.set_weights(weights)
 
+        if rebind:
+            self._model = ret
+            self._edit_weights = {}
+            self._update_analysis()
         return ret
 
+    def _update_analysis(self):
+        """Update the information derived from the graph after `materialize`.
+
+        """
+        return
+
     def replace_block(self, replace_mappings, in_maps=None, ex_maps=None, custom_objects=None):
         """This function replaces a block with another block in your NN model.
         A block is defined to be a list of layers each of which is written in a dictionary.
@@ -498,68 +750,151 @@ class NNParser(object):
 
         """
 
+        index = self.get_index()
+        names = index["names"]
+        ids = index["ids"]
+        if inbound:
+            ptr, edges, next_, next_level, level_ = index["in_ptr"], index["in_edges"], index["in_src"], index["in_src_level"], index["in_dst_level"]
+        else:
+            ptr, edges, next_, next_level, level_ = index["out_ptr"], index["out_edges"], index["out_dst"], index["out_dst_level"], index["out_src_level"]
+
+        # Use the cached order for a full traversal without any customization.
+        if sources is None and not inbound and sync and node_callbacks is None and neighbor_callbacks is None\
+            and stopping_condition is None and previsit is None and index["topo"] is not None:
+            return list(index["topo"])
+        is_full = sources is None and not inbound and sync and stopping_condition is None and previsit is None
+
         visit = []
         if previsit is None:
             visit_ = set()
         else:
-            visit_ = previsit
+            visit_ = set([(ids[n], level) for n, level in previsit if n in ids])
 
         # if sources is None, then we start from leaves.
         if sources is None:
-            sources = [x for x in self._graph.nodes(data=True)
-                if (inbound and self._graph.out_degree(x[0])==0)
-                    or (not inbound and self._graph.in_degree(x[0])==0)]
+            degree = index["out_degree"] if inbound else index["in_degree"]
+            sources = [(names[i], self._graph.nodes[names[i]]) for i in range(len(names)) if degree[i] == 0]
         stk = []
         for s in sources:
             if s[1]["nlevel"] == 0 or s[1]["nlevel"] == 1:
-                stk.append((s[0], 0))
+                stk.append((ids[s[0]], 0))
             else:
                 for idx in range(s[1]["nlevel"]):
-                    stk.append((s[0], idx))
+                    stk.append((ids[s[0]], idx))
 
         if sync and not inbound:
-            dependency = {
-                n[0] : [
-                    [0 for _ in range(len(flow))] if type(flow[0]) == list else [0]
-                    for flow in n[1]["layer_dict"]["inbound_nodes"]
-                ]
-                for n in self._graph.nodes(data=True) if "inbound_nodes" in n[1]["layer_dict"]
-            }
+            flow_ptr = index["flow_ptr"]
+            slot_base = index["slot_base"]
+            remaining = list(index["flow_size"])
+            satisfied = bytearray(index["nslots"])
         while len(stk) > 0:
             curr, level = stk.pop()
-            visit.append((curr, level))
+            name = names[curr]
+            visit.append((name, level))
 
             if node_callbacks is not None:
                 for callback in node_callbacks:
-                    callback(curr, level)
+                    callback(name, level)
 
-            if stopping_condition is not None and stopping_condition((curr, level), is_edge=False):
+            if stopping_condition is not None and stopping_condition((name, level), is_edge=False):
                 break
 
-            neighbors = self._graph.in_edges(curr, data=True) if inbound else self._graph.out_edges(curr, data=True)
-            for e in neighbors:
-                src, dst, level_change, inbound_idx = e[0], e[1], e[2]["level_change"], e[2]["inbound_idx"]
+            for k in range(ptr[curr], ptr[curr+1]):
                 if neighbor_callbacks is not None:
                     for callback in neighbor_callbacks:
-                        callback(e)
+                        callback(edges[k])
 
-                if stopping_condition is not None and stopping_condition(e, is_edge=True):
+                if stopping_condition is not None and stopping_condition(edges[k], is_edge=True):
                     continue
 
+                n, n_level = next_[k], next_level[k]
                 if inbound:
-                    if level_change[1] == level and (src, level_change[0]) not in visit_:
-                        stk.append((src, level_change[0]))
-                        visit_.add((src, level_change[0]))
+                    if level_[k] == level and (n, n_level) not in visit_:
+                        stk.append((n, n_level))
+                        visit_.add((n, n_level))
                 else: #outbound
                     if sync:
-                        dependency[dst][level_change[1]][inbound_idx] = 1
-                        if np.sum(dependency[dst][level_change[1]]) < len(dependency[dst][level_change[1]]):
+                        fidx = flow_ptr[n] + n_level
+                        slot = slot_base[fidx] + index["out_inbound_idx"][k]
+                        if not satisfied[slot]:
+                            satisfied[slot] = 1
+                            remaining[fidx] -= 1
+                        if remaining[fidx] > 0:
                             continue
-                    if level_change[0] == level and (sync or (dst, level_change[1]) not in visit_):
-                        stk.append((dst, level_change[1]))
-                        visit_.add((dst, level_change[1]))
+                    if level_[k] == level and (sync or (n, n_level) not in visit_):
+                        stk.append((n, n_level))
+                        visit_.add((n, n_level))
+
+        if previsit is not None:
+            previsit.update([(names[n], level) for n, level in visit_])
+        if is_full and index["topo"] is None:
+            index["topo"] = list(visit)
         return visit
 
+    def get_index(self):
+        """Return compact adjacency arrays of the graph.
+        The arrays are built once and reused until the graph is edited.
+
+        Nodes are identified by integers in the order of `self._graph.nodes`.
+        Out-edges of node i are located at [out_ptr[i], out_ptr[i+1]) in the `out_*` arrays (CSR),
+        and in-edges are similarly located in the `in_*` arrays.
+        `out_edges` and `in_edges` keep the edge tuples (src, dst, data) of networkx for callbacks.
+        Each inbound flow of a node has slots as many as its inbound tensors, which are used to check
+        whether all the inputs of the flow are ready in traversal.
+
+        # Returns.
+            a dictionary of the arrays.
+
+        """
+        if self._index is not None:
+            return self._index
+
+        names = list(self._graph.nodes)
+        ids = {name:idx for idx, name in enumerate(names)}
+        index = {
+            "names":names,
+            "ids":ids,
+            "topo":None
+        }
+        for direction in ["out", "in"]:
+            ptr = [0]
+            edges = []
+            for name in names:
+                if direction == "out":
+                    edges.extend(self._graph.out_edges(name, data=True))
+                else:
+                    edges.extend(self._graph.in_edges(name, data=True))
+                ptr.append(len(edges))
+            index[direction+"_ptr"] = ptr
+            index[direction+"_edges"] = edges
+            index[direction+"_src"] = [ids[e[0]] for e in edges]
+            index[direction+"_dst"] = [ids[e[1]] for e in edges]
+            index[direction+"_src_level"] = [e[2]["level_change"][0] for e in edges]
+            index[direction+"_dst_level"] = [e[2]["level_change"][1] for e in edges]
+            index[direction+"_inbound_idx"] = [e[2]["inbound_idx"] for e in edges]
+        index["in_degree"] = [index["in_ptr"][i+1] - index["in_ptr"][i] for i in range(len(names))]
+        index["out_degree"] = [index["out_ptr"][i+1] - index["out_ptr"][i] for i in range(len(names))]
+
+        flow_ptr = []
+        flow_size = []
+        slot_base = []
+        nslots = 0
+        for name in names:
+            flow_ptr.append(len(flow_size))
+            layer_dict = self._graph.nodes[name]["layer_dict"]
+            for flow in layer_dict.get("inbound_nodes", []):
+                size = len(flow) if type(flow[0]) == list else 1
+                flow_size.append(size)
+                slot_base.append(nslots)
+                nslots += size
+        index["flow_ptr"] = flow_ptr
+        index["flow_size"] = flow_size
+        index["slot_base"] = slot_base
+        index["nslots"] = nslots
+
+        self._index = index
+        return index
+
     def parse(self):
         """Parse a given network. 
 
@@ -593,11 +928,9 @@ class NNParser(object):
                         self._graph.add_edge(
                             src, dst, level_change=(inbound[1], flow_idx), tensor=inbound[2], inbound_idx=in_idx, temp=None)
 
-        v = self.traverse()
-        self.torder = {
-            name:idx
-            for idx, (name, _) in enumerate(v)
-        }
+        self._torder = None
+        self._index = None
+        self.torder # compute the traversal order.
 
     def get_topology(self):
         """Return a networkx graph having the topology of the graph.
@@ -13,7 +13,7 @@ from tensorflow import keras
 from tensorflow.keras.layers import Lambda
 from orderedset import OrderedSet
 
-from nncompress.backend.tensorflow_.transformation.handler import get_handler
+from nncompress.backend.tensorflow_.transformation.handler import get_handler, to_index, align_gate
 from nncompress.backend.tensorflow_.transformation.parser import NNParser, serialize
 from nncompress.backend.tensorflow_ import DifferentiableGate
 
@@ -64,6 +64,7 @@ class PruningNNParser(NNParser):
     def __init__(self, model, basestr="", custom_objects=None, gate_class=None, namespace=None, allow_input_pruning=False):
         super(PruningNNParser, self).__init__(model, basestr=basestr, custom_objects=custom_objects, namespace=namespace)
         self._sharing_groups = []
+        self._group_index = {}
         self._avoid_pruning = set()
         self._t2g = None
         if gate_class is None:
@@ -79,6 +80,13 @@ class PruningNNParser(NNParser):
 
     def parse(self):
         super(PruningNNParser, self).parse()
+        self._update_analysis()
+
+    def _update_analysis(self):
+        """Find sharing groups and layers to avoid pruning on the current graph.
+
+        """
+        self._sharing_groups = []
 
         def extract(i):
             if type(i) == frozenset and len(i) == 0:
@@ -107,6 +115,7 @@ class PruningNNParser(NNParser):
         affecting_layers = self.get_affecting_layers(augmented_transformers)
 
         # Find sharing groups
+        merger = SharingGroupMerger()
         for layer, group  in affecting_layers.items():
             h = get_handler(self._model.get_layer(layer[0]).__class__.__name__)
             if h.is_concat():
@@ -125,22 +134,13 @@ class PruningNNParser(NNParser):
                         if g not in group_:
                             group_.append(g)
 
-            candidates = []
-            for target in self._sharing_groups:
-                if has_intersection(group_, target):
-                    candidates.append(target)
-            if len(candidates) == 0:
-                self._sharing_groups.append(group_)
-            elif len(candidates) == 1 and candidates[0] == group_: # to avoid kicking out the same group.
-                continue
-            else:
-                new_group = group_.copy()
-                for cand in candidates:
-                    for c in cand:
-                        if not has_intersection(new_group, c):
-                            new_group.append(c)
-                    self._sharing_groups.remove(cand)
-                self._sharing_groups.append(new_group)
+            merger.add(group_)
+        self._sharing_groups = merger.get_groups()
+        self._group_index = {}
+        for g in self._sharing_groups:
+            for item in g:
+                if type(item) == str:
+                    self._group_index[item] = g
 
         # Find layers to avoid pruning
         self._avoid_pruning = self.get_last_transformers()
@@ -278,10 +278,7 @@ class PruningNNParser(NNParser):
             a list of str, the name of sharing group layers.
 
         """
-        target_group = None
-        for g in self._sharing_groups:
-            if target in g:
-                target_group = g
+        target_group = self._group_index.get(target, None)
         if target_group is None:
             raise ValueError("No sharing group for %s" % target)
         return [ copy.deepcopy(i) for i in target_group ]
@@ -510,52 +507,79 @@ class PruningNNParser(NNParser):
         It does not remove the parsed information.
 
         """
+        super(PruningNNParser, self).clear()
         self._t2g = None
-        self._id_cnt = {}
 
-    def cut(self, gmodel, return_history=False, new_spatial_shape=None):
+    def cut(self, gmodel, return_history=False, new_spatial_shape=None, channel_multiple=None, scores=None):
         """This function gets a compressed model from a model having gates
 
         # Arguments.
             gmodel: a Keras model, which has differentiable gates.
+            channel_multiple: int, if it is given, the alive channels of each gate are rounded up to
+                a multiple of it by re-admitting pruned channels, because arbitrary channel counts
+                often run slower on CPU (XNNPACK/oneDNN) than the next multiple of 8 or 16.
+                Re-admitted channels keep their original weights.
+            scores: a dict from gate names to per-channel scores, which decide the channels to re-admit.
+                If a gate is not in it, its gate values are used.
 
         # Returns.
             a Keras model, which is compressed.
 
         """
-        model_dict = copy.deepcopy(self._model_dict)
+        # Layer dicts are shared with `_model_dict` and copied only when they are modified.
+        model_config = dict(self._model_dict["config"])
+        model_config["layers"] = list(model_config["layers"])
         layers_dict = {}
-        for layer_dict in model_dict["config"]["layers"]:
+        layers_idx = {}
+        copied = set()
+        def writable(name):
+            if name not in copied:
+                layers_dict[name] = copy.deepcopy(layers_dict[name])
+                model_config["layers"][layers_idx[name]] = layers_dict[name]
+                copied.add(name)
+            return layers_dict[name]
+
+        for idx, layer_dict in enumerate(model_config["layers"]):
             layers_dict[layer_dict["config"]["name"]] = layer_dict
+            layers_idx[layer_dict["config"]["name"]] = idx
 
             # TODO: 4D Input Assumption (batch, spatial1, spatial2, channel)
             if layer_dict["class_name"] == "InputLayer" and new_spatial_shape is not None:
+                layer_dict = writable(layer_dict["config"]["name"])
                 layer_dict["config"]["batch_input_shape"][1] = new_spatial_shape[layer_dict["config"]["name"]][1]
                 layer_dict["config"]["batch_input_shape"][2] = new_spatial_shape[layer_dict["config"]["name"]][2]
 
-        gmodel_dict = json.loads(gmodel.to_json())
-        glayers_dict = {}
+        # Find the inbounds of gates from the gated model without serializing it.
         g2t = {}
         gate_mapping = {}
-        for layer_dict in gmodel_dict["config"]["layers"]:
-            glayers_dict[layer_dict["config"]["name"]] = layer_dict
-            if layer_dict["class_name"] == self._gate_class.__name__:
-                g2t[layer_dict["name"]] = set()
-                gate = gmodel.get_layer(layer_dict["name"]).binary_selection() == 1.0
-                for flow in layer_dict["inbound_nodes"]:
-                    for inbound in flow:
-                        g2t[layer_dict["name"]].add(inbound[0])
-                        if inbound[0] not in gate_mapping:
-                            gate_mapping[(inbound[0], inbound[1])] = gate
+        for layer in gmodel.layers:
+            if layer.__class__.__name__ == self._gate_class.__name__:
+                g2t[layer.name] = set()
+                gate = layer.binary_selection() == 1.0
+                if channel_multiple is not None:
+                    gate_scores = scores[layer.name] if scores is not None and layer.name in scores else layer.gates.numpy()
+                    gate = align_gate(gate, channel_multiple, gate_scores)
+                for node in layer._inbound_nodes:
+                    for inbound_layer, node_index, _, _ in node.iterate_inbound():
+                        g2t[layer.name].add(inbound_layer.name)
+                        gate_mapping[(inbound_layer.name, node_index)] = gate
+
+        def gclass_name(n):
+            try:
+                return gmodel.get_layer(n).__class__.__name__
+            except ValueError:
+                return None
 
         history = {n:None for n in self._graph.nodes}
-        weights = {}
-        for n in self._graph.nodes:
-            try:
-                if gmodel.get_layer(n).__class__.__name__ != "Functional":
-                    weights[n] = gmodel.get_layer(n).get_weights()
-            except ValueError as e:
-                print("%s does not exist, but ignore it." % n)
+        weights = {} # the weights of cut layers
+
+        indices = {} # id(gate) -> (gate, index array), shared by the layers having the same gate.
+        def index_of(gate):
+            if gate is None:
+                return None
+            if id(gate) not in indices:
+                indices[id(gate)] = (gate, to_index(gate))
+            return indices[id(gate)][1]
 
         def cut_weights(n, level):
 
@@ -571,7 +595,7 @@ class PruningNNParser(NNParser):
                     continue
                 elif (src, level_change[0]) in gate_mapping:
                     gates.append(gate_mapping[(src, level_change[0])])
-                elif glayers_dict[n]["class_name"] != "Functional":
+                elif gclass_name(n) != "Functional":
                     # TODO: better implementation for getting the channel of src?
                     gates.append(np.ones((self.get_nchannel(src),)) == 1.0) # Holder
 
@@ -589,20 +613,40 @@ class PruningNNParser(NNParser):
 
             output_gate = gate_mapping[(n, level)] if (n, level) in gate_mapping else None
             if not history[n]:
-                new_weights = h.cut_weights(weights[n], input_gate, output_gate)
+                class_name = gclass_name(n)
+                if class_name is None:
+                    print("%s does not exist, but ignore it." % n)
+                    return
+                elif class_name == "Functional":
+                    return
+                new_weights = h.cut_weights(gmodel.get_layer(n).get_weights(), index_of(input_gate), index_of(output_gate))
                 weights[n] = new_weights
-                h.update_layer_schema(layers_dict[n], weights[n], input_gate, output_gate)
+                h.update_layer_schema(writable(n), weights[n], input_gate, output_gate)
                 history[n] = (input_gate, output_gate)
 
         self.traverse(node_callbacks=[cut_weights])
 
-        model_json = json.dumps(model_dict)
-        ret = tf.keras.models.model_from_json(model_json, custom_objects=self._custom_objects)
+        # Build the compact model from the config in memory, and write weights into its variables.
+        # Keras may modify config dicts in place, so that layer dicts shared with `_model_dict`
+        # (which can live in the parser cache) are copied before deserialization.
+        for name in layers_dict:
+            writable(name)
+        for key in ["input_layers", "output_layers"]:
+            model_config[key] = copy.deepcopy(model_config[key])
+        ret = tf.keras.Model.from_config(model_config, custom_objects=self._custom_objects)
         for layer in ret.layers:
             if layer.name in weights:
-                layer.set_weights(weights[layer.name])
+                values = weights[layer.name]
             else:
-                print(layer.name, " is not in `weights`. It should be handled somewhere.")
+                try:
+                    values = gmodel.get_layer(layer.name).weights # variable-to-variable copy
+                except ValueError:
+                    print(layer.name, " is not in `weights`. It should be handled somewhere.")
+                    continue
+            if len(values) != len(layer.weights):
+                raise ValueError("%s expects %d weights, but %d are given." % (layer.name, len(layer.weights), len(values)))
+            for var, value in zip(layer.weights, values):
+                var.assign(value)
 
         if return_history:
             ret = (ret, history)
@@ -692,27 +736,126 @@ class PruningNNParser(NNParser):
         return cutmodel
 
 
-def has_intersection(i, j):
-    if not type(i) in [list, tuple, OrderedSet, frozenset]:
-        i  = (i,)
-    if not type(j) in [list, tuple, OrderedSet, frozenset]:
-        j  = (j,)
-
-    def expand(s):
-        stk = [s]
-        output = []
-        while len(stk) > 0:
-            curr = stk.pop()
-            for s_ in curr:
-                if type(s_) in [list, tuple, OrderedSet, frozenset]:
-                    stk.append(s_)
-                else:
-                    output.append(s_)
-        return output
+def flatten_group(g):
+    """Return the layer names in a (nested) sharing group item."""
+    if not type(g) in [list, tuple, OrderedSet, frozenset]:
+        return [g]
+    stk = [g]
+    output = []
+    while len(stk) > 0:
+        curr = stk.pop()
+        for s_ in curr:
+            if type(s_) in [list, tuple, OrderedSet, frozenset]:
+                stk.append(s_)
+            else:
+                output.append(s_)
+    return output
+
+class UnionFind(object):
+    """A disjoint-set forest over integer ids with path halving and union by size.
+
+    """
+
+    def __init__(self):
+        self._parent = []
+        self._size = []
+
+    def make(self):
+        self._parent.append(len(self._parent))
+        self._size.append(1)
+        return len(self._parent) - 1
+
+    def find(self, x):
+        parent = self._parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        x = self.find(x)
+        y = self.find(y)
+        if x == y:
+            return x
+        if self._size[x] < self._size[y]:
+            x, y = y, x
+        self._parent[y] = x
+        self._size[x] += self._size[y]
+        return x
+
+class SharingGroupMerger(object):
+    """SharingGroupMerger merges overlapping groups of layers into sharing groups.
+
+    Each layer is given an integer id in a union-find structure, so finding the groups overlapping
+    with a new group costs the number of layers in the new group rather than the number of groups.
+    The result is the same as merging groups pairwise with `has_intersection`:
+    a group is appended at the end when it is created or merged, and an item of a merged group
+    is kept only if it does not overlap with the items kept before it.
+
+    """
 
-    i = OrderedSet(expand(i))
-    j = OrderedSet(expand(j))
-    return len(i.intersection(j)) > 0
+    def __init__(self):
+        self._uf = UnionFind()
+        self._ids = {} # layer name -> id, only for layers in a group.
+        self._groups = {} # root -> (items, layer names, sequence number)
+        self._seq = 0
+        self._leaves = {}
+
+    def _get_leaves(self, item):
+        if item not in self._leaves:
+            self._leaves[item] = frozenset(flatten_group(item))
+        return self._leaves[item]
+
+    def add(self, group):
+        leaves = set()
+        for item in group:
+            leaves.update(self._get_leaves(item))
+
+        roots = set()
+        for leaf in leaves:
+            if leaf in self._ids:
+                roots.add(self._uf.find(self._ids[leaf]))
+        candidates = sorted(roots, key=lambda root: self._groups[root][2]) # in the order of creation.
+
+        if len(candidates) == 1 and self._groups[candidates[0]][0] == group: # to avoid kicking out the same group.
+            return
+
+        new_group = list(group)
+        old_leaves = []
+        for root in candidates:
+            items, members, _ = self._groups.pop(root)
+            old_leaves.append(members)
+            for item in items:
+                item_leaves = self._get_leaves(item)
+                if leaves.isdisjoint(item_leaves):
+                    new_group.append(item)
+                    leaves.update(item_leaves)
+
+        for members in old_leaves: # drop the layers of discarded items.
+            for leaf in members:
+                if leaf not in leaves:
+                    del self._ids[leaf]
+
+        root = None
+        for leaf in leaves:
+            if leaf not in self._ids:
+                self._ids[leaf] = self._uf.make()
+            if root is None:
+                root = self._uf.find(self._ids[leaf])
+            else:
+                root = self._uf.union(root, self._ids[leaf])
+        if root is None: # a group without any layer.
+            root = self._uf.make()
+        self._groups[root] = (new_group, leaves, self._seq)
+        self._seq += 1
+
+    def get_groups(self):
+        groups = sorted(self._groups.values(), key=lambda x: x[2])
+        return [items for items, _, _ in groups]
+
+def has_intersection(i, j):
+    i = set(flatten_group(i))
+    return not i.isdisjoint(flatten_group(j))
 
 
 if __name__ == "__main__":
@@ -59,6 +59,10 @@ def get_out_channel_idx():
 def get_weights(model, layer_name):
     return model.get_layer(layer_name).get_weights()
 
+def get_io_shapes(model, layer_name):
+    layer = model.get_layer(layer_name)
+    return layer.get_input_shape_at(0), layer.get_output_shape_at(0)
+
 def weight_transfer(a, b, exclude=None):
     if exclude is None:
         exclude = set()
@@ -73,21 +77,42 @@ def copy_(model):
     model_.set_weights(model.get_weights())
     return model_
 
+def fingerprint(model):
+    from nncompress.backend.tensorflow_.transformation.cache import fingerprint as fingerprint_
+    return fingerprint_(model)
+
+_PARSER_CACHE = None
+
+def get_parser_cache():
+    global _PARSER_CACHE
+    if _PARSER_CACHE is None:
+        from nncompress.backend.tensorflow_.transformation.cache import ParserCache
+        _PARSER_CACHE = ParserCache()
+    return _PARSER_CACHE
+
+def get_parser(model, parser_class=None, custom_objects=None, **kwargs):
+    """Return a parsed parser for `model`, reusing a cached one if `model` was already parsed.
+
+    """
+    if parser_class is None:
+        from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser
+        parser_class = PruningNNParser
+    return get_parser_cache().get(model, parser_class, custom_objects=custom_objects, **kwargs)
+
+def invalidate_parser_cache(model=None):
+    get_parser_cache().invalidate(model)
+
 def prune_filter(model, domain, mode="channel", custom_objects=None):
-    from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser
     domain = copy.deepcopy(domain)
     if mode == "channel": # it supports `channel_pruning` only now.
-        parser = PruningNNParser(model, custom_objects=custom_objects)
-        parser.parse()
+        parser = get_parser(model, custom_objects=custom_objects)
         avoid = parser.get_last_transformers()
         for a in avoid:
             domain.remove(a)
     return domain
 
 def get_sharing_layers(model, target, custom_objects=None):
-    from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser
-    parser = PruningNNParser(model, custom_objects=custom_objects)
-    parser.parse()
+    parser = get_parser(model, custom_objects=custom_objects)
 
     if type(target) == list:
         ret = {}
@@ -101,13 +126,40 @@ def get_sharing_layers(model, target, custom_objects=None):
         return parser.get_sharing_layers(target)
 
 def get_sharing_groups(model, custom_objects=None):
-    from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser
-    parser = PruningNNParser(model, custom_objects=custom_objects)
-    parser.parse()
+    parser = get_parser(model, custom_objects=custom_objects)
     model_ = parser.inject()
     tf.keras.utils.plot_model(model_, to_file="gmodel.png", show_shapes=True)
     return parser.get_sharing_groups()
 
+def get_prunable_groups(model, custom_objects=None):
+    """Return the sharing groups which can be pruned, i.e., having no last transformers.
+
+    """
+    from nncompress.backend.tensorflow_.transformation.pruning_parser import flatten_group
+    parser = get_parser(model, custom_objects=custom_objects)
+    avoid = set(parser.get_last_transformers())
+    return [
+        g for g in parser.get_sharing_groups()
+        if not any([l in avoid for l in flatten_group(g)])
+    ]
+
+def get_channel_consumers(model, custom_objects=None):
+    """Return the producers of the input channels of each layer, i.e., the transformers whose outputs
+    reach it without passing through another transformer. Inputs made by concatenation are not included.
+
+    # Returns.
+        a dictionary from layer names to lists of producer layer names.
+
+    """
+    parser = get_parser(model, custom_objects=custom_objects)
+    ret = {}
+    for (name, level), affecting in parser.get_affecting_layers().items():
+        if level != 0 or len(affecting) == 0:
+            continue
+        if all([type(a) == tuple and len(a) == 3 and type(a[0]) == str for a in affecting]):
+            ret[name] = [a[0] for a in affecting]
+    return ret
+
 def get_topology(model, custom_objects=None):
     from nncompress.backend.tensorflow_.transformation.parser import NNParser
     parser = NNParser(model, custom_objects)
@@ -115,10 +167,8 @@ def get_topology(model, custom_objects=None):
     return parser.get_topology()
 
 def prune(model, masking, mode="channel", custom_objects=None):
-    from nncompress.backend.tensorflow_.transformation.pruning_parser import PruningNNParser
     if mode == "channel":
-        parser = PruningNNParser(model, custom_objects=custom_objects)
-        parser.parse()
+        parser = get_parser(model, custom_objects=custom_objects)
         model_ = parser.inject()
         for t, g in parser.get_t2g().items():
             g = model_.get_layer(g)
@@ -213,16 +263,12 @@ def decompose(model, targets, decomposed, custom_objects=None):
         else:
             raise NotImplementedError()
         replace_mappings.append(([target], replacement))
-    model_dict = parser.replace_block(replace_mappings, in_maps="seq", custom_objects=custom_objects)
-    model_json = json.dumps(model_dict)
-    ret = tf.keras.models.model_from_json(model_json, custom_objects=custom_objects)
-    weight_transfer(model, ret, targets)
-
-    for name, weight in n2w.items():
-        if type(weight) == tuple:
-            ret.get_layer(name).set_weights(weight)
-        else:
-            ret.get_layer(name).set_weights((weight,))
+        weights = [
+            list(n2w[r["name"]]) if type(n2w[r["name"]]) == tuple else [n2w[r["name"]]]
+            for r in replacement
+        ]
+        parser.replace_layer(target, replacement, weights)
+    ret = parser.materialize(custom_objects=custom_objects)
     return ret, replace_mappings
 
 def add_prefix(model, prefix, custom_objects=None, val_check=None, not_change_model_name=False, not_change_input=False):
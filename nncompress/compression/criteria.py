@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+
+from nncompress import backend as M
+
+_CRITERIA = {}
+
+def register_criterion(name):
+    """A decorator registering a channel-importance criterion.
+
+    A criterion is a function (weights) -> scores, where `weights` is a list of the kernels of
+    the layers in a sharing group and `scores` is a vector over their output channels.
+    Registered criteria can be used as `method` of `prune`.
+
+    """
+    def _register(func):
+        _CRITERIA[name] = func
+        return func
+    return _register
+
+def get_criterion(name):
+    if name not in _CRITERIA:
+        raise NotImplementedError("%s is not a registered criterion." % name)
+    return _CRITERIA[name]
+
+def has_criterion(name):
+    return type(name) == str and name in _CRITERIA
+
+def collect_weights(model, targets):
+    """Fetch the kernels of `targets` with a single `get_weights` call per layer."""
+    return [M.get_weights(model, t)[0] for t in targets]
+
+def _channel_sum(w):
+    # Sum over all axes but the last one (output channels).
+    return w.reshape(-1, w.shape[-1]).sum(axis=0)
+
+def threshold(scores, ratio):
+    """Return the `ratio`-quantile of `scores` by a partial sort, which equals `np.sort(scores)[int((n-1)*ratio)]`."""
+    scores = np.ravel(scores)
+    k = int((len(scores)-1)*ratio)
+    return np.partition(scores, k)[k]
+
+def mask_from_scores(scores, ratio):
+    return (scores >= threshold(scores, ratio)).astype(np.float32)
+
+@register_criterion("l1")
+def l1_score(weights):
+    return np.sum([_channel_sum(np.abs(w)) for w in weights], axis=0)
+
+@register_criterion("l2")
+def l2_score(weights):
+    return np.sqrt(np.sum([_channel_sum(np.square(w)) for w in weights], axis=0))
+
+@register_criterion("group_sum")
+def normalized_score(weights):
+    # Each kernel is normalized by its maximum value.
+    return np.sum([_channel_sum(np.abs(w)) / np.max(w) for w in weights], axis=0)
+
+@register_criterion("w_group_sum")
+def weighted_normalized_score(weights):
+    # Normalized scores weighted by the share of each layer in the L1 norms of the group.
+    # As in the original implementation, the first layer is weighted by 1 (its share was overwritten by the total).
+    l1 = [_channel_sum(np.abs(w)) for w in weights]
+    total = np.sum(l1, axis=0)
+    shares = [np.ones_like(total)] + [n / total for n in l1[1:]]
+    return np.sum([(n / np.max(np.abs(w))) * share for n, w, share in zip(l1, weights, shares)], axis=0)
+
+@register_criterion("random")
+def random_score(weights):
+    return np.random.rand(weights[0].shape[-1],)
+
+def group_mask(model, targets, ratio, criterion="l1"):
+    """Compute a channel mask shared by `targets` with `criterion`.
+
+    # Arguments.
+        model: a model.
+        targets: a list of layer names in a sharing group.
+        ratio: float, the ratio of channels to be removed.
+        criterion: str or function, a registered name or a function (weights) -> scores.
+
+    # Returns.
+        a float32 mask over output channels.
+
+    """
+    func = get_criterion(criterion) if type(criterion) == str else criterion
+    return mask_from_scores(func(collect_weights(model, targets)), ratio)
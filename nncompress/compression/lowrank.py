@@ -5,6 +5,11 @@ import tensorly as tl
 from tensorly.decomposition import partial_tucker
 from scipy.sparse.linalg import svds
 import numpy as np
+import hashlib
+import heapq
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from nncompress import backend as M
 
@@ -20,38 +25,429 @@ def tucker(tensor, in_rank, out_rank):
     vt = vt.astype(tensor.dtype)
     return [u, c, vt]
 
-def svd(mat, rank):
-    u, s, vt = svds(mat, rank)
+def svd(mat, rank, seed=None):
+    # ARPACK starts from a random vector, which is fixed by `seed` for reproducibility.
+    v0 = np.random.default_rng(seed).uniform(size=min(mat.shape)) if seed is not None else None
+    u, s, vt = svds(mat, rank, v0=v0)
     u = u.astype(mat.dtype)
     s = s.astype(mat.dtype)
     vt = vt.astype(mat.dtype)
     return [u, s, vt]
 
-def decompose(model, targets, custom_objects=None):
+def _range_finder(A, size, niters, rng):
+    omega = rng.standard_normal(A.shape[:-2] + (A.shape[-1], size)).astype(A.dtype)
+    Q, _ = np.linalg.qr(np.matmul(A, omega))
+    for _ in range(niters): # power iterations
+        Q, _ = np.linalg.qr(np.matmul(np.swapaxes(A, -1, -2), Q))
+        Q, _ = np.linalg.qr(np.matmul(A, Q))
+    return Q
+
+def randomized_svd(mat, rank, oversample=10, niters=2, seed=None):
+    """Randomized SVD (Halko et al.) of `mat` or a stack of matrices of the same shape.
+
+    # Arguments.
+        mat: a (..., m, n) array.
+        rank: int, the number of singular triplets.
+        oversample: int, the number of extra random projections.
+        niters: int, the number of power iterations.
+        seed: the seed of the random projections.
+
+    # Returns.
+        a list [u, s, vt] of (..., m, rank), (..., rank) and (..., rank, n) arrays.
+
+    """
+    rng = np.random.default_rng(seed)
+    size = min(rank + oversample, mat.shape[-1], mat.shape[-2])
+    Q = _range_finder(mat, size, niters, rng)
+    ub, s, vt = np.linalg.svd(np.matmul(np.swapaxes(Q, -1, -2), mat), full_matrices=False)
+    u = np.matmul(Q, ub)
+    return [u[..., :rank].astype(mat.dtype), s[..., :rank].astype(mat.dtype), vt[..., :rank, :].astype(mat.dtype)]
+
+def _unfold(tensor, mode):
+    # tensor: (batch, ...), mode is counted without the batch axis.
+    t = np.moveaxis(tensor, mode+1, 1)
+    return t.reshape(t.shape[0], t.shape[1], -1)
+
+def randomized_tucker(tensor, in_rank, out_rank, oversample=10, niters=2, seed=None):
+    """Tucker-2 decomposition over the channel axes by randomized HOSVD.
+
+    # Arguments.
+        tensor: a (kh, kw, in, out) kernel or a (batch, kh, kw, in, out) stack of kernels.
+
+    # Returns.
+        a list [u, c, vt] in the same format as `tucker`, having a leading batch axis if `tensor` has it.
+
+    """
+    batched = len(tensor.shape) == 5
+    t = tensor if batched else tensor[np.newaxis, ...]
+    u_in = randomized_svd(_unfold(t, 2), in_rank, oversample, niters, seed)[0]
+    u_out = randomized_svd(_unfold(t, 3), out_rank, oversample, niters, seed)[0]
+    c = np.einsum("bhwio,bir,bos->bhwrs", t, u_in, u_out, optimize=True)
+    u = u_in[:, np.newaxis, np.newaxis, ...]
+    vt = np.swapaxes(u_out, -1, -2)[:, np.newaxis, np.newaxis, ...]
+    ret = [u.astype(tensor.dtype), c.astype(tensor.dtype), vt.astype(tensor.dtype)]
+    if not batched:
+        ret = [x[0] for x in ret]
+    return ret
+
+def weight_hash(weight):
+    h = hashlib.sha1(np.ascontiguousarray(weight).tobytes())
+    h.update(str((weight.shape, weight.dtype.str)).encode())
+    return h.hexdigest()
+
+def full_factorize(weight):
+    """Compute the full-rank factors of a weight, from which any truncation can be sliced.
+
+    For a 2D weight, it is the full SVD [u, s, vt].
+    For a 4D weight, it is the full HOSVD over the channel modes [u_in, core, u_out],
+    where u_in and u_out are the left singular vectors of the input/output channel unfoldings.
+
+    # Returns.
+        a tuple (factors, spectra), where spectra are singular values in descending order.
+
+    """
+    if len(weight.shape) == 2:
+        u, s, vt = np.linalg.svd(weight, full_matrices=False)
+        return [u, s, vt], [s]
+    elif len(weight.shape) == 4:
+        t = weight[np.newaxis, ...]
+        u_in, s_in, _ = np.linalg.svd(_unfold(t, 2)[0], full_matrices=False)
+        u_out, s_out, _ = np.linalg.svd(_unfold(t, 3)[0], full_matrices=False)
+        c = np.einsum("hwio,ir,os->hwrs", weight, u_in, u_out, optimize=True)
+        return [u_in, c, u_out], [s_in, s_out]
+    else:
+        raise NotImplementedError("Unsupported weight shape: %s" % str(weight.shape))
+
+class FactorizationCache(object):
+    """FactorizationCache keeps full-rank factors of weights keyed by layer names and weight hashes.
+
+    A truncated decomposition of any rank is sliced from the cached factors without recomputation.
+    The least recently used entries are evicted when the cached factors exceed `max_bytes`.
+    It is thread-safe, so that `factorize` can use it in a thread pool.
+
+    """
+
+    def __init__(self, max_bytes=512*1024*1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, name, weight):
+        """Return (factors, spectra) of `weight`, computing them if they are not cached."""
+        key = (name, weight_hash(weight))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        entry = full_factorize(weight)
+        nbytes = sum([x.nbytes for x in entry[0] + entry[1]])
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and len(self._entries) > 1:
+                _, (factors, spectra) = self._entries.popitem(last=False)
+                self._nbytes -= sum([x.nbytes for x in factors + spectra])
+        return entry
+
+    def truncate(self, name, weight, rank):
+        """Return the factors of `weight` truncated to `rank` in the same format as `tucker` or `svd`."""
+        factors, _ = self.get(name, weight)
+        if len(weight.shape) == 2:
+            u, s, vt = factors
+            ret = [u[:, :rank], s[:rank], vt[:rank]]
+        else:
+            r_in, r_out = rank
+            u_in, c, u_out = factors
+            ret = [
+                u_in[np.newaxis, np.newaxis, :, :r_in],
+                c[:, :, :r_in, :r_out],
+                np.transpose(u_out[:, :r_out])[np.newaxis, np.newaxis, ...]
+            ]
+        return [np.array(x, dtype=weight.dtype) for x in ret]
+
+_FACTORIZATION_CACHE = FactorizationCache()
+
+def get_factorization_cache():
+    return _FACTORIZATION_CACHE
+
+def get_spectrum(name, weight):
+    """Return the singular spectra of a weight, which are cached by its layer name and content.
+
+    # Returns.
+        a list of singular values in descending order; [s] for a 2D weight,
+        and [s_in, s_out] of the input/output channel unfoldings for a 4D weight.
+
+    """
+    return _FACTORIZATION_CACHE.get(name, weight)[1]
+
+def factorize(items, engine="exact", oversample=10, niters=2, njobs=None, seed=None, names=None):
+    """Decompose weight tensors.
+
+    With the 'randomized' engine, items of the same shape and rank are decomposed together as a batch.
+    With the 'cached' engine, items are truncated from full-rank factors in the factorization cache,
+    so that decomposing the same weight again with another rank costs only slicing.
+    Independent items (or batches) run in a thread pool.
+
+    # Arguments.
+        items: a list of (weight, rank), where rank is an int or (in_rank, out_rank) for a 4D weight.
+        engine: str, 'exact' (tensorly/svds), 'randomized' or 'cached'.
+        oversample: int, the oversampling size of randomized SVD.
+        niters: int, the number of power iterations of randomized SVD.
+        njobs: int, the number of threads.
+        seed: the seed of random projections (randomized) and of the ARPACK start vector (exact SVD).
+        names: a list of layer names of `items`, which are a part of the keys of the factorization cache.
+
+    # Returns.
+        a list of factors ([u, c, vt] for Tucker-2 and [u, s, vt] for SVD) in the order of `items`.
+
+    """
+    def _ranks(w, rank):
+        if len(w.shape) == 4 and type(rank) not in {tuple, list}:
+            return (rank, rank)
+        return tuple(rank) if type(rank) in {tuple, list} else rank
+
+    if engine == "exact":
+        groups = [[idx] for idx in range(len(items))]
+        def run(group):
+            w, rank = items[group[0]]
+            rank = _ranks(w, rank)
+            if len(w.shape) == 4:
+                return [tucker(w, rank[0], rank[1])]
+            else:
+                return [svd(w, rank, seed)]
+    elif engine == "cached":
+        groups = [[idx] for idx in range(len(items))]
+        def run(group):
+            w, rank = items[group[0]]
+            name = names[group[0]] if names is not None else ""
+            return [_FACTORIZATION_CACHE.truncate(name, w, _ranks(w, rank))]
+    elif engine == "randomized":
+        grouped = {}
+        for idx, (w, rank) in enumerate(items):
+            grouped.setdefault((w.shape, w.dtype.str, _ranks(w, rank)), []).append(idx)
+        groups = list(grouped.values())
+        def run(group):
+            w = np.stack([items[idx][0] for idx in group])
+            rank = _ranks(items[group[0]][0], items[group[0]][1])
+            if len(w.shape) == 5:
+                d = randomized_tucker(w, rank[0], rank[1], oversample, niters, seed)
+            elif len(w.shape) == 3:
+                d = randomized_svd(w, rank, oversample, niters, seed)
+            else:
+                raise NotImplementedError("Unsupported weight shape: %s" % str(w.shape[1:]))
+            return [[x[i] for x in d] for i in range(len(group))]
+    else:
+        raise NotImplementedError("`engine` can be 'exact', 'randomized' or 'cached', but %s is given." % engine)
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        results = list(executor.map(run, groups))
+
+    ret = [None for _ in items]
+    for group, result in zip(groups, results):
+        for idx, d in zip(group, result):
+            ret[idx] = d
+    return ret
+
+def energy_rank(spectrum, energy):
+    """Return the smallest rank keeping `energy` of the squared singular values."""
+    e = np.cumsum(spectrum.astype(np.float64)**2)
+    return int(np.searchsorted(e, energy * e[-1] - 1e-12) + 1)
+
+class _LayerCost(object):
+    """The cost (params or FLOPs) of a layer decomposed at a given rank."""
+
+    def __init__(self, shape, in_shape=None, out_shape=None, budget_type="params"):
+        self.shape = shape
+        in_hw, out_hw = 1, 1
+        if budget_type == "flops" and len(shape) == 4:
+            in_hw = int(np.prod(in_shape[1:3]))
+            out_hw = int(np.prod(out_shape[1:3]))
+        self.in_hw, self.out_hw = in_hw, out_hw
+
+    @property
+    def original(self):
+        return int(np.prod(self.shape)) * self.out_hw
+
+    def __call__(self, rank):
+        if len(self.shape) == 2:
+            return rank * (self.shape[0] + self.shape[1])
+        else:
+            kh, kw, cin, cout = self.shape
+            r_in, r_out = rank
+            return cin * r_in * self.in_hw + (kh * kw * r_in * r_out + r_out * cout) * self.out_hw
+
+def select_ranks(model, targets, energy=None, budget=None, budget_type="params", min_rank=3):
+    """Select the ranks of target layers from their singular spectra.
+
+    The ranks of a 4D weight are tied by their relative position over the input/output spectra in both modes,
+    and ranks are clamped to the lengths of the spectra.
+    If `energy` is given, each layer keeps `energy` of its spectral energy (averaged over the tied spectra).
+    If `budget` is given, ranks are reduced greedily, where the layer losing the least energy
+    per saved cost goes first, until the total cost of the targets is at most `budget` times the original one.
+    A layer whose decomposition does not reduce its cost is not decomposed.
+
+    # Arguments.
+        model: a model.
+        targets: a list of layer names.
+        energy: float, the per-layer energy threshold in (0, 1].
+        budget: float, the global budget ratio in (0, 1].
+        budget_type: str, 'params' or 'flops'.
+        min_rank: int, the minimum rank.
+
+    # Returns.
+        a dictionary from layer names to ranks (int for 2D weights, (in_rank, out_rank) for 4D weights).
+
+    """
+    assert (energy is None) != (budget is None), "Either `energy` or `budget` must be given."
+    spectra = {}
+    costs = {}
+    for target in targets:
+        w = M.get_weights(model, target)[0]
+        if len(w.shape) not in {2, 4}:
+            continue
+        spectra[target] = get_spectrum(target, w)
+        if budget_type == "flops":
+            in_shape, out_shape = M.get_io_shapes(model, target)
+        else:
+            in_shape, out_shape = None, None
+        costs[target] = _LayerCost(w.shape, in_shape, out_shape, budget_type)
+
+    def _rank(target, r):
+        # Ranks of a 4D weight are tied by their relative position over the input/output spectra.
+        if len(costs[target].shape) == 2:
+            return r
+        s_in, s_out = spectra[target]
+        scale = len(s_out) / float(len(s_in))
+        return (r, max(min(int(round(r * scale)), len(s_out)), 1))
+
+    def _energy(target, r):
+        # The kept energy of `r` averaged over the spectra.
+        kept = []
+        rank = _rank(target, r)
+        rank = rank if type(rank) == tuple else (rank,)
+        for s, r_ in zip(spectra[target], rank):
+            e = s.astype(np.float64)**2
+            kept.append(np.sum(e[:r_]) / np.sum(e))
+        return float(np.mean(kept))
+
+    def _min_rank(target):
+        return min(min_rank, len(spectra[target][0]))
+
+    def _energy_rank(target):
+        # The smallest tied rank keeping `energy`, found by a binary search since the kept energy is monotone.
+        if len(costs[target].shape) == 2:
+            return energy_rank(spectra[target][0], energy)
+        lo, hi = 1, len(spectra[target][0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _energy(target, mid) >= energy - 1e-12:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    ret = {}
+    if energy is not None:
+        for target in spectra:
+            r = min(max(_energy_rank(target), _min_rank(target)), len(spectra[target][0]))
+            rank = _rank(target, r)
+            if costs[target](rank) < costs[target].original:
+                ret[target] = rank
+        return ret
+
+    # Greedy rank reduction under a global budget.
+    total = sum([cost.original for cost in costs.values()])
+    limit = budget * total
+    curr = {} # target -> the current rank index (None means not decomposed).
+    heap = []
+    def _push(target):
+        r = curr.get(target)
+        cost = costs[target]
+        if r is None:
+            # The largest rank reducing the cost.
+            r_next = len(spectra[target][0])
+            while r_next >= _min_rank(target) and cost(_rank(target, r_next)) >= cost.original:
+                r_next -= 1
+            curr_cost, curr_energy = cost.original, 1.0
+        else:
+            r_next = r - 1
+            curr_cost, curr_energy = cost(_rank(target, r)), _energy(target, r)
+        if r_next < _min_rank(target):
+            return
+        saving = curr_cost - cost(_rank(target, r_next))
+        loss = curr_energy - _energy(target, r_next)
+        heapq.heappush(heap, (loss / max(saving, 1), target, r_next, saving))
+
+    for target in spectra:
+        _push(target)
+    while total > limit and len(heap) > 0:
+        _, target, r_next, saving = heapq.heappop(heap)
+        curr[target] = r_next
+        total -= saving
+        _push(target)
+    for target, r in curr.items():
+        ret[target] = _rank(target, r)
+    return ret
+
+def decompose(model, targets, custom_objects=None, engine="exact", oversample=10, niters=2, njobs=None,
+              energy=None, budget=None, budget_type="params", seed=None):
     """Compress a model written in tf.Keras or PyTorch.
 
     In case of PyTorch, `model` must be a layer.
+    `engine`, `oversample`, `niters`, `njobs` and `seed` are passed to `factorize`.
+    Give `seed` to reproduce a decomposition with the 'randomized' engine.
+    If `energy` or `budget` is given, ranks are chosen by `select_ranks` and the ratios of `targets` are ignored.
 
     """
-    decomposed = []
+    if energy is not None or budget is not None:
+        ranks = select_ranks(model, [target for target, _ in targets], energy=energy, budget=budget, budget_type=budget_type)
+    else:
+        ranks = None
+
+    items = []
+    weights_ = []
     targets_ = []
     for target, ratio in targets:
-        print(target, ratio)
         weights = M.get_weights(model, target)
-        rank = min(int(ratio * weights[0].shape[-1]), int(ratio * weights[0].shape[-2]))
-        if rank < 3:
+        if len(weights[0].shape) not in {2, 4}:
             continue
-        if len(weights[0].shape) == 4:
-            if type(rank) == tuple or type(rank) == list:
-                d = tucker(weights[0], rank[0], rank[1])
-            else:
-                d = tucker(weights[0], rank, rank)
-        elif len(weights[0].shape) == 2:
-            d = svd(weights[0], rank)
+        if ranks is not None:
+            if target not in ranks:
+                continue
+            rank = ranks[target]
+        else:
+            rank = min(int(ratio * weights[0].shape[-1]), int(ratio * weights[0].shape[-2]))
+            if rank < 3:
+                continue
+        items.append((weights[0], rank))
+        weights_.append(weights)
+        targets_.append(target)
+
+    decomposed = factorize(items, engine=engine, oversample=oversample, niters=niters, njobs=njobs, seed=seed, names=targets_)
+    for d, weights in zip(decomposed, weights_):
         if len(weights) > 1:
             d.append(weights[1]) # bias
-        decomposed.append(d)
-        targets_.append(target)
     return M.decompose(model, targets_, decomposed, custom_objects=custom_objects)
 
 if __name__ == "__main__":
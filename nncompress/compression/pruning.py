@@ -4,10 +4,14 @@ from __future__ import print_function
 import numpy as np
 
 from nncompress import backend as M
+from nncompress.compression.criteria import group_mask, has_criterion, l1_score, mask_from_scores
+from nncompress.compression.criteria import get_criterion, collect_weights
 from nncompress.search.projection import extract_sample_features
+from nncompress.search.projection import iter_sample_features
+from nncompress.search.projection import accumulate_normal_equations
 from nncompress.search.projection import least_square_projection
 
-def cali(model, compressed, masking, handler, nsamples=100, feat_data=None):
+def cali(model, compressed, masking, handler, nsamples=100, feat_data=None, memmap_dir=None, method="lstsq", ridge=0.0):
     merged_masking = {}
     for layer_name in masking:
         assert masking[layer_name] is not None
@@ -45,23 +49,26 @@ def cali(model, compressed, masking, handler, nsamples=100, feat_data=None):
 
     ## apply projection
     if feat_data is None:
-        temp_data = extract_sample_features(model, layers_, handler, nsamples=nsamples)
-        feat_data = {}
-        for layer_name, feat_data_ in temp_data.items():
-            feat_data[layer_name] = feat_data_
-    least_square_projection(compressed, feat_data, merged_masking)
+        if method == "normal":
+            # Stream batches into the normal equations without keeping sampled features.
+            use_bias = {layer.name:layer.use_bias for layer in layers_}
+            feat_data = accumulate_normal_equations(
+                iter_sample_features(model, layers_, handler, nsamples=nsamples), use_bias=use_bias, ridge=ridge)
+        else:
+            temp_data = extract_sample_features(model, layers_, handler, nsamples=nsamples, memmap_dir=memmap_dir)
+            feat_data = {}
+            for layer_name, feat_data_ in temp_data.items():
+                feat_data[layer_name] = feat_data_
+    least_square_projection(compressed, feat_data, merged_masking, method=method, ridge=ridge)
 
 def _magnitude_based_mask(w, ratio, mode):
-    w = np.abs(w)
     if mode == "channel": # output channel
-        sum_ = np.sum(w, axis=tuple([i for i in range(len(w.shape)-1)]))
-        sorted_ = np.sort(sum_, axis=None)
-        val = sorted_[int((len(sorted_)-1)*ratio)]
-        removal = (sum_ >= val).astype(np.float32)
-        return removal
+        return mask_from_scores(l1_score([w]), ratio)
     elif mode == "weight":
-        sorted_ = np.sort(w, axis=None)
-        val = sorted_[int(len(sorted_)*ratio)]
+        w = np.abs(w)
+        flat = w.ravel()
+        k = int(len(flat)*ratio)
+        val = np.partition(flat, k)[k]
         w_ = (w >= val).astype(np.float32)
         return w_
     else:
@@ -71,64 +78,143 @@ def group_pruning_mask(model, targets, ratio):
     """A magnitude-based pruning method for sharing layers
 
     """
-    sum_ = None
-    for t in targets:
-        layer = model.get_layer(t)
-        w = layer.get_weights()[0]
-        if sum_ is None:
-            sum_ = np.sum(np.abs(w)/np.max(w), axis=tuple([i for i in range(len(w.shape)-1)]))
-        else:
-            sum_ += np.sum(np.abs(w)/np.max(w), axis=tuple([i for i in range(len(w.shape)-1)]))
-    sorted_ = np.sort(sum_, axis=None)
-    val = sorted_[int((len(sorted_)-1)*ratio)]
-    removal = (sum_ >= val).astype(np.float32)
-    return removal
+    return group_mask(model, targets, ratio, criterion="group_sum")
 
 def random_mask(model, targets, ratio):
     """A magnitude-based pruning method for sharing layers
 
     """
-    t = targets[0]
-    w = model.get_layer(t).get_weights()[0]
-    sum_ = np.random.rand(w.shape[-1],)
-    sorted_ = np.sort(sum_, axis=None)
-    val = sorted_[int((len(sorted_)-1)*ratio)]
-    removal = (sum_ >= val).astype(np.float32)
-    return removal
+    return group_mask(model, targets[:1], ratio, criterion="random")
 
 def weighted_group_pruning_mask(model, targets, ratio):
     """A magnitude-based pruning method for sharing layers
 
     """
-    weight = []
-    Ns = []
-    sum_ = None
-    for idx, t in enumerate(targets):
-        layer = model.get_layer(t)
-        w = np.abs(layer.get_weights()[0])
-        N = np.sum(w, axis=tuple([i for i in range(len(w.shape)-1)]))
-        if sum_ is None:
-            sum_ = N
-        else:
-            sum_ += N
-        Ns.append(N)
-    for idx, N in enumerate(Ns):
-        weight.append(N/sum_)
-
-    sum_ = None
-    for idx, t in enumerate(targets):
-        layer = model.get_layer(t)
-        w = np.abs(layer.get_weights()[0])
-        N = np.sum(w, axis=tuple([i for i in range(len(w.shape)-1)]))
-
-        if sum_ is None:
-            sum_ = np.sum(w/np.max(w), axis=tuple([i for i in range(len(w.shape)-1)])) * weight[idx]
-        else:
-            sum_ += np.sum(w/np.max(w), axis=tuple([i for i in range(len(w.shape)-1)])) * weight[idx]
-    sorted_ = np.sort(sum_, axis=None)
-    val = sorted_[int((len(sorted_)-1)*ratio)]
-    removal = (sum_ >= val).astype(np.float32)
-    return removal
+    return group_mask(model, targets, ratio, criterion="w_group_sum")
+
+def _layer_flops(model, layer_name, w):
+    # The multiply-accumulates of a layer having kernel `w`.
+    _, out_shape = M.get_io_shapes(model, layer_name)
+    out_hw = int(np.prod(out_shape[1:-1])) if len(out_shape) > 2 else 1
+    return float(w.size) * out_hw
+
+def _model_flops(model):
+    ret = 0.0
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if len(weights) > 0 and len(weights[0].shape) in {2, 4}:
+            ret += _layer_flops(model, layer.name, weights[0])
+    return ret
+
+def _group_costs(model, group, weights, budget_type, consumers=None):
+    # The cost of a channel is the cost of producing it in the layers of `group`,
+    # and the cost of consuming it in the layers fed only by `group` (`consumers`).
+    if budget_type == "channels":
+        return 1.0
+    elif budget_type == "flops":
+        cost = 0.0
+        for layer_name, w in zip(group, weights):
+            cost += _layer_flops(model, layer_name, w) / w.shape[-1]
+        for layer_name in consumers or []:
+            weights_ = M.get_weights(model, layer_name)
+            if len(weights_) > 0 and len(weights_[0].shape) in {2, 4}:
+                cost += _layer_flops(model, layer_name, weights_[0]) / weights[0].shape[-1]
+        return cost
+    else:
+        raise NotImplementedError("`budget_type` can be 'channels' or 'flops', but %s is given." % budget_type)
+
+def global_prune_masks(model, ratio, criterion="l1", budget_type="channels", min_channels=3, custom_objects=None):
+    """Compute channel masks of all the prunable sharing groups under a global target.
+
+    Channel scores are normalized by the maximum score of each group and ranked together,
+    and the lowest ones are removed until `ratio` of the total cost is removed.
+    With `budget_type` 'flops', the cost of a channel is the FLOPs of the layers producing it and
+    of the layers consuming it (their input channels), and `ratio` is a ratio of the FLOPs of the whole model.
+    The consumers fed through a concatenation are not counted (conservative).
+    Groups having concatenated items are not pruned.
+
+    # Arguments.
+        model: a model.
+        ratio: float, the ratio of the cost to be removed.
+        criterion: str or function, a criterion in `nncompress.compression.criteria`.
+        budget_type: str, 'channels' or 'flops'.
+        min_channels: int, the minimum number of channels kept in each group.
+
+    # Returns.
+        a list of (target, mask) for `M.prune`, where target is the first layer of a group.
+
+    """
+    func = get_criterion(criterion) if type(criterion) == str else criterion
+    prunable = [
+        group for group in M.get_prunable_groups(model, custom_objects=custom_objects)
+        if all([type(l) == str for l in group])
+    ]
+    consumers = {}
+    if budget_type == "flops":
+        l2g = {l:gid for gid, group in enumerate(prunable) for l in group}
+        for layer_name, producers in M.get_channel_consumers(model, custom_objects=custom_objects).items():
+            gids = set([l2g.get(p) for p in producers])
+            if len(gids) == 1 and None not in gids: # fed only by a single group
+                consumers.setdefault(gids.pop(), []).append(layer_name)
+
+    groups = []
+    scores = []
+    costs = []
+    for gid, group in enumerate(prunable):
+        weights = collect_weights(model, group)
+        nchannels = weights[0].shape[-1]
+        if nchannels < 3 or any([w.shape[-1] != nchannels for w in weights]):
+            continue
+        s = np.asarray(func(weights), dtype=np.float64)
+        s = s / max(np.max(s), 1e-12)
+        groups.append(group)
+        scores.append(s)
+        costs.append(np.full(nchannels, _group_costs(model, group, weights, budget_type, consumers.get(gid))))
+    if len(groups) == 0:
+        return []
+
+    gids = np.concatenate([np.full(len(s), gid) for gid, s in enumerate(scores)])
+    offsets = np.cumsum([0] + [len(s) for s in scores])
+    all_scores = np.concatenate(scores)
+    all_costs = np.concatenate(costs)
+    target = ratio * (_model_flops(model) if budget_type == "flops" else np.sum(all_costs))
+
+    keep = np.ones_like(all_scores, dtype=bool)
+    remaining = np.array([len(s) for s in scores])
+    removed = 0.0
+    for idx in np.argsort(all_scores, kind="stable"):
+        if removed >= target:
+            break
+        gid = gids[idx]
+        if remaining[gid] <= min_channels:
+            continue
+        keep[idx] = False
+        remaining[gid] -= 1
+        removed += all_costs[idx]
+
+    masking = []
+    for gid, group in enumerate(groups):
+        mask = keep[offsets[gid]:offsets[gid+1]]
+        if np.all(mask):
+            continue
+        masking.append((group[0], mask.astype(np.float32)))
+    return masking
+
+def global_prune(model, ratio, criterion="l1", budget_type="channels", min_channels=3, custom_objects=None):
+    """Prune all the prunable sharing groups of a model together with a single `M.prune` call.
+
+    # Returns.
+        a tuple (model, replace_mappings, history) as `prune`.
+
+    """
+    masking = global_prune_masks(
+        model, ratio, criterion=criterion, budget_type=budget_type, min_channels=min_channels, custom_objects=custom_objects)
+    replace_mappings = []
+    for target, _ in masking:
+        for s in M.get_sharing_layers(model, target, custom_objects=custom_objects):
+            replace_mappings.append((s, [s]))
+    model_, history = M.prune(model, masking, mode="channel", custom_objects=custom_objects)
+    return model_, replace_mappings, history
 
 def prune_filter(model, domain, targets, mode="channel", method="magnitude", sample_inputs=None, custom_objects=None):
     return M.prune_filter(model, domain, mode, custom_objects)  
@@ -164,12 +250,10 @@ def prune(model, targets, mode="channel", method="magnitude", sample_inputs=None
                 else:
                     raise NotImplementedError("%s is not implemented." % method)
                 mask = _magnitude_based_mask(w, ratio, mode)
-            elif method == "group_sum":
-                mask = group_pruning_mask(model, sharing_layers, ratio)
-            elif method == "w_group_sum":
-                mask = weighted_group_pruning_mask(model, sharing_layers, ratio)
             elif method == "random":
                 mask = random_mask(model, sharing_layers, ratio)
+            elif has_criterion(method):
+                mask = group_mask(model, sharing_layers, ratio, criterion=method)
             elif callable(method):
                 mask = method(model, sharing_layers, ratio)
             else:
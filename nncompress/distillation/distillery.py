@@ -13,13 +13,44 @@ def make_teacher_output(name, t_idx=0, flow_idx=0, tensor_idx=0):
 def make_student_output(name, flow_idx=0, tensor_idx=0):
     return (name, flow_idx, tensor_idx)
 
+class DevicePlacement(tf.keras.layers.Layer):
+    """A layer running `model` on `device` whenever it is executed.
+
+    A `tf.device` scope around a symbolic call of a functional model is not kept in the graph,
+    so the scope is entered in `call`, i.e., where the model executes.
+
+    """
+
+    def __init__(self, model, device, **kwargs):
+        super(DevicePlacement, self).__init__(**kwargs)
+        self.model = model
+        self.device = device
+
+    def call(self, inputs, training=None):
+        with tf.device(self.device):
+            return self.model(inputs, training=training)
+
 class Distillery(object):
 
     def __init__(self, teachers, student):
         self.teachers = teachers
         self.student = student
 
-    def prep(self, recipe):
+    def prep(self, recipe, devices=None):
+        """Make a student having distillation losses defined by `recipe`.
+
+        Each teacher is called once, and its outputs are shared by all the loss terms using it.
+
+        # Arguments.
+            recipe: a list of (teacher outputs, student outputs, weight, loss function).
+            devices: a list of device names. If it is given, the `i`-th used teacher runs on `devices[i % len(devices)]`.
+                Teachers are independent branches of the student graph, so that teachers on different devices
+                run concurrently in a compiled step.
+
+        # Returns.
+            a Keras model.
+
+        """
         self._recipe = recipe # backup
         student = tf.keras.models.clone_model(self.student, input_tensors=self.student.input)
 
@@ -36,16 +67,26 @@ class Distillery(object):
                 if (name, flow_idx, tensor_idx) not in t_outputs[t_idx]:
                     t_outputs[t_idx][(name, flow_idx, tensor_idx)] = tensors
 
-        # Define teachers with intermediate features 
-        teachers = []
+        # Define teachers with intermediate features, and call each of them once.
+        t_results = [None for _ in range(len(self.teachers))]
         t_output_idx = [{} for _ in range(len(self.teachers))]
+        nused = 0
         for idx, teacher in enumerate(self.teachers):
+            if len(t_outputs[idx]) == 0: # unused
+                continue
             output = []
             for item, val in t_outputs[idx].items():
                 output.append(val)
                 t_output_idx[idx][item] = len(output)-1
-            teachers.append(Model(inputs=teacher.input, outputs=output))
-  
+            feature_model = Model(inputs=teacher.input, outputs=output)
+            if devices is not None:
+                feature_model = DevicePlacement(feature_model, devices[nused % len(devices)])
+            nused += 1
+            results = feature_model(student.input)
+            if type(results) != list:
+                results = [results]
+            t_results[idx] = results
+
         # Compute loss
         for idx, (teachers_outputs, student_outputs, weight, func) in enumerate(self._recipe):
             if type(teachers_outputs) == tuple:
@@ -56,8 +97,7 @@ class Distillery(object):
             t_tensors = []
             for t_item in teachers_outputs:
                 t_idx, name, flow_idx, tensor_idx = t_item
-                outputs = teachers[t_idx](student.input)
-                t_tensors.append(outputs[t_output_idx[t_idx][(name, flow_idx, tensor_idx)]])
+                t_tensors.append(t_results[t_idx][t_output_idx[t_idx][(name, flow_idx, tensor_idx)]])
             s_tensors = []
             for s_item in student_outputs:
                 name, flow_idx, tensor_idx = s_item 
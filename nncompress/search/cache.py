@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+IGNORED_KWARGS = {"custom_objects"}
+
+def _canonicalize(value, ndigits):
+    if isinstance(value, float):
+        return value if ndigits is None else round(value, ndigits)
+    elif isinstance(value, (list, tuple)):
+        return [_canonicalize(v, ndigits) for v in value]
+    elif isinstance(value, dict):
+        return {str(k):_canonicalize(v, ndigits) for k, v in value.items()}
+    elif callable(value):
+        return getattr(value, "__name__", repr(value))
+    elif value is None or isinstance(value, (bool, int, str)):
+        return value
+    else:
+        return repr(value)
+
+def action_key(action, ndigits=6):
+    """Return a canonical JSON-compatible form of a compression action.
+
+    # Arguments.
+        action: a tuple (function, kwargs) generated by `random_sample`.
+        ndigits: int, floats are rounded to `ndigits` digits. If it is None, they are kept as they are.
+
+    """
+    func, kwargs = action
+    kwargs = {
+        key:_canonicalize(val, ndigits) for key, val in kwargs.items() if key not in IGNORED_KWARGS
+    }
+    return [_canonicalize(func, ndigits), kwargs]
+
+def state_key(parent_key, actions, ndigits=6):
+    """Compute the key of a state derived from the state of `parent_key` by applying `actions`.
+
+    """
+    h = hashlib.sha1()
+    h.update(str(parent_key).encode())
+    h.update(json.dumps([action_key(a, ndigits) for a in actions], sort_keys=True).encode())
+    return h.hexdigest()
+
+class ScoreCache(object):
+    """ScoreCache is a persistent dictionary from state keys to scores.
+
+    Scores are appended to a JSON-lines file at `path` as soon as they are put,
+    so that a restarted search reads the scores computed before.
+
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._scores = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError: # a partially written line
+                        continue
+                    self._scores[item["key"]] = item["score"]
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, key):
+        return key in self._scores
+
+    def get(self, key):
+        if key in self._scores:
+            self.hits += 1
+            return self._scores[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, score):
+        score = float(score)
+        self._scores[key] = score
+        with open(self._path, "a") as f:
+            f.write(json.dumps({"key":key, "score":score}) + "\n")
+
+class ModelCache(object):
+    """ModelCache keeps at most `capacity` models, evicting the least recently used one.
+    It is thread-safe, so that states can be scored in a thread pool.
+
+    """
+
+    def __init__(self, capacity=4):
+        self._capacity = capacity
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return len(self._models)
+
+    def get(self, name):
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                self.hits += 1
+                return self._models[name]
+            self.misses += 1
+            return None
+
+    def put(self, name, model):
+        with self._lock:
+            self._models[name] = model
+            self._models.move_to_end(name)
+            while len(self._models) > self._capacity:
+                self._models.popitem(last=False)
+
+    def remove(self, name):
+        with self._lock:
+            self._models.pop(name, None)
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import json
+import random
+
+import numpy as np
+
+def get_rng_state():
+    """Return the states of `random` and `numpy.random` in a JSON-compatible form."""
+    version, internal, gauss = random.getstate()
+    np_state = np.random.get_state()
+    return {
+        "random":[version, list(internal), gauss],
+        "numpy":[np_state[0], np_state[1].tolist(), int(np_state[2]), int(np_state[3]), float(np_state[4])]
+    }
+
+def set_rng_state(state):
+    version, internal, gauss = state["random"]
+    random.setstate((version, tuple(internal), gauss))
+    name, keys, pos, has_gauss, cached = state["numpy"]
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached))
+
+class SearchJournal(object):
+    """SearchJournal is an append-only log for resuming a search.
+
+    It has two kinds of records in a JSON-lines file at `path`.
+    A 'state' record is a compact descriptor of a state (its action log, ancestors and score).
+    An 'iter' record is written after each completed iteration, and it has the solver state,
+    the RNG state and the names of the current and the best states.
+    A later 'state' record of the same name overrides earlier ones.
+
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._written = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    def exists(self):
+        return os.path.exists(self._path)
+
+    def is_written(self, name, key):
+        return self._written.get(name) == key
+
+    def add_state(self, desc):
+        self._append(dict(desc, type="state"))
+        self._written[desc["name"]] = desc["key"]
+
+    def add_iteration(self, record):
+        self._append(dict(record, type="iter"))
+
+    def _append(self, record):
+        with open(self._path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self):
+        """Load the journal.
+
+        # Returns.
+            a tuple (states, last), where `states` is a dictionary from state names to descriptors,
+            and `last` is the last 'iter' record (None if there is no completed iteration).
+
+        """
+        states = {}
+        last = None
+        with open(self._path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError: # a partially written line
+                    continue
+                if record["type"] == "state":
+                    states[record["name"]] = record
+                else:
+                    last = record
+        self._written = {name:desc["key"] for name, desc in states.items()}
+        return states, last
@@ -7,13 +7,20 @@ import copy
 import os
 import json
 import shutil
+import hashlib
+import inspect
+import threading
+import weakref
 
+import numpy as np
 import tensorflow as tf
 
 from nncompress.compression.lowrank import decompose
 from nncompress.compression.pruning import prune, prune_filter
 from nncompress.algorithms.solver.simulated_annealing import SimulatedAnnealingSolver
 from nncompress.algorithms.solver.solver import State
+from nncompress.search.cache import ScoreCache, ModelCache, state_key, action_key
+from nncompress.search.journal import SearchJournal, get_rng_state, set_rng_state
 from nncompress import backend as M
 
 def random_sample(model, search_space, nsteps, use_same_spec=False, filter_func=None):
@@ -58,21 +65,143 @@ def random_sample(model, search_space, nsteps, use_same_spec=False, filter_func=
         actions.append((spec[0], kwargs))
     return actions
 
+def is_deterministic(action):
+    """Return whether replaying `action` gives the same model, which a seeded random engine does."""
+    func, kwargs = action
+    return kwargs.get("engine", "exact") != "randomized" or kwargs.get("seed") is not None
+
+def seed_actions(actions):
+    """Give a seed to actions using random factorization, so that they are recorded and replayed identically.
+    Deterministic actions are left unseeded, so that identical ones share their score-cache keys."""
+    for func, kwargs in actions:
+        if "seed" in inspect.signature(func).parameters and kwargs.get("engine", "exact") == "randomized" and kwargs.get("seed") is None:
+            kwargs["seed"] = random.randint(0, 2**31-1)
+    return actions
+
+def model_key(model):
+    """Return a key of `model` covering its structure and the bytes of its weights.
+
+    """
+    h = hashlib.sha1(M.fingerprint(model).encode())
+    for w in model.get_weights():
+        h.update(str(w.dtype).encode())
+        h.update(np.ascontiguousarray(w).tobytes())
+    return h.hexdigest()
+
+def apply_actions(model, actions, verbose=True):
+    """Apply compression actions to `model` in order, stopping at the first failed action.
+
+    # Arguments.
+        model: a Keras model.
+        actions: a list of (function, kwargs).
+        verbose: bool, whether actions are printed. Replays of known actions are not printed.
+
+    # Returns.
+        a tuple (model, log, masking), where `log` has (replace_mappings, action) of the applied actions.
+
+    """
+    log = []
+    masking = []
+    for a in actions:
+        if verbose:
+            print(a)
+        try:
+            ret = a[0](model, **a[1])
+            if len(ret) == 2:
+                model, replace_mappings = ret
+            elif len(ret) == 3:
+                model, replace_mappings, history = ret
+                masking.append((history, a))
+            log.append((replace_mappings, a))
+        except Exception as e:
+            print(e)
+            print(traceback.format_exc())
+            print("A problem occurs with %s(%s)" % (str(a[0]), str(a[1])))
+            break
+    return model, log, masking
+
 class CompressionState(State):
+    """A state of compression search.
 
-    def __init__(self, name, model, ctx, ancestors=None, log=None):
+    A state keeps its action log and ancestors instead of its model.
+    Its model is rebuilt from the parent model (`ancestors[-1]`) on demand,
+    and it is kept in the model cache of `ctx`, which bounds the number of alive models.
+    A state given `model` (e.g., the initial state) pins it.
+
+    Since the parent model may also be evicted, rebuilding can replay the actions of several generations.
+    A parent whose `replay_depth` reaches `ctx.max_replay_depth` is pinned before it is used,
+    so that at most `max_replay_depth` generations are replayed for a model.
+
+    A state changed in place (e.g., fine-tuned) should call `detach_children` before the change,
+    so that its children are not rebuilt from the changed model.
+
+    """
+
+    def __init__(self, name, model, ctx, ancestors=None, log=None, key=None):
         super(CompressionState, self).__init__()
         self._name = name
         self._model = model
         self._ancestors = ancestors or []
         self._ctx = ctx
         self._score = None
+        self._key = key
+        self._journal_key = key # the key when it is built from its actions.
+        self._children = weakref.WeakSet() # alive states whose models are replayed on this model.
         self.log = log
+        if len(self._ancestors) > 0:
+            self._ancestors[-1]._children.add(self)
+
+    @property
+    def key(self):
+        """The canonical key of the state, which is derived from its parent key and its action log."""
+        return self._key
 
     @property
     def model(self):
+        if self._model is not None:
+            return self._model
+        model = self._ctx.model_cache.get(self._name)
+        if model is None:
+            model, _, _ = apply_actions(M.copy_(self.parent_for_replay().model), self.actions, verbose=False)
+            self._ctx.model_cache.put(self._name, model)
+        return model
+
+    @property
+    def replay_depth(self):
+        """The number of generations to be replayed to rebuild the model of this state from a pinned one."""
+        if self._model is not None:
+            return 0
+        return self._ancestors[-1].replay_depth + 1
+
+    def parent_for_replay(self):
+        """Return the parent, which is pinned if it is too far from a pinned state."""
+        parent = self._ancestors[-1]
+        if parent.replay_depth >= self._ctx.max_replay_depth:
+            parent.pin()
+        return parent
+
+    @property
+    def actions(self):
+        return [a for _, a in (self.log or [])]
+
+    def pin(self):
+        """Keep the model of this state alive, since it cannot be rebuilt from actions (e.g., fine-tuned).
+
+        # Returns.
+            the model.
+
+        """
+        if self._model is None:
+            self._model = self.model
+            self._ctx.model_cache.remove(self._name)
         return self._model
 
+    def detach_children(self):
+        """Pin the alive children of this state, so that their models are kept as built from the current model."""
+        for child in list(self._children):
+            child.pin()
+        self._children = weakref.WeakSet()
+
     @property
     def name(self):
         return self._name
@@ -96,31 +225,19 @@ class CompressionState(State):
                 while len(ancestors)-1 > cidx:
                     ancestors.pop()
             candidate = ancestors[-1]
+            if candidate.replay_depth >= self._ctx.max_replay_depth:
+                candidate.pin()
             actions = random_sample(candidate.model, self._ctx.search_space, self._ctx.nsteps, use_same_spec=True, filter_func=self._ctx.filter_func)
-            model = M.copy_(candidate.model)
-            log = []
-            masking = []
-            for a in actions:
-                print(a)
-                try:
-                    ret = a[0](model, **a[1])
-                    if len(ret) == 2:
-                        model, replace_mappings = ret
-                    elif len(ret) == 3:
-                        model, replace_mappings, history = ret
-                        masking.append((history, a))
-                    log.append((replace_mappings, a))
-                except Exception as e:
-                    print(e)
-                    print(traceback.format_exc())
-                    print("A problem occurs with %s(%s)" % (str(a[0]), str(a[1])))
-                    break
+            actions = seed_actions(actions)
+            model, log, masking = apply_actions(M.copy_(candidate.model), actions)
             ret = CompressionState(
                 name=self._ctx.generate_state_name(),
-                model=model,
+                model=None,
                 ctx=self._ctx,
                 ancestors=ancestors[-1*self._ctx.h:],
-                log=log)
+                log=log,
+                key=state_key(candidate.key, [a for _, a in log]))
+            self._ctx.model_cache.put(ret.name, model)
             if self._ctx.compression_callbacks is not None:
                 pid = ret.ancestors[-1].name
                 cid = ret.name
@@ -130,8 +247,9 @@ class CompressionState(State):
 
 class NNCompress(object):
 
-    def __init__(self, model, handler, dir_=os.getcwd(), max_iters=1000, h=3, nsteps=3, search_space=None, compression_callbacks=None, finetune_callback=None, custom_objects=None, solver_kwargs=None, filter_func=None, overwrite=False):
+    def __init__(self, model, handler, dir_=os.getcwd(), max_iters=1000, h=3, nsteps=3, search_space=None, compression_callbacks=None, finetune_callback=None, custom_objects=None, solver_kwargs=None, filter_func=None, overwrite=False, score_cache=True, resume=False, model_cache_size=4, max_replay_depth=2):
         self._model = model # original model, which will not be modified.
+        self._custom_objects = custom_objects
         self._masks = {} # to mask gradients
         self._states = []
         self._max_iters = max_iters
@@ -151,6 +269,7 @@ class NNCompress(object):
             self._search_space = [
                 (decompose, {
                     "targets":(0.0, 1.0),
+                    "engine":["exact"], # ["cached"] reuses factors of the same weights over candidates (truncated HOSVD).
                     "custom_objects":custom_objects
                 }),
                 (prune, {
@@ -164,6 +283,8 @@ class NNCompress(object):
         self._finetune_callback = finetune_callback
         if not os.path.exists(dir_):
             os.mkdir(dir_)
+        elif resume:
+            print("%s does exist, so the search will be resumed." % dir_)
         else:
             if overwrite:
                 shutil.rmtree(dir_)
@@ -173,6 +294,17 @@ class NNCompress(object):
                 import sys
                 sys.exit(1)
         self._dir_ = dir_
+        self.score_cache = ScoreCache(os.path.join(dir_, "scores.jsonl")) if score_cache else None
+        self.journal = SearchJournal(os.path.join(dir_, "journal.jsonl"))
+        # Keep the whole batch of neighbors proposed by the solver with their parent.
+        batch_size = (solver_kwargs or {}).get("batch_size", 1)
+        self.model_cache = ModelCache(max(model_cache_size, batch_size + 1))
+        # The maximum number of generations replayed to rebuild an evicted model.
+        self.max_replay_depth = max(max_replay_depth, 1)
+        self._resume = resume
+        # Scores can be computed in a thread pool (`executor` of `solver_kwargs`), while neither building models
+        # from actions nor appending to the score cache is thread-safe.
+        self._lock = threading.Lock()
 
     @property
     def search_space(self):
@@ -184,12 +316,91 @@ class NNCompress(object):
 
     def get_dir(self):
         return self._dir_
-       
+
+    def _journal_state(self, state):
+        """Write the descriptor of `state` and its ancestors into the journal if it is not written yet.
+        The model of a state changed after its creation (e.g., fine-tuned) is saved, since it cannot be rebuilt from its actions.
+
+        """
+        for a in state.ancestors:
+            self._journal_state(a)
+        if self.journal.is_written(state.name, state.key):
+            return
+        model_path = None
+        if state.key != state._journal_key:
+            models_path = os.path.join(self.get_dir(), "journal_models")
+            if not os.path.exists(models_path):
+                os.mkdir(models_path)
+            model_path = os.path.join(models_path, "%s.h5" % state.name)
+            tf.keras.models.save_model(state.model, model_path)
+        self.journal.add_state({
+            "name":state.name,
+            "key":state.key,
+            "score":state.score,
+            "ancestors":[a.name for a in state.ancestors],
+            "actions":[action_key(a, ndigits=None) for a in state.actions],
+            "model_path":model_path
+        })
+
+    def _restore_state(self, name, descs, restored):
+        """Rebuild a state from its descriptor. Its model is built lazily by replaying its actions on its parent."""
+        if name in restored:
+            return restored[name]
+        desc = descs[name]
+        ancestors = [self._restore_state(a, descs, restored) for a in desc["ancestors"]]
+        specs = {spec[0].__name__:spec for spec in self._search_space}
+        actions = []
+        for func_name, kwargs in desc["actions"]:
+            func, spec_kwargs = specs[func_name]
+            if "custom_objects" in spec_kwargs:
+                kwargs["custom_objects"] = spec_kwargs["custom_objects"]
+            if desc["model_path"] is None and not is_deterministic((func, kwargs)):
+                raise ValueError("%s cannot be resumed, since its action %s(%s) is not seeded." % (name, func_name, str(kwargs)))
+            actions.append((func, kwargs))
+
+        if desc["model_path"] is not None:
+            model = tf.keras.models.load_model(desc["model_path"], custom_objects=self._custom_objects)
+        elif len(ancestors) == 0: # the initial state
+            model = self._model
+        else:
+            model = None # rebuilt on demand
+        log = [(None, a) for a in actions]
+        state = CompressionState(name=name, model=model, ctx=self, ancestors=ancestors, log=log, key=desc["key"])
+        state._score = desc["score"]
+        restored[name] = state
+        return state
+
     def compress(self):
-        init_state = CompressionState(name=self.generate_state_name(), model=self._model, ctx=self)
+        """Run the search.
+        If `resume` is given, it continues from the last completed iteration recorded in the journal.
+        Note that a custom finetune callback should call `state.detach_children()` before training a state in place,
+        and re-score the trained state with `force=True`, so that the trained model is saved in the journal.
 
+        """
         self.history = []
         self.last_score = -1
+
+        last = None
+        if self._resume and self.journal.exists():
+            descs, last = self.journal.load()
+        if last is not None:
+            restored = {}
+            init_state = self._restore_state(last["state"], descs, restored)
+            best = self._restore_state(last["best"], descs, restored)
+            self._id_cnt["state"] = last["id_cnt"]
+            self.last_score = last["last_score"]
+            self.history = [self._restore_state(name, descs, restored) for name in last.get("history", [])]
+            set_rng_state(last["rng"])
+            solve_kwargs = {
+                "start_iter":last["iter"]+1,
+                "best":best,
+                "best_score":last["best_score"],
+                "temp":last["temp"]
+            }
+            print("Resume the search from iteration %d." % (last["iter"]+1))
+        else:
+            init_state = CompressionState(name=self.generate_state_name(), model=self._model, ctx=self, key=model_key(self._model))
+            solve_kwargs = {}
         def finetune_callback(state, i, transition):
             if len(self.history) >= 10:
                 max_score = -1
@@ -198,6 +409,9 @@ class NNCompress(object):
                         score(state_)
                     max_score = max(max_score, state_.score)
                 if self.last_score != -1 and max_score / self.last_score < 1.05:
+                    state.pin()
+                    # Children (e.g., the best state) must not be replayed on the fine-tuned model.
+                    state.detach_children()
                     self.handler.train(state.model)
                     max_score = score(state, force=True)
                 self.last_score = max_score 
@@ -218,12 +432,44 @@ class NNCompress(object):
 
         def score(state, force=False):
             if state.score is None or force:
-                score_ = self.handler.score(state.model)
+                score_ = None
+                model = None
+                with self._lock:
+                    if force:
+                        state.pin()
+                        # The model is changed by fine-tuning, so that its descendants should not share keys with the untrained one.
+                        state._key = state_key(state.key, [("finetune", {"name":state.name})])
+                    elif self.score_cache is not None:
+                        score_ = self.score_cache.get(state.key)
+                    if score_ is None:
+                        model = state.model
+                if score_ is None:
+                    score_ = self.handler.score(model)
+                    if self.score_cache is not None:
+                        with self._lock:
+                            self.score_cache.put(state.key, score_)
                 state._score =  score_
             else:
                 score_ = state.score
             return score_
 
+        def journal_callback(state, i, transition):
+            self._journal_state(state)
+            self._journal_state(solver.best)
+            for state_ in self.history: # the window of the default finetune callback
+                self._journal_state(state_)
+            self.journal.add_iteration({
+                "iter":i,
+                "temp":solver.temp,
+                "state":state.name,
+                "best":solver.best.name,
+                "best_score":solver.best_score,
+                "id_cnt":self._id_cnt["state"],
+                "last_score":self.last_score,
+                "history":[state_.name for state_ in self.history],
+                "rng":get_rng_state()
+            })
+
         solver = SimulatedAnnealingSolver(score, self._max_iters, **(self._solver_kwargs or {}))
         finetune_cbk = finetune_callback if self._finetune_callback is None else self._finetune_callback
-        return solver.solve(init_state, callbacks=[dump_callback, finetune_cbk])
+        return solver.solve(init_state, callbacks=[dump_callback, finetune_cbk, journal_callback], **solve_kwargs)
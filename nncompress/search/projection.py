@@ -1,10 +1,80 @@
 from __future__ import print_function
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import tensorflow as tf
 from sklearn.linear_model import LinearRegression
+from scipy.linalg import cho_factor, cho_solve
 import numpy as np
 
-def extract_sample_features(model, layers, handler, nsamples=3, npoints=10):
+class FeatureBuffer(object):
+    """A growable row buffer for sampled features.
+
+    Rows are written into a preallocated array, which is doubled when it is full.
+    If `path` is given, the array is a memory-mapped `.npy` file, so that it does not
+    have to fit in RAM.
+
+    """
+
+    def __init__(self, ncols, dtype, capacity=1024, path=None):
+        self._ncols = ncols
+        self._dtype = dtype
+        self._path = path
+        self._size = 0
+        self._gen = 0
+        self._data = self._alloc(max(capacity, 1), self._gen)
+
+    def _alloc(self, capacity, gen):
+        shape = (capacity, self._ncols)
+        if self._path is None:
+            return np.empty(shape, dtype=self._dtype)
+        path = self._path if gen == 0 else "%s.%d" % (self._path, gen)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=self._dtype, shape=shape)
+
+    def append(self, rows):
+        n = rows.shape[0]
+        if self._size + n > self._data.shape[0]:
+            capacity = self._data.shape[0]
+            while self._size + n > capacity:
+                capacity *= 2
+            self._gen += 1
+            data = self._alloc(capacity, self._gen)
+            data[:self._size] = self._data[:self._size]
+            old, self._data = self._data, data
+            if isinstance(old, np.memmap):
+                fname = old.filename
+                del old
+                os.remove(fname)
+        self._data[self._size:self._size+n] = rows
+        self._size += n
+
+    def get(self):
+        return self._data[:self._size]
+
+    @property
+    def filename(self):
+        """The file of the current array, or None if it is in memory."""
+        return self._data.filename if isinstance(self._data, np.memmap) else None
+
+    def flush(self):
+        if isinstance(self._data, np.memmap):
+            self._data.flush()
+
+def iter_sample_features(model, layers, handler, nsamples=3, npoints=10):
+    """Yield sampled (input, output) features of `layers` batch by batch.
+
+    # Arguments.
+        model: a Keras model.
+        layers: a list of layers in `model`.
+        handler: a TaskHandler, which gives training data.
+        nsamples: int, the argument of `handler.sample_training_data`.
+        npoints: int, the number of spatial points sampled from a 4D feature map.
+
+    # Returns.
+        a generator of dictionaries from layer names to (input, output) 2D matrices.
+
+    """
     tensors = []
     for idx, layer in enumerate(layers):
         tensors.append(layer.inbound_nodes[0].input_tensors)
@@ -12,40 +82,177 @@ def extract_sample_features(model, layers, handler, nsamples=3, npoints=10):
     model_ = tf.keras.Model(inputs=model.inputs,
                         outputs=tensors)
     sampled_data = handler.sample_training_data(nsamples)
-    ret = {}
     for data in sampled_data:
         X, Y = data
-        Y_ = model_.predict(X, verbose=0)
+        Y_ = model_.predict_on_batch(X)
+        ret = {}
         for idx, layer in enumerate(layers):
-            layer_input = Y_[2*idx]
-            layer_output = Y_[2*idx+1]
+            layer_input = np.asarray(Y_[2*idx])
+            layer_output = np.asarray(Y_[2*idx+1])
             if len(layer_input.shape) == 4:
                 #sampling coordinates
                 if layer_input.shape[2] == 1:
-                    random_X = [0]
+                    random_X = np.zeros((1,), dtype=np.int64)
                 else:
                     random_X = np.random.randint(0, layer_input.shape[2]-1, npoints)
 
                 if layer_input.shape[1] == 1:
-                    random_Y = [0]
+                    random_Y = np.zeros((1,), dtype=np.int64)
                 else:
                     random_Y = np.random.randint(0, layer_input.shape[1]-1, npoints)
 
                 assert len(random_X) == len(random_Y)
-                npoints_ = len(random_X)
-                sampled_input = layer_input[:, random_Y, random_X, :].reshape(handler.batch_size * npoints_, -1)
-                sampled_output = layer_output[:, random_Y, random_X, :].reshape(handler.batch_size * npoints_, -1)
+                # A single gather per feature map over the sampled points of all the batch items.
+                sampled_input = layer_input[:, random_Y, random_X, :].reshape(-1, layer_input.shape[-1])
+                sampled_output = layer_output[:, random_Y, random_X, :].reshape(-1, layer_output.shape[-1])
             else:
                 sampled_input = layer_input
                 sampled_output = layer_output
-            if layer.name not in ret:
-                ret[layer.name] = [sampled_input, sampled_output]
-            else:
-                ret[layer.name][0] = np.vstack((ret[layer.name][0], sampled_input))
-                ret[layer.name][1] = np.vstack((ret[layer.name][1], sampled_output))
-    return ret
+            ret[layer.name] = (sampled_input, sampled_output)
+        yield ret
+
+def extract_sample_features(model, layers, handler, nsamples=3, npoints=10, memmap_dir=None):
+    """Collect sampled features of `layers` into per-layer matrices.
+
+    If `memmap_dir` is given, the matrices are memory-mapped `.npy` files in the directory.
+
+    """
+    ret = {}
+    for batch in iter_sample_features(model, layers, handler, nsamples=nsamples, npoints=npoints):
+        for layer_name, (sampled_input, sampled_output) in batch.items():
+            if layer_name not in ret:
+                # `nsamples` batches are expected. Buffers grow if more rows come.
+                capacity = sampled_input.shape[0] * max(nsamples, 1)
+                buffers = []
+                for tag, feat in [("input", sampled_input), ("output", sampled_output)]:
+                    path = None
+                    if memmap_dir is not None:
+                        path = os.path.join(memmap_dir, "%s_%s.npy" % (layer_name.replace("/", "_"), tag))
+                    buffers.append(FeatureBuffer(feat.shape[-1], feat.dtype, capacity=capacity, path=path))
+                ret[layer_name] = buffers
+            ret[layer_name][0].append(sampled_input)
+            ret[layer_name][1].append(sampled_output)
+    return {
+        layer_name:[buffers[0].get(), buffers[1].get()]
+        for layer_name, buffers in ret.items()
+    }
+
+class NormalEquationSolver(object):
+    """A least square solver accumulating the normal equations of mini-batches.
+
+    It keeps X^T X and X^T Y (and column sums for the intercept), so that its memory
+    is O(d^2) regardless of the number of samples.
+    The system is solved with Cholesky factorization, and `ridge` adds L2 regularization
+    on the coefficients (not on the intercept).
 
-def least_square_projection(model, feature_data, masking):
+    """
+
+    def __init__(self, fit_intercept=True, ridge=0.0):
+        self.fit_intercept = fit_intercept
+        self.ridge = ridge
+        self._n = 0
+        self._xtx = None
+        self._xty = None
+        self._sx = None
+        self._sy = None
+
+    def update(self, X, Y):
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        if self._xtx is None:
+            self._xtx = np.zeros((X.shape[-1], X.shape[-1]))
+            self._xty = np.zeros((X.shape[-1], Y.shape[-1]))
+            self._sx = np.zeros((X.shape[-1],))
+            self._sy = np.zeros((Y.shape[-1],))
+        self._xtx += X.T @ X
+        self._xty += X.T @ Y
+        self._sx += X.sum(axis=0)
+        self._sy += Y.sum(axis=0)
+        self._n += X.shape[0]
+
+    def solve(self, input_mask=None):
+        """Solve the system over the input features selected by `input_mask`.
+
+        # Returns.
+            a tuple (W, b), where W is a (d_in, d_out) matrix and b is a (d_out,) vector.
+
+        """
+        xtx, xty, sx = self._xtx, self._xty, self._sx
+        if input_mask is not None:
+            xtx = xtx[np.ix_(input_mask, input_mask)]
+            xty = xty[input_mask]
+            sx = sx[input_mask]
+        if self.fit_intercept:
+            mx = sx / self._n
+            my = self._sy / self._n
+            xtx = xtx - self._n * np.outer(mx, mx)
+            xty = xty - self._n * np.outer(mx, my)
+        A = xtx + self.ridge * np.eye(xtx.shape[0])
+        try:
+            W = cho_solve(cho_factor(A), xty)
+        except np.linalg.LinAlgError: # singular without regularization
+            W = np.linalg.lstsq(A, xty, rcond=None)[0]
+        if self.fit_intercept:
+            b = my - mx @ W
+        else:
+            b = np.zeros((xty.shape[-1],))
+        return W, b
+
+def accumulate_normal_equations(batches, use_bias=None, ridge=0.0, chunk_size=4096):
+    """Build NormalEquationSolver objects from feature batches.
+
+    # Arguments.
+        batches: an iterable of dictionaries from layer names to (X, Y), such as `iter_sample_features`,
+            or a dictionary from layer names to (X, Y) matrices.
+        use_bias: a dictionary from layer names to whether their intercepts are fitted.
+        ridge: float, the L2 regularization strength.
+        chunk_size: int, the number of rows fed at once when full matrices are given.
+
+    # Returns.
+        a dictionary from layer names to solvers.
+
+    """
+    if isinstance(batches, dict):
+        data = batches
+        def _chunks():
+            for layer_name, (X, Y) in data.items():
+                for i in range(0, X.shape[0], chunk_size):
+                    yield {layer_name:(X[i:i+chunk_size], Y[i:i+chunk_size])}
+        batches = _chunks()
+
+    solvers = {}
+    for batch in batches:
+        for layer_name, (X, Y) in batch.items():
+            if layer_name not in solvers:
+                fit_intercept = True if use_bias is None else use_bias.get(layer_name, True)
+                solvers[layer_name] = NormalEquationSolver(fit_intercept=fit_intercept, ridge=ridge)
+            solvers[layer_name].update(X, Y)
+    return solvers
+
+def _fit_lstsq(layer, X, Y, input_mask):
+    if input_mask is not None:
+        X = X[:,input_mask]
+    reg = LinearRegression(fit_intercept=layer.use_bias)
+    reg.fit(X, Y)
+    return reg.coef_.transpose(1,0), reg.intercept_
+
+def least_square_projection(model, feature_data, masking, method="lstsq", ridge=0.0, njobs=None):
+    """Reconstruct the weights of the layers in `model` from sampled features.
+
+    # Arguments.
+        model: a compressed Keras model.
+        feature_data: a dictionary from layer names to (X, Y) matrices,
+            or to NormalEquationSolver objects for `method` 'normal'.
+        masking: a dictionary from layer names to (input mask, output mask).
+        method: str, 'lstsq' (sklearn LinearRegression) or 'normal' (Cholesky on the normal equations).
+        ridge: float, the L2 regularization strength for 'normal'.
+        njobs: int, the number of threads solving layers in parallel for 'normal'.
+
+    """
+    if method not in {"lstsq", "normal"}:
+        raise NotImplementedError("`method` can be 'lstsq' or 'normal', but %s is given." % method)
+
+    targets = []
     for layer_name in feature_data:
         try:
             layer = model.get_layer(layer_name)
@@ -53,18 +260,35 @@ def least_square_projection(model, feature_data, masking):
             continue
         if layer_name not in masking:
             continue
+        targets.append((layer_name, layer))
+
+    if method == "normal":
+        data = {
+            layer_name:feat for layer_name, feat in feature_data.items() if not isinstance(feat, NormalEquationSolver)
+        }
+        if len(data) > 0:
+            use_bias = {layer_name:layer.use_bias for layer_name, layer in targets}
+            solvers = accumulate_normal_equations(data, use_bias=use_bias, ridge=ridge)
+        else:
+            solvers = {}
+        for layer_name, feat in feature_data.items():
+            if isinstance(feat, NormalEquationSolver):
+                solvers[layer_name] = feat
+        # LAPACK releases the GIL, so that threads solve layers concurrently.
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            results = list(executor.map(
+                lambda t: solvers[t[0]].solve(masking[t[0]][0]), targets))
+    else:
+        results = [
+            _fit_lstsq(layer, feature_data[layer_name][0], feature_data[layer_name][1], masking[layer_name][0])
+            for layer_name, layer in targets
+        ]
 
-        X, Y = feature_data[layer_name]
-        if masking[layer_name][0] is not None:
-            X = X[:,masking[layer_name][0]]
-            reg = LinearRegression(fit_intercept=layer.use_bias)
-        reg.fit(X, Y)
-        W = reg.coef_.transpose(1,0)
-        b = reg.intercept_
+    for (layer_name, layer), (W, b) in zip(targets, results):
         if masking[layer_name][1] is not None:
-            W = W[:,masking[layer_name][1]]
             if type(b) == float:
-                b = np.ones((Y.shape[-1],)) * b
+                b = np.ones((W.shape[-1],)) * b
+            W = W[:,masking[layer_name][1]]
             b = b[np.array(masking[layer_name][1])]
         if layer.__class__.__name__ == "Conv2D":
             W = W.reshape(1, 1, W.shape[-2], W.shape[-1])
@@ -43,3 +43,171 @@ class CompressionTest(TestCase):
     def test_04_channel_pruning(self):
         model, nparams, acc, new_nparams, new_acc = self.compress("seq", method=lambda x:prune(x, [("conv2d_3", 0.5)]))
         self.assertEqual(int(new_nparams), 707749)
+
+    def test_05_feature_buffer(self):
+        import tempfile
+        import numpy as np
+        from nncompress.search.projection import FeatureBuffer
+        rows = [np.random.rand(n, 4).astype(np.float32) for n in [3, 1, 7, 2]]
+        for path in [None, os.path.join(tempfile.mkdtemp(), "feat.npy")]:
+            buf = FeatureBuffer(4, np.float32, capacity=2, path=path)
+            for r in rows:
+                buf.append(r)
+            self.assertTrue(np.array_equal(buf.get(), np.vstack(rows)))
+
+    def test_06_normal_equation_solver(self):
+        import numpy as np
+        from sklearn.linear_model import LinearRegression
+        from nncompress.search.projection import accumulate_normal_equations
+        X = np.random.rand(500, 8)
+        Y = np.matmul(X, np.random.rand(8, 5)) + np.random.rand(5)
+        mask = np.array([1, 0, 1, 1, 0, 1, 1, 1], dtype=bool)
+        solver = accumulate_normal_equations({"dense":(X, Y)}, chunk_size=64)["dense"]
+        W, b = solver.solve(mask)
+        reg = LinearRegression().fit(X[:,mask], Y)
+        self.assertTrue(np.allclose(W, reg.coef_.transpose(1,0)))
+        self.assertTrue(np.allclose(b, reg.intercept_))
+
+    def test_07_randomized_factorization(self):
+        import numpy as np
+        from nncompress.compression.lowrank import factorize
+        mat = np.matmul(np.random.rand(128, 8), np.random.rand(8, 64)).astype(np.float32)
+        kernel = np.random.rand(3, 3, 32, 48).astype(np.float32)
+        d_mat, d_mat2, d_kernel = factorize([(mat, 8), (mat*2, 8), (kernel, 6)], engine="randomized")
+        u, s, vt = d_mat
+        self.assertTrue(np.allclose(np.matmul(u * s, vt), mat, atol=1e-3))
+        self.assertEqual([x.shape for x in d_kernel], [(1, 1, 32, 6), (3, 3, 6, 6), (1, 1, 6, 48)])
+        d1, d2 = [factorize([(kernel, 6)], engine="randomized", seed=7)[0] for _ in range(2)]
+        self.assertTrue(all([np.array_equal(x, y) for x, y in zip(d1, d2)]))
+
+    def test_08_rank_selection(self):
+        from nncompress.compression.lowrank import select_ranks
+        model = common.request_model("seq")
+        ranks = select_ranks(model, ["dense", "conv2d_3"], energy=0.9)
+        for target, rank in ranks.items():
+            self.assertTrue(min(rank if type(rank) == tuple else (rank,)) >= 3)
+        model, nparams, acc, new_nparams, new_acc = self.compress("seq", method=lambda x:decompose(x, [("dense", 1.0), ("conv2d_3", 1.0)], budget=0.5))
+        self.assertTrue(new_nparams < nparams)
+
+    def test_09_factorization_cache(self):
+        import numpy as np
+        from nncompress.compression.lowrank import factorize, get_factorization_cache
+        cache = get_factorization_cache()
+        cache.clear()
+        mat = np.random.rand(64, 32).astype(np.float32)
+        d1, = factorize([(mat, 8)], engine="cached", names=["dense"])
+        d2, = factorize([(mat, 4)], engine="cached", names=["dense"])
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        self.assertTrue(np.allclose(d1[0][:, :4], d2[0]))
+
+    def test_10_pruning_criteria(self):
+        import numpy as np
+        from nncompress.compression.criteria import register_criterion, threshold
+        scores = np.random.rand(100)
+        for ratio in [0.0, 0.3, 1.0]:
+            self.assertEqual(threshold(scores, ratio), np.sort(scores)[int(99*ratio)])
+
+        @register_criterion("last_channels")
+        def last_channels(weights):
+            return np.arange(weights[0].shape[-1])
+        model, nparams, acc, new_nparams, new_acc = self.compress("seq", method=lambda x:prune(x, [("conv2d_3", 0.5)], method="last_channels"))
+        self.assertEqual(int(new_nparams), 707749)
+
+    def test_11_global_pruning(self):
+        from nncompress.compression.pruning import global_prune
+        model, nparams, acc, new_nparams, new_acc = self.compress("seq", method=lambda x:global_prune(x, 0.5))
+        self.assertTrue(new_nparams < nparams)
+        model, nparams, acc, new_nparams_, new_acc = self.compress("seq", method=lambda x:global_prune(x, 0.5, budget_type="flops"))
+        self.assertTrue(new_nparams_ < nparams)
+
+    def test_12_gate_statistics(self):
+        import numpy as np
+        from nncompress.backend.tensorflow_ import GateStatistics
+        g1 = np.random.rand(4, 8).astype(np.float32)
+        g2 = np.random.rand(4, 8).astype(np.float32)
+        stats = GateStatistics(8, nmembers=2)
+        stats.add(g1)
+        stats.add(g2)
+        stats.flush()
+        self.assertTrue(np.allclose(stats.read().numpy(), np.sum(np.square(g1 + g2), axis=0)))
+        stats.add(g1) # a step where the other member is skipped
+        self.assertTrue(np.allclose(stats.read().numpy(), np.sum(np.square(g1 + g2) + np.square(g1), axis=0)))
+        stats.reset()
+        self.assertEqual(float(tf.reduce_sum(stats.read())), 0.0)
+        stats = GateStatistics(8, per_call=True) # the statistics of a single gate called twice in a step
+        stats.add(g1)
+        stats.add(g2)
+        stats.flush()
+        self.assertTrue(np.allclose(stats.read().numpy(), np.sum(np.square(g1) + np.square(g2), axis=0)))
+
+    def test_13_distillery_single_call(self):
+        import numpy as np
+        from nncompress.distillation.distillery import Distillery, make_teacher_output, make_student_output
+
+        class CountingLayer(keras.layers.Layer):
+            ncalls = 0
+            def call(self, x):
+                CountingLayer.ncalls += 1
+                return x
+
+        def build(prefix, counting=False):
+            input_ = keras.Input(shape=(8, 8, 3))
+            x = CountingLayer(name=prefix+"count")(input_) if counting else input_
+            x = keras.layers.Conv2D(4, 3, padding="same", name=prefix+"conv1")(x)
+            x = keras.layers.Conv2D(4, 3, padding="same", name=prefix+"conv2")(x)
+            x = keras.layers.Conv2D(4, 3, padding="same", name=prefix+"conv3")(x)
+            return keras.Model(input_, x)
+
+        teacher = build("t_", counting=True)
+        distiller = Distillery([teacher], build(""))
+        student = distiller.prep([
+            (make_teacher_output("t_conv1"), make_student_output("conv1"), 1.0, "mean_squared_error"),
+            (make_teacher_output("t_conv2"), make_student_output("conv2"), 1.0, "mean_squared_error")
+        ])
+        CountingLayer.ncalls = 0
+        student(np.zeros((2, 8, 8, 3), dtype=np.float32))
+        self.assertEqual(CountingLayer.ncalls, 1) # the teacher runs once for both loss terms.
+        self.assertEqual(len(student.losses), 2)
+
+        # A teacher placed on a device is still called once.
+        student = distiller.prep([
+            (make_teacher_output("t_conv1"), make_student_output("conv1"), 1.0, "mean_squared_error"),
+            (make_teacher_output("t_conv2"), make_student_output("conv2"), 1.0, "mean_squared_error")
+        ], devices=["/cpu:0"])
+        CountingLayer.ncalls = 0
+        student(np.zeros((2, 8, 8, 3), dtype=np.float32))
+        self.assertEqual(CountingLayer.ncalls, 1)
+
+    def test_14_deterministic_action_key(self):
+        from nncompress.search.nncompress import seed_actions
+        from nncompress.search.cache import state_key
+        keys = []
+        for _ in range(2):
+            actions = seed_actions([(decompose, {"targets":[("dense", 0.5)], "engine":"exact"})])
+            self.assertTrue("seed" not in actions[0][1])
+            keys.append(state_key("root", actions))
+        self.assertEqual(keys[0], keys[1])
+        actions = seed_actions([(decompose, {"targets":[("dense", 0.5)], "engine":"randomized"})])
+        self.assertTrue(actions[0][1]["seed"] is not None)
+
+    def test_15_weighted_group_sum(self):
+        import numpy as np
+        from nncompress.compression.criteria import get_criterion, mask_from_scores
+        # The first layer is weighted by 1 and the others by their shares in the L1 norms, as in the original masks.
+        weights = [np.array([[1., 5., 3., 2.]]), np.array([[7., 8., 8., 7.]])]
+        scores = get_criterion("w_group_sum")(weights)
+        self.assertTrue(np.allclose(scores, [1/5 + 7/8 * 7/8, 1 + 8/13, 3/5 + 8/11, 2/5 + 7/8 * 7/9]))
+        self.assertTrue(np.array_equal(mask_from_scores(scores, 0.5), [0., 1., 1., 1.]))
+
+    def test_16_teacher_cache_order(self):
+        import tempfile
+        import numpy as np
+        from examples.image_classification.teacher_cache import TeacherCache
+        batches = [(np.random.rand(2, 4).astype(np.float32), np.eye(2, dtype=np.float32)) for _ in range(3)]
+        teacher = lambda X, training=False: 2.0 * X
+        cache = TeacherCache.build(teacher, batches, tempfile.mkdtemp(), with_inputs=False)
+        for _ in range(2): # epochs
+            for X, y, outputs in cache.iterate(batches):
+                self.assertTrue(np.allclose(outputs[0].numpy(), 2.0 * X, atol=1e-2))
+        with self.assertRaises(ValueError): # reshuffled
+            list(cache.iterate(batches[::-1]))
@@ -35,3 +35,106 @@ class TransformationTest(TestCase):
         n, m = compute_nodes_edges(model)
         self.assertEqual(n, 320)
         self.assertEqual(m, 404)
+
+    def test_parser_cache_01(self):
+        from nncompress import backend as M
+        resnet = common.request_model("json")
+        M.invalidate_parser_cache()
+        cache = M.get_parser_cache()
+        hits = cache.hits
+
+        groups = M.get_sharing_groups(resnet)
+        for group in groups:
+            self.assertEqual(M.get_sharing_layers(resnet, group[0]), group)
+        self.assertEqual(cache.hits - hits, len(groups))
+
+        M.invalidate_parser_cache(resnet)
+        self.assertEqual(len(cache), 0)
+
+    def test_parser_cache_02(self):
+        from nncompress.backend.tensorflow_.transformation.cache import fingerprint
+        def build(activation):
+            input_ = keras.Input(shape=(8, 8, 3), name="input")
+            return keras.Model(input_, keras.layers.Conv2D(4, 3, activation=activation, name="conv")(input_))
+        # Models differing only in layer configs must not share a cached model dictionary.
+        self.assertEqual(fingerprint(build("relu")), fingerprint(build("relu")))
+        self.assertNotEqual(fingerprint(build("relu")), fingerprint(build("linear")))
+
+    def test_incremental_edit_01(self):
+        resnet = common.request_model("json")
+        parser = PruningNNParser(resnet)
+        parser.parse()
+
+        model_json = json.dumps(parser._model_dict)
+        editor = parser.fork()
+        editor.remove_layer("conv2_block1_2_relu")
+        editor.insert_layer({"class_name":"ReLU", "config":{"name":"conv2_block1_2_relu_"}}, "conv2_block1_2_bn")
+        self.assertEqual(parser.version, 0)
+        self.assertEqual(editor.version, 2)
+        self.assertEqual(json.dumps(parser._model_dict), model_json) # shared layer dicts are not modified.
+
+        model = editor.materialize()
+        n, m = compute_nodes_edges(model)
+        self.assertEqual((n, m), compute_nodes_edges(resnet))
+
+        reparsed = PruningNNParser(model)
+        reparsed.parse()
+        self.assertEqual(reparsed.get_sharing_groups(), editor.get_sharing_groups())
+
+    def test_sharing_group_merger_01(self):
+        from nncompress.backend.tensorflow_.transformation.pruning_parser import SharingGroupMerger
+        merger = SharingGroupMerger()
+        merger.add(["a", ("b", "c")])
+        merger.add(["d"])
+        merger.add(["a"]) # merged into the first group.
+        merger.add(["c", "e"]) # ("b", "c") is kicked out.
+        merger.add(["d", "f"])
+        self.assertEqual(merger.get_groups(), [["c", "e", "a"], ["d", "f"]])
+
+    def test_traverse_index_01(self):
+        resnet = common.request_model("json")
+        parser = PruningNNParser(resnet)
+        parser.parse()
+
+        index = parser.get_index()
+        n, m = compute_nodes_edges(resnet)
+        self.assertEqual(len(index["names"]), n)
+        self.assertEqual(index["out_ptr"][-1], index["in_ptr"][-1])
+        self.assertEqual(parser.traverse(), parser.traverse(node_callbacks=[lambda n, level: None]))
+
+        editor = parser.fork()
+        editor.remove_layer("conv2_block1_2_relu")
+        self.assertEqual(len(editor.get_index()["names"]), n-1)
+        self.assertEqual(len(parser.get_index()["names"]), n)
+
+    def test_cut_alignment_01(self):
+        import numpy as np
+        from nncompress.backend.tensorflow_.transformation.handler import align_gate
+
+        gate = np.zeros((40,), dtype=bool)
+        gate[:13] = True
+        scores = np.arange(40, dtype=np.float32)
+        aligned = align_gate(gate, 8, scores)
+        self.assertEqual(int(np.sum(aligned)), 16)
+        self.assertTrue(np.all(aligned[37:])) # the highest-scoring pruned channels are re-admitted.
+        self.assertEqual(int(np.sum(align_gate(gate, 16))), 16)
+        gate[:33] = True
+        self.assertEqual(int(np.sum(align_gate(gate, 16))), 40)
+
+        resnet = common.request_model("json")
+        parser = PruningNNParser(resnet)
+        parser.parse()
+        gmodel = parser.inject()
+        for layer in gmodel.layers:
+            if layer.__class__.__name__ == "DifferentiableGate":
+                gates = np.ones((layer.ngates,), dtype=np.float32)
+                gates[:layer.ngates // 3 + 1] = 0.0
+                layer.gates.assign(gates)
+
+        model_json = json.dumps(parser._model_dict)
+        cmodel = parser.cut(gmodel, channel_multiple=8)
+        self.assertEqual(json.dumps(parser._model_dict), model_json) # the parsed (cached) dict is not modified.
+        for layer in cmodel.layers:
+            if layer.__class__.__name__ == "Conv2D":
+                filters = layer.get_config()["filters"]
+                self.assertTrue(filters % 8 == 0 or filters == resnet.get_layer(layer.name).filters)